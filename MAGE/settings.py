@@ -185,6 +185,9 @@ CACHES = {
     }
 }
 
+# Number of parsed MQL queries and naming language patterns kept in memory (per process and per language)
+MAGE_PARSE_CACHE_SIZE = 1000
+
 DEFAULT_PROJECT_ID = None
 LOCAL_APPS = []
 try:
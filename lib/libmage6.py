@@ -124,6 +124,23 @@ class MageClient(object):
             response = request.json()
         return response
 
+    def run_mql_queries(self, queries):
+        """Execute many queries on mage in a single HTTP call.
+        @:return list of the results of each query, in the same order. Each result is a list of component instance
+         descriptions (or, for queries with a LIMIT clause, a dict with the results and the cursor of the next page)."""
+        url = urljoin(self.base_url, "ref/mqlbatch/json")
+        if self._session is None:
+            msg = "You must login before trying to run a query"
+            self.logger.fatal(msg)
+            raise LibMageException(msg)
+        self.logger.debug("Running %s mage queries: %s" % (len(queries), queries))
+        request = self._session.post(url, json=list(queries))
+        if request.status_code != 200:
+            msg = "Cannot query Mage. Response was %s: %s" % (request.status_code, request.reason)
+            self.logger.critical(msg)
+            raise LibMageException(msg)
+        return request.json()
+
 
     def mage_get_delivery_id(self):
         raise NotImplementedError()
@@ -119,6 +119,15 @@ class TestQuerying(LiveServerTestCase):
         #BUG: fail with django live test server, but works when runs as the only test or against previously launched mage. Bug in MAGE server or django ?
 
 
+    def test_multiple_queries(self):
+        m = MageClient(self.live_server_url, USERNAME, PASSWORD)
+        m.login()
+        queries = ["SELECT ENVIRONMENT 'DEV1' 'oracleschema' INSTANCES", "SELECT ENVIRONMENT 'DEV1' 'oracleschema' INSTANCES where name='schema1'"]
+        r = m.run_mql_queries(queries)
+        self.assertEqual([3, 1], [len(results) for results in r])
+        self.assertEqual(u'schema1', r[1][0]['name'])
+
+
     def test_query_without_login(self):
         m = MageClient(self.live_server_url, USERNAME, PASSWORD)
         self.assertRaises(LibMageException, m.run_mql_query, "query", self.project)
\ No newline at end of file
@@ -1,60 +1,110 @@
 # coding: utf-8
 from django.core.cache import cache
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch.dispatcher import receiver
 
-from ref.models.instances import ComponentInstance, ComponentInstanceField
+from ref.models.instances import ComponentInstanceField, ComponentInstanceRelation, ComponentInstance, Environment
+from ref.models.logical import ComponentImplementationClass, LogicalComponent
+from ref.models.classifier import Project
 from ref.models.description import ImplementationComputedFieldDescription, \
-    ImplementationRelationDescription, ImplementationFieldDescription
+    ImplementationRelationDescription, ImplementationFieldDescription, ImplementationDescription
+from ref.naming_language import bump_generations
+from ref import value_index
+from ref.computed_store import affected_by_field, affected_by_relation, refresh, purge, purge_depending_on, reset_dependency_index
 
 
+@receiver(post_save, sender=ComponentInstance)
+@receiver(post_delete, sender=ComponentInstance)
 @receiver(post_save, sender=ComponentInstanceField)
-def empty_computed_cache(sender, instance, created, raw, using, update_fields, **kwargs):
-    if not instance.pk or created or raw:
+@receiver(post_delete, sender=ComponentInstanceField)
+@receiver(post_save, sender=ComponentInstanceRelation)
+@receiver(post_delete, sender=ComponentInstanceRelation)
+@receiver(m2m_changed, sender=ComponentInstance.environments.through)
+@receiver(post_save, sender=Environment)
+@receiver(post_delete, sender=Environment)
+@receiver(post_save, sender=ImplementationDescription)
+@receiver(post_delete, sender=ImplementationDescription)
+@receiver(post_save, sender=ImplementationFieldDescription)
+@receiver(post_delete, sender=ImplementationFieldDescription)
+@receiver(post_save, sender=ImplementationRelationDescription)
+@receiver(post_delete, sender=ImplementationRelationDescription)
+@receiver(post_save, sender=ImplementationComputedFieldDescription)
+@receiver(post_delete, sender=ImplementationComputedFieldDescription)
+@receiver(post_save, sender=ComponentImplementationClass)
+@receiver(post_delete, sender=ComponentImplementationClass)
+@receiver(post_save, sender=LogicalComponent)
+@receiver(post_delete, sender=LogicalComponent)
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def empty_mql_cache(sender, **kwargs):
+    ## Any change of the referential may change the result of any MQL query
+    bump_generations(['mql'])
+
+@receiver(post_save, sender=ComponentInstanceField)
+def index_field_value(sender, instance, created, **kwargs):
+    ## Also done for raw saves (fixtures): wildcard queries would miss values without trigrams
+    value_index.index([instance], created)
+
+@receiver(post_save, sender=ComponentInstanceField)
+@receiver(post_delete, sender=ComponentInstanceField)
+def refresh_computed_on_field(sender, instance, raw=False, **kwargs):
+    if raw:
         return
-    ci_id = instance.instance_id
-    cis = ComponentInstance.objects.prefetch_related('reverse_relationships__reverse_relationships__reverse_relationships').get(pk=ci_id)
-    computed_fields = ImplementationComputedFieldDescription.objects.all()
-    d = {}
-    for cf in computed_fields:
-        try:
-            d[cf.description_id].append(cf.id)
-        except KeyError:
-            d[cf.description_id] = [cf.id, ]
-    
-    clean_ci(cis, d, 3)
+    refresh(affected_by_field(instance.field_id, instance.instance_id))
 
-def clean_ci(ci, d, rec_level):
-    i = 0
-    try:
-        for field_id in d[ci.description_id]:
-            cache.delete('computed_%s_%s' % (field_id, ci.pk))
-            i += 1
-    except KeyError:
-        # Types without computed fields
-        pass
-    
-    cache.delete('computed_id_%s_%s' % (ci.description_id, ci.pk))
-    
-    if rec_level > 0:
-        for cc in ci.reverse_relationships.all():
-            i += clean_ci(cc, d, rec_level - 1)
-    return i
+@receiver(post_save, sender=ComponentInstanceRelation)
+@receiver(post_delete, sender=ComponentInstanceRelation)
+def refresh_computed_on_relation(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh(affected_by_relation(instance.field_id, instance.source_id))
 
 @receiver(post_save, sender=ImplementationComputedFieldDescription)
-def empty_commuted_cache_on_description(sender, instance, created, raw, using, update_fields, **kwargs):
-    if not instance.pk or created or raw:
+@receiver(post_delete, sender=ImplementationComputedFieldDescription)
+def empty_commuted_cache_on_description(sender, instance, raw=False, **kwargs):
+    reset_dependency_index()
+    if not instance.pk or raw:
+        return
+    purge(instance)
+
+@receiver(post_save, sender=ImplementationDescription)
+def empty_self_description_cache(sender, instance, raw, **kwargs):
+    reset_dependency_index()
+    if raw:
         return
-    for ci in ComponentInstance.objects.filter(description_id=instance.description_id):
-        cache.delete('computed_%s_%s' % (instance.pk, ci.pk))
-        
-    
+    bump_generations(['id_%s' % instance.pk])
+
+@receiver(post_delete, sender=ImplementationDescription)
+def reset_dependencies(sender, **kwargs):
+    reset_dependency_index()
+
+@receiver(pre_save, sender=ImplementationFieldDescription)
+@receiver(pre_save, sender=ImplementationRelationDescription)
+def keep_previous_name(sender, instance, raw, **kwargs):
+    if instance.pk is None or raw:
+        return
+    instance._previous_name = sender.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+@receiver(post_delete, sender=ImplementationFieldDescription)
+@receiver(post_delete, sender=ImplementationRelationDescription)
+def purge_computed_on_delete(sender, instance, **kwargs):
+    reset_dependency_index()
+    purge_depending_on([instance.name])
+
 @receiver(post_save, sender=ImplementationFieldDescription)
 @receiver(post_save, sender=ImplementationRelationDescription)
 def empty_form_cache(sender, instance, created, raw, using, update_fields, **kwargs):
-    if not instance.pk or created or raw:
+    reset_dependency_index()
+    if not instance.pk or raw:
+        return
+
+    ## Patterns using the old or the new name may now give other values
+    previous_name = getattr(instance, '_previous_name', None)
+    if created or previous_name != instance.name:
+        purge_depending_on([previous_name, instance.name])
+    if created:
         return
-    
+
     # remove from cache the form class for the description that was just modified
     # Note: not a standard cache call because these object are not pickable. Cache is simply used as
     # a reference to allow global purge.
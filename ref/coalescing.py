@@ -0,0 +1,189 @@
+# coding: utf-8
+'''
+    Single-flight request coalescing for script APIs: when many identical requests arrive at the same time, only the
+    first one is computed and all the others receive the same bytes.
+
+    Inside a process, waiting requests are simply blocked on an event. Between processes, the Django cache is used:
+    the computing process holds a lock key (cache.add is atomic with every real backend) and publishes the result
+    under a key unique to the computation. With the local memory backend each process works on its own, which is
+    still correct.
+
+    @license: Apache License, Version 2.0
+'''
+
+## Python imports
+import time
+from functools import wraps
+from hashlib import md5
+from threading import Event, Lock
+from uuid import uuid4
+
+## Django imports
+from django.conf import settings
+from django.core.cache import cache
+from django.http.response import HttpResponse
+
+
+## Maximum time (seconds) a request waits for an identical one before computing its own response
+WAIT_TIMEOUT = getattr(settings, 'MAGE_COALESCING_WAIT_TIMEOUT', 60)
+## Time (seconds) a result stays available to requests of other processes which waited for it
+RESULT_TIMEOUT = getattr(settings, 'MAGE_COALESCING_RESULT_TIMEOUT', 5)
+## Maximum size (bytes) of a shared response. Bigger responses are streamed without being kept, and waiting requests
+## compute their own.
+MAX_SIZE = getattr(settings, 'MAGE_COALESCING_MAX_SIZE', 1024 * 1024)
+POLL_INTERVAL = 0.05
+
+
+class _Flight(object):
+    def __init__(self, key):
+        self.key = key
+        self.id = None
+        self.lock_key = None
+        self.done = Event()
+        self.result = None
+
+    def end(self, result):
+        """Gives the result of the computation (None if it failed) to everyone waiting for it"""
+        if self.lock_key:
+            if result is not None:
+                cache.set('coalescing_result_%s' % self.id, result, RESULT_TIMEOUT)
+            cache.delete(self.lock_key)
+            self.lock_key = None
+        self.result = result
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        self.done.set()
+
+
+## Computations running inside this process
+_flights = {}
+_flights_lock = Lock()
+
+
+def __begin(key, timeout):
+    """
+        Returns (result, None) when an identical computation gave its result, (None, flight) when the caller must compute
+        the result and then give it to flight.end(result), or (None, None) when the caller must compute alone (the
+        computation it waited for failed or was too long).
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight(key)
+
+    if not leader:
+        if flight.done.wait(timeout) and flight.result is not None:
+            return flight.result, None
+        return None, None
+
+    ## Other processes
+    lock_key = 'coalescing_lock_%s' % key
+    flight_id = uuid4().hex
+    if cache.add(lock_key, flight_id, timeout):
+        flight.lock_key = lock_key
+        flight.id = flight_id
+        return None, flight
+
+    deadline = time.time() + timeout
+    result = None
+    while time.time() < deadline:
+        flight_id = cache.get(lock_key)
+        if flight_id is None:
+            break
+        result = cache.get('coalescing_result_%s' % flight_id)
+        if result is not None:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    ## Threads of this process waiting for this call are given the same result - or compute alone.
+    flight.end(result)
+    return result, None
+
+
+def single_flight(key, compute, timeout=WAIT_TIMEOUT):
+    """
+        Returns compute(), computed only once for all the concurrent calls with the same key (in all threads and, with a
+        shared cache backend, in all processes). The result must be picklable. If the computation fails or takes more
+        than timeout seconds, waiting calls compute the result themselves.
+    """
+    result, flight = __begin(key, timeout)
+    if result is not None:
+        return result
+    if flight is None:
+        return compute()
+
+    result = None
+    try:
+        result = compute()
+        return result
+    finally:
+        flight.end(result)
+
+
+def coalesce_requests(view):
+    """
+        View decorator coalescing identical concurrent requests (same user, method, URL and body). The first request is
+        answered as usual (streamed responses are still streamed) while the others wait for its full content - if it is
+        smaller than MAX_SIZE.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = md5()
+        for part in (request.method, str(request.user.pk), request.get_full_path()):
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        key.update(request.body)
+
+        result, flight = __begin(key.hexdigest(), WAIT_TIMEOUT)
+        if result is not None:
+            status, headers, content = result
+            response = HttpResponse(content, status=status)
+            for header, value in headers:
+                response[header] = value
+            return response
+        if flight is None:
+            return view(request, *args, **kwargs)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except:
+            flight.end(None)
+            raise
+        if not response.streaming:
+            flight.end((response.status_code, list(response.items()), response.content) if len(response.content) <= MAX_SIZE else None)
+            return response
+        response.streaming_content = _Tee(response, flight)
+        return response
+    return wrapper
+
+
+class _Tee(object):
+    """Streamed content, also given to the waiting requests once complete (and only kept while it is small enough)"""
+
+    def __init__(self, response, flight):
+        self.response = response
+        self.content = response.streaming_content
+        self.flight = flight
+        self.headers = list(response.items())
+
+    def __iter__(self):
+        chunks = []
+        size = 0
+        for chunk in self.content:
+            if chunks is not None:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > MAX_SIZE:
+                    ## Too big to be shared: waiting requests compute their own response
+                    chunks = None
+                    self.flight.end(None)
+            yield chunk
+        if chunks is not None:
+            self.flight.end((self.response.status_code, self.headers, b''.join(chunks)))
+
+    def close(self):
+        ## Called by Django at the end of the response - an incomplete response is not shared
+        if not self.flight.done.is_set():
+            self.flight.end(None)
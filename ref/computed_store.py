@@ -0,0 +1,239 @@
+# coding: utf-8
+'''
+    Materialized computed fields.
+
+    Computed field values are stored inside ComponentInstanceComputedValue the first time they are read, and kept up to
+    date by the signal handlers of ref.cache: each change of a field value or of a relationship only recomputes the
+    (instance, computed field) pairs which actually depend on it.
+
+    Dependencies are derived from the navigations of the patterns. As relationship names are unique per description,
+    each navigation can be statically resolved into a chain of relationship descriptions ending with a field
+    description. Self description patterns are indexed the same way, but their values stay in the Django cache (see the cache
+    generations in ref.naming_language).
+
+    @license: Apache License, Version 2.0
+'''
+
+## Python imports
+import json
+import operator
+from functools import reduce
+from threading import Lock
+
+## Django imports
+from django.db.models import Q
+
+## MAGE imports
+from ref import naming_language
+from ref.models import ComponentInstance, ComponentInstanceRelation, ComponentInstanceComputedValue, \
+    ImplementationDescription, ImplementationComputedFieldDescription
+
+
+################################################################################
+## Dependency index
+################################################################################
+
+class DependencyIndex(object):
+    """
+        by_field: {field description id: [(owner, relation description ids of the navigation)]}
+        by_relation: {relation description id: [(owner, relation description ids before this relation)]}
+        Owners are either computed field descriptions or implementation descriptions (for self descriptions).
+    """
+
+    def __init__(self):
+        self.by_field = {}
+        self.by_relation = {}
+
+        descriptions = dict((d.pk, d) for d in ImplementationDescription.objects.prefetch_related('field_set', 'target_set', 'computed_field_set'))
+        for descr in descriptions.values():
+            self.__add(descr, descr.self_description_pattern, descriptions)
+            for cf in descr.computed_field_set.all():
+                self.__add(cf, cf.pattern, descriptions)
+
+    def __add(self, owner, pattern, descriptions):
+        try:
+            navigations = naming_language.compile_pattern(pattern).navigations
+        except Exception:
+            ## Invalid patterns cannot be evaluated, so they have no dependencies.
+            return
+        root = owner if isinstance(owner, ImplementationDescription) else descriptions[owner.description_id]
+
+        for path in navigations:
+            descr = root
+            relations = []
+            for segment in path[:-1]:
+                rel = next((r for r in descr.target_set.all() if r.name == segment), None)
+                if rel is None:
+                    break
+                self.by_relation.setdefault(rel.pk, []).append((owner, tuple(relations)))
+                relations.append(rel.pk)
+                descr = descriptions[rel.target_id]
+            else:
+                field = next((f for f in descr.field_set.all() if f.name == path[-1]), None)
+                if field is not None:
+                    self.by_field.setdefault(field.pk, []).append((owner, tuple(relations)))
+
+
+## The index is built by each process, and rebuilt when the shared 'dependency_index' cache generation changes: a
+## description changed in a process is seen by all the others.
+__index = None
+__index_generation = None
+__index_lock = Lock()
+
+def dependency_index():
+    global __index, __index_generation
+    generation = naming_language.generations(['dependency_index'])['dependency_index']
+    with __index_lock:
+        if __index is None or __index_generation != generation:
+            __index = DependencyIndex()
+            __index_generation = generation
+        return __index
+
+def reset_dependency_index():
+    global __index
+    naming_language.bump_generations(['dependency_index'])
+    with __index_lock:
+        __index = None
+
+
+################################################################################
+## Refresh
+################################################################################
+
+def __roots(instance_ids, relations):
+    """Ids of the instances reaching the given instances through the given chain of relationship descriptions"""
+    ids = set(instance_ids)
+    for rel_id in reversed(relations):
+        if not ids:
+            break
+        ids = set(ComponentInstanceRelation.objects.filter(field_id=rel_id, target_id__in=ids).values_list('source_id', flat=True))
+    return ids
+
+def __affected(dependencies, instance_ids, res=None):
+    res = {} if res is None else res
+    for owner, relations in dependencies:
+        res.setdefault(owner, set()).update(__roots(instance_ids, relations))
+    return res
+
+def affected_by_field(field_id, instance_id):
+    """{owner: set of instance ids} of the computed values depending on the given field of the given instance"""
+    return __affected(dependency_index().by_field.get(field_id, ()), (instance_id,))
+
+def __affected_many(dependencies, pairs):
+    ids = {}
+    for field_id, instance_id in pairs:
+        ids.setdefault(field_id, set()).add(instance_id)
+    res = {}
+    for field_id, instance_ids in ids.items():
+        __affected(dependencies.get(field_id, ()), instance_ids, res)
+    return res
+
+def affected_by_fields(field_values):
+    """Same as affected_by_field for many (field id, instance id) pairs at once (e.g. after a bulk operation)"""
+    return __affected_many(dependency_index().by_field, field_values)
+
+def affected_by_relation(field_id, source_id):
+    """{owner: set of instance ids} of the computed values depending on the given relationship of the given instance"""
+    return __affected(dependency_index().by_relation.get(field_id, ()), (source_id,))
+
+def affected_by_relations(relations):
+    """Same as affected_by_relation for many (field id, source id) pairs at once (e.g. after a bulk operation)"""
+    return __affected_many(dependency_index().by_relation, relations)
+
+def refresh(affected):
+    """Recomputes the materialized values (and invalidates the cached self descriptions) of the given {owner: instance ids}"""
+    for owner, ids in affected.items():
+        if not ids:
+            continue
+        if isinstance(owner, ImplementationDescription):
+            naming_language.bump_generations(['ci_%s' % pk for pk in ids])
+            continue
+
+        ## Only values already materialized are refreshed - others will be computed on first read.
+        stored = list(ComponentInstanceComputedValue.objects.filter(field_id=owner.pk, instance_id__in=ids))
+        if not stored:
+            continue
+        values = naming_language.resolve_many(owner.pattern, [s.instance_id for s in stored])
+        for s in stored:
+            s.value = json.dumps(values[s.instance_id])
+        ComponentInstanceComputedValue.objects.bulk_update(stored, ['value'])
+
+
+################################################################################
+## Read
+################################################################################
+
+def get_values(computed_field, instances):
+    """Values of a computed field for the given instances (or proxies, or ids) as a dict {instance id: value}"""
+    return get_many_values({computed_field: instances})[computed_field]
+
+def get_many_values(instances_by_field):
+    """
+        Same as get_values for many computed fields at once: takes {computed field: instances} and returns
+        {computed field: {instance id: value}}. Stored values of all the fields are read together, and the missing ones
+        are computed together: the navigations of all the patterns are loaded in a single pass.
+    """
+    ids = {}
+    for computed_field, instances in instances_by_field.items():
+        ids[computed_field] = field_ids = []
+        for instance in instances:
+            try:
+                instance = instance._instance
+            except AttributeError:
+                pass
+            field_ids.append(instance.pk if isinstance(instance, ComponentInstance) else instance)
+
+    res = dict((computed_field, {}) for computed_field in ids)
+    fields = dict((computed_field.pk, computed_field) for computed_field in ids)
+    all_ids = list(set(pk for field_ids in ids.values() for pk in field_ids))
+    for i in range(0, len(all_ids), 500):
+        rows = ComponentInstanceComputedValue.objects.filter(field_id__in=fields.keys(), instance_id__in=all_ids[i:i + 500]).values_list('field_id', 'instance_id', 'value')
+        for field_id, instance_id, value in rows:
+            res[fields[field_id]][instance_id] = json.loads(value)
+
+    missing = dict((computed_field, [pk for pk in field_ids if pk not in res[computed_field]]) for computed_field, field_ids in ids.items())
+    missing = dict((computed_field, field_ids) for computed_field, field_ids in missing.items() if field_ids)
+    if missing:
+        patterns = dict((computed_field, naming_language.compile_pattern(computed_field.pattern)) for computed_field in missing)
+        contexts = naming_language.preload_navigations(set(path for f in patterns.values() for path in f.navigations),
+                                                       set(pk for field_ids in missing.values() for pk in field_ids))
+        created = []
+        for computed_field, field_ids in missing.items():
+            for pk in field_ids:
+                value = res[computed_field][pk] = patterns[computed_field](contexts[pk])
+                created.append(ComponentInstanceComputedValue(instance_id=pk, field_id=computed_field.pk, value=json.dumps(value)))
+        ComponentInstanceComputedValue.objects.bulk_create(created, ignore_conflicts=True)
+    return res
+
+def get_value(computed_field, instance):
+    return next(iter(get_values(computed_field, (instance,)).values()))
+
+def purge(computed_field):
+    """Removes all the materialized values of a computed field (e.g. when its pattern changes)"""
+    ComponentInstanceComputedValue.objects.filter(field_id=computed_field.pk).delete()
+
+def purge_depending_on(names):
+    """
+        Removes the materialized values (and invalidates the cached self descriptions) of all the patterns navigating
+        through a field or a relationship with one of the given names. Used when field or relationship descriptions are
+        created, renamed or deleted: the dependency index only knows the descriptions as they are now, so the patterns
+        are matched on names.
+    """
+    names = set(name for name in names if name)
+    if not names:
+        return
+    def depends(pattern):
+        try:
+            navigations = naming_language.compile_pattern(pattern).navigations
+        except Exception:
+            return False
+        return any(names.intersection(path) for path in navigations)
+
+    ## Patterns which do not even contain the names are not compiled
+    contains = reduce(operator.or_, (Q(pattern__contains=name) for name in names))
+    field_ids = [pk for pk, pattern in ImplementationComputedFieldDescription.objects.filter(contains).values_list('id', 'pattern') if depends(pattern)]
+    if field_ids:
+        ComponentInstanceComputedValue.objects.filter(field_id__in=field_ids).delete()
+    contains = reduce(operator.or_, (Q(self_description_pattern__contains=name) for name in names))
+    descr_ids = [pk for pk, pattern in ImplementationDescription.objects.filter(contains).values_list('id', 'self_description_pattern') if depends(pattern)]
+    naming_language.bump_generations(['id_%s' % pk for pk in descr_ids])
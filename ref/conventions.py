@@ -6,15 +6,18 @@
 '''
 
 ## Django imports
+from django.conf import settings
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 
 ## MAGE imports
 from MAGE.exceptions import MageError
-from ref.models import ConventionCounter, Environment, ComponentInstanceField, Project, ImplementationFieldDescription
+from ref.models import ConventionCounter, ComponentInstance, ComponentInstanceField
 import re
-from django.dispatch.dispatcher import receiver
-from django.db.models.signals import pre_save
-from ref.naming_language import resolve
+from ref.naming_language import resolve_many, bump_generations
+from ref.computed_store import affected_by_fields, refresh
+from ref import value_index
+from ref.parse_cache import ParseCache
 
 # Public regex
 re_counter_tyev = re.compile("(%cem(~)?(\d+)?)%")
@@ -26,167 +29,168 @@ re_counter_item = re.compile(r"(%ci(~)?(\d+)?([\w_\.]+)%)")
 re_navigation = re.compile(r"(%n([\w_\.]+)%)")
 re_maths = re.compile(r'^[\d\+\-\*\/\(\)]+$')
 
-def __value_pattern_field(instance, pattern, envt=None, counter_simulation=False):
+## Pattern tokens
+def __build_simple_tokens():
     """
-        @param instance: the component instance. It is not modified here, but used as a reference for environment, cic, ...
-        @param pattern: the pattern to value
-        @param envt: offers the possibility to overload the environment, or to select a single environment if the instance is inside multiple ones.
-        @param counter_simulation: if True, no counters will be ever incremented in the database - but their incremented value will still be used.
+        {token name: (object, attribute, case)}. Objects without the attribute give "noname", missing objects give their
+        own default name - both in the case of the token (cic & lc references are taken as is, but for defaults).
     """
-    res = pattern
-
-    ## Environment
-    if instance.environments.count() > 0 or envt is not None:
-        if envt is None:
-            envt = instance.environments.all()[0]
-        elif isinstance(envt, unicode):
-            envt = Environment.objects.get(name=envt)
-        res = res.replace("%e%", envt.name.lower())
-        res = res.replace("%E%", envt.name.upper())
-        res = res.replace("%E~%", envt.name.capitalize())
-    else:
-        res = res.replace("%e%", "noenvironment")
-        res = res.replace("%E%", "NOENVIRONMENT")
-        res = res.replace("%E~%", "NoEnvironment")
-
-    ## Application
-    if instance.instanciates is not None:
-        trg = instance.instanciates.implements.application
-        res = res.replace("%a1%", trg.alternate_name_1.lower() if trg.alternate_name_1 else 'noname')
-        res = res.replace("%A1%", trg.alternate_name_1.upper() if trg.alternate_name_1 else 'NONAME')
-        res = res.replace("%A1~%", trg.alternate_name_1.capitalize() if trg.alternate_name_1 else 'NoName')
-        res = res.replace("%a2%", trg.alternate_name_2.lower() if trg.alternate_name_2 else 'noname')
-        res = res.replace("%A2%", trg.alternate_name_2.upper() if trg.alternate_name_2 else 'NONAME')
-        res = res.replace("%A2~%", trg.alternate_name_2.capitalize() if trg.alternate_name_2 else 'NoName')
-        res = res.replace("%a3%", trg.alternate_name_3.lower() if trg.alternate_name_3 else 'noname')
-        res = res.replace("%A3%", trg.alternate_name_3.upper() if trg.alternate_name_3 else 'NONAME')
-        res = res.replace("%A3~%", trg.alternate_name_3.capitalize() if trg.alternate_name_3 else 'NoName')
-        res = res.replace("%a%", trg.name.lower())
-        res = res.replace("%A%", trg.name.upper())
-        res = res.replace("%A~%", trg.name.capitalize())
-    else:
-        res = res.replace("%a1%", "noapplication")
-        res = res.replace("%A1%", "NOAPPLICATION")
-        res = res.replace("%A1~%", "NoApplication")
-        res = res.replace("%a2%", "noapplication")
-        res = res.replace("%A2%", "NOAPPLICATION")
-        res = res.replace("%A2~%", "NoApplication")
-        res = res.replace("%a3%", "noapplication")
-        res = res.replace("%A3%", "NOAPPLICATION")
-        res = res.replace("%A3~%", "NoApplication")
-        res = res.replace("%a%", "noapplication")
-        res = res.replace("%A%", "NOAPPLICATION")
-        res = res.replace("%A~%", "NoApplication")
-
-    ## Project
-    if (instance.instanciates is not None and instance.instanciates.implements.application.project is not None) or (instance.environments.filter(project__isnull=False).count() > 0):
-        if instance.instanciates is not None and instance.instanciates.implements.application.project is not None:
-            trg = instance.instanciates.implements.application.project
+    res = {}
+    for prefix, obj in (('e', 'envt'), ('a', 'application'), ('p', 'project')):
+        res[prefix] = (obj, 'name', 'lower')
+        res[prefix.upper()] = (obj, 'name', 'upper')
+        res[prefix.upper() + '~'] = (obj, 'name', 'capitalize')
+        if obj != 'envt':
+            for i in '123':
+                res[prefix + i] = (obj, 'alternate_name_' + i, 'lower')
+                res[prefix.upper() + i] = (obj, 'alternate_name_' + i, 'upper')
+                res[prefix.upper() + i + '~'] = (obj, 'alternate_name_' + i, 'capitalize')
+    for prefix, obj in (('ic', 'cic'), ('lc', 'lc')):
+        for i in '123':
+            res[prefix + i] = (obj, 'ref' + i, None)
+            res[prefix.upper() + i] = (obj, 'ref' + i, 'upper')
+            res[prefix.upper() + i + '~'] = (obj, 'ref' + i, 'capitalize')
+    return res
+
+__simple_tokens = __build_simple_tokens()
+__missing_objects = {'envt': 'NoEnvironment', 'application': 'NoApplication', 'project': 'NoProject', 'cic': 'NoCic', 'lc': 'NoLc'}
+
+re_token = re.compile(r"%%(?:(?P<counter>cem|cm|ce|cp|cg)(?P<no_increment>~)?(?P<padding>\d+)?|(?P<name>d|%s))%%"
+                      % '|'.join(re.escape(name) for name in sorted(__simple_tokens, key=len, reverse=True)))
+
+def __compile(pattern):
+    """
+        Splits a pattern once and for all into a tuple of texts and tokens: ('name', token name) or
+        ('counter', scope, increment, padding).
+    """
+    res = []
+    position = 0
+    for match in re_token.finditer(pattern):
+        if match.start() > position:
+            res.append(pattern[position:match.start()])
+        if match.group('counter'):
+            res.append(('counter', match.group('counter'), match.group('no_increment') is None, match.group('padding')))
         else:
-            trg = instance.environments.filter(project__isnull=False).all()[0].project
-        res = res.replace("%p1%", trg.alternate_name_1.lower() if trg.alternate_name_1 else 'noname')
-        res = res.replace("%P1%", trg.alternate_name_1.upper() if trg.alternate_name_1 else 'NONAME')
-        res = res.replace("%P1~%", trg.alternate_name_1.capitalize() if trg.alternate_name_1 else 'NoName')
-        res = res.replace("%p2%", trg.alternate_name_2.lower() if trg.alternate_name_2 else 'noname')
-        res = res.replace("%P2%", trg.alternate_name_2.upper() if trg.alternate_name_2 else 'NONAME')
-        res = res.replace("%P2~%", trg.alternate_name_2.capitalize() if trg.alternate_name_2 else 'NoName')
-        res = res.replace("%p3%", trg.alternate_name_3.lower() if trg.alternate_name_3 else 'noname')
-        res = res.replace("%P3%", trg.alternate_name_3.upper() if trg.alternate_name_3 else 'NONAME')
-        res = res.replace("%P3~%", trg.alternate_name_3.capitalize() if trg.alternate_name_3 else 'NoName')
-        res = res.replace("%p%", trg.name.lower())
-        res = res.replace("%P%", trg.name.upper())
-        res = res.replace("%P~%", trg.name.capitalize())
-    else:
-        res = res.replace("%p1%", "noproject")
-        res = res.replace("%P1%", "NOPROJECT")
-        res = res.replace("%P1~%", "NoProject")
-        res = res.replace("%p2%", "noproject")
-        res = res.replace("%P2%", "NOPROJECT")
-        res = res.replace("%P2~%", "NoProject")
-        res = res.replace("%p3%", "noproject")
-        res = res.replace("%P3%", "NOPROJECT")
-        res = res.replace("%P3~%", "NoProject")
-        res = res.replace("%p%", "noproject")
-        res = res.replace("%P%", "NOPROJECT")
-
-    ## CIC
-    if instance.instanciates is not None:
-        cic = instance.instanciates
-        res = res.replace("%ic1%", cic.ref1 or 'noname')
-        res = res.replace("%ic2%", cic.ref2 or 'noname')
-        res = res.replace("%ic3%", cic.ref3 or 'noname')
-        res = res.replace("%IC1%", cic.ref1.upper() if cic.ref1 else 'NONAME')
-        res = res.replace("%IC2%", cic.ref2.upper() if cic.ref2 else 'NONAME')
-        res = res.replace("%IC3%", cic.ref3.upper() if cic.ref3 else 'NONAME')
-        res = res.replace("%IC1~%", cic.ref1.capitalize() if cic.ref1 else 'NoName')
-        res = res.replace("%IC2~%", cic.ref2.capitalize() if cic.ref2 else 'NoName')
-        res = res.replace("%IC3~%", cic.ref3.capitalize() if cic.ref3 else 'NoName')
-    else:
-        res = res.replace("%ic1%", "nocic")
-        res = res.replace("%ic2%", "nocic")
-        res = res.replace("%ic3%", "nocic")
-        res = res.replace("%IC1%", "NOCIC")
-        res = res.replace("%IC2%", "NOCIC")
-        res = res.replace("%IC3%", "NOCIC")
-        res = res.replace("%IC1~%", "NoCic")
-        res = res.replace("%IC2~%", "NoCic")
-        res = res.replace("%IC3~%", "NoCic")
-
-    ## LC
-    if instance.instanciates is not None and instance.instanciates.implements is not None:
-        lc = instance.instanciates.implements
-        res = res.replace("%lc1%", lc.ref1 or 'noname')
-        res = res.replace("%lc2%", lc.ref2 or 'noname')
-        res = res.replace("%lc3%", lc.ref3 or 'noname')
-        res = res.replace("%LC1%", lc.ref1.upper() if lc.ref1 else 'NONAME')
-        res = res.replace("%LC2%", lc.ref2.upper() if lc.ref2 else 'NONAME')
-        res = res.replace("%LC3%", lc.ref3.upper() if lc.ref3 else 'NONAME')
-        res = res.replace("%LC1~%", lc.ref1.capitalize() if lc.ref1 else 'NoName')
-        res = res.replace("%LC2~%", lc.ref2.capitalize() if lc.ref2 else 'NoName')
-        res = res.replace("%LC3~%", lc.ref3.capitalize() if lc.ref3 else 'NoName')
-    else:
-        res = res.replace("%lc1%", "nolc")
-        res = res.replace("%lc2%", "nolc")
-        res = res.replace("%lc3%", "nolc")
-        res = res.replace("%LC1%", "NOLC")
-        res = res.replace("%LC2%", "NOLC")
-        res = res.replace("%LC3%", "NOLC")
-        res = res.replace("%LC1~%", "NoLc")
-        res = res.replace("%LC2~%", "NoLc")
-        res = res.replace("%LC3~%", "NoLc")
-
-    ## Date (Japanese format)
-    d = now().strftime('%Y%m%d')
-    res = res.replace("%d%", d)
-
-    ## Counter
-    for match in reversed([i for i in re_counter_envt.finditer(res)]):
-        if envt is None:
-            raise MageError('a counter within an environment scope can only be used if the instance is associated to an environment')
-        c = ConventionCounter.objects.get_or_create(scope_project=None, scope_application=None, scope_environment=envt, scope_type=None, scope_instance=None)[0]
-        res = __counter(match, res, c, counter_simulation)
+            res.append(('name', match.group('name')))
+        position = match.end()
+    if position < len(pattern):
+        res.append(pattern[position:])
+    return tuple(res)
 
-    for match in reversed([i for i in re_counter_prjt.finditer(res)]):
-        if envt is None or envt.project is None:
-            raise MageError('a counter within a project scope can only be used if the instance is associated to an environment belonging to a project')
-        c = ConventionCounter.objects.get_or_create(scope_project=envt.project, scope_application=None, scope_environment=None, scope_type=None, scope_instance=None)[0]
-        res = __counter(match, res, c, counter_simulation)
+compiled_patterns = ParseCache(__compile, getattr(settings, 'MAGE_PARSE_CACHE_SIZE', 1000))
 
-    for match in reversed([i for i in re_counter_glob.finditer(res)]):
-        c = ConventionCounter.objects.get_or_create(scope_project=None, scope_application=None, scope_environment=None, scope_type=None, scope_instance=None)[0]
-        res = __counter(match, res, c, counter_simulation)
 
-    for match in reversed([i for i in re_counter_tyev.finditer(res)]):
-        if envt is None:
-            raise MageError('a counter within an environment scope can only be used if the instance is associated to an environment')
-        c = ConventionCounter.objects.get_or_create(scope_project=None, scope_application=None, scope_environment=envt, scope_type=instance.description, scope_instance=None)[0]
-        res = __counter(match, res, c, counter_simulation)
+def __case(value, case):
+    return getattr(value, case)() if case else value
+
+def __default_case(value, case):
+    ## Default names are already capitalized (NoName...)
+    return value if case == 'capitalize' else getattr(value, case or 'lower')()
+
+def __token_value(context, name):
+    if name == 'd':
+        return context.date
+    obj_name, attribute, case = __simple_tokens[name]
+    obj = getattr(context, obj_name)
+    if obj is None:
+        return __default_case(__missing_objects[obj_name], case)
+    value = getattr(obj, attribute)
+    if not value and attribute != 'name':
+        return __default_case('NoName', case)
+    return __case(value, case)
 
-    for match in reversed([i for i in re_counter_type.finditer(res)]):
-        if instance.description_id is None:
+
+class _Context(object):
+    """The objects naming conventions refer to for an instance, each read at most once"""
+    def __init__(self, instance, counters=None):
+        self.instance = instance
+        ## {(environment, project, description): counter}, may be shared by the contexts of many instances
+        self.counters = {} if counters is None else counters
+
+    @cached_property
+    def environments(self):
+        return list(self.instance.environments.all())
+
+    @cached_property
+    def envt(self):
+        return self.environments[0] if self.environments else None
+
+    @cached_property
+    def cic(self):
+        return self.instance.instanciates
+
+    @cached_property
+    def lc(self):
+        return self.cic.implements if self.cic is not None else None
+
+    @cached_property
+    def application(self):
+        return self.lc.application if self.lc is not None else None
+
+    @cached_property
+    def project(self):
+        if self.application is not None and self.application.project is not None:
+            return self.application.project
+        return next((envt.project for envt in self.environments if envt.project_id is not None), None)
+
+    @cached_property
+    def date(self):
+        ## Japanese format
+        return now().strftime('%Y%m%d')
+
+    def counter_scope(self, scope):
+        """(environment, project, description) of the counter of the given scope (as named in the pattern tokens)"""
+        envt, description = self.envt, self.instance.description
+        if scope in ('ce', 'cem') and envt is None:
+            raise MageError('a counter within an environment scope can only be used if the instance is associated to an environment')
+        if scope == 'cp' and (envt is None or envt.project is None):
+            raise MageError('a counter within a project scope can only be used if the instance is associated to an environment belonging to a project')
+        if scope == 'cm' and self.instance.description_id is None:
             raise MageError('a counter within a description scope can only be used if the instance is correctly associated to a description')
-        c = ConventionCounter.objects.get_or_create(scope_project=None, scope_application=None, scope_environment=None, scope_type=instance.description, scope_instance=None)[0]
-        res = __counter(match, res, c, counter_simulation)
+        return (envt if scope in ('ce', 'cem') else None, envt.project if scope == 'cp' else None,
+                description if scope in ('cem', 'cm') else None)
+
+    def counter(self, scope):
+        """The counter of the given scope (as named in the pattern tokens)"""
+        key = self.counter_scope(scope)
+        if key not in self.counters:
+            environment, project, description = key
+            self.counters[key] = ConventionCounter.objects.get_for_scope(environment=environment, project=project, type=description)
+        return self.counters[key]
+
+
+class _ReservedCounter(object):
+    """A block of values reserved beforehand in a counter, handed out one by one as the counter itself would do"""
+    def __init__(self, counter, count):
+        self.val = counter.reserve(count) - 1
+
+    def reserve(self):
+        self.val += 1
+        return self.val
+
+
+def __value_pattern_field(instance, pattern, counter_simulation=False, context=None):
+    """
+        @param instance: the component instance. It is not modified here, but used as a reference for environment, cic, ...
+        @param pattern: the pattern to value
+        @param counter_simulation: if True, no counters will be ever incremented in the database - but their incremented value will still be used.
+        @param context: the _Context of the instance, to share it between the fields of the instance.
+    """
+    if context is None:
+        context = _Context(instance)
+
+    ## A single pass on the compiled pattern - backwards, so that counter values without increment (%cem~%) are the
+    ## values after the increments of the pattern.
+    res = []
+    for part in reversed(compiled_patterns.get(pattern)):
+        if isinstance(part, str):
+            res.append(part)
+        elif part[0] == 'name':
+            res.append(__token_value(context, part[1]))
+        else:
+            kind, scope, increment, padding = part
+            res.append(__counter_value(context.counter(scope), increment, padding, counter_simulation))
+    res = ''.join(reversed(res))
 
     ## Maths?
     if re_maths.search(res):
@@ -198,57 +202,202 @@ def __value_pattern_field(instance, pattern, envt=None, counter_simulation=False
     ## Done
     return res
 
-def __counter(match, res, counter, counter_simulation):
+def __counter_value(counter, increment, padding, counter_simulation):
     # Only advance sequence if tilde is absent
-    val = counter.val
-    if not counter_simulation and match.groups()[1] is None:
-        counter.val = counter.val + 1
-        counter.save()
-    if match.groups()[1] is None:
-        val = val + 1
+    if not increment:
+        val = counter.val
+    elif counter_simulation:
+        val = counter.val + 1
+    else:
+        val = counter.reserve()
 
     # Padding
-    if not match.groups()[2] is None:
-        val = format(val, '0' + match.groups()[2])
+    if padding is not None:
+        val = format(val, '0' + padding)
+    return str(val)
+
+def __counter(match, res, counter, counter_simulation):
+    val = __counter_value(counter, match.groups()[1] is None, match.groups()[2], counter_simulation)
+    return res[0:match.start()] + val + res[match.end():]
+
+def __existing_field_values(instances, fields):
+    """{(instance id, field description id): ComponentInstanceField} of the given instances, in a single query"""
+    return dict(((fv.instance_id, fv.field_id), fv) for fv in ComponentInstanceField.objects.filter(instance__in=instances, field__in=fields))
 
-    return res[0:match.start()] + str(val) + res[match.end():]
+def __set_field_value(instance, field, existing, value, created, updated):
+    """Adds the new or changed ComponentInstanceField to the created or updated list"""
+    if existing is None:
+        created.append(ComponentInstanceField(value=value, field=field, instance=instance))
+    elif existing.value != str(value):
+        existing.value = value
+        updated.append(existing)
+
+def save_field_values(created, updated):
+    """
+        Saves new and changed ComponentInstanceField objects in bulk, then empties both lists. Bulk operations send no
+        signals, so what the signal handlers do for each field value (reversed value, trigrams, MQL cache, materialized
+        computed values) is done here.
+    """
+    if not created and not updated:
+        return
+    for fv in created + updated:
+        fv.reversed_value = str(fv.value)[::-1]
+
+    ComponentInstanceField.objects.bulk_create(created)
+    if created and created[0].pk is None:
+        ## Not all databases give back the primary keys of bulk created rows
+        pks = dict(((instance_id, field_id), pk) for pk, instance_id, field_id in ComponentInstanceField.objects.filter(
+            instance_id__in=set(fv.instance_id for fv in created), field_id__in=set(fv.field_id for fv in created)).values_list('pk', 'instance_id', 'field_id'))
+        for fv in created:
+            fv.pk = pks[(fv.instance_id, fv.field_id)]
+    if updated:
+        ComponentInstanceField.objects.bulk_update(updated, ['value', 'reversed_value'])
+
+    value_index.index(created, created=True)
+    if updated:
+        value_index.index(updated)
+    bump_generations(['mql'])
+    refresh(affected_by_fields((fv.field_id, fv.instance_id) for fv in created + updated))
+
+    del created[:]
+    del updated[:]
+
+def __resolve_all(paths):
+    """{(navigation, instance id): value} for the given {navigation: instances}, one resolve_many per navigation"""
+    res = {}
+    for path, instances in paths.items():
+        for pk, value in resolve_many(path, instances).items():
+            res[(path, pk)] = value
+    return res
+
+def __by_description(instances):
+    """
+        Lists of instances sharing a description, reloaded with everything conventions need (context objects,
+        field descriptions), by chunks of 500 instances.
+    """
+    pks = [getattr(instance, '_instance', instance).pk for instance in instances]
+    for i in range(0, len(pks), 500):
+        chunk = pks[i:i + 500]
+        order = dict((pk, position) for position, pk in enumerate(chunk))
+        loaded = sorted(ComponentInstance.objects.filter(pk__in=chunk).select_related('description', 'instanciates__implements__application__project')
+                        .prefetch_related('environments__project', 'description__field_set'), key=lambda instance: order[instance.pk])
+        groups = {}
+        for instance in loaded:
+            if not instance.description:
+                raise Exception ('cannot value an instance without structure')
+            groups.setdefault(instance.description_id, []).append(instance)
+        for group in groups.values():
+            yield group
+
+def __value_graph_fields(instances, force):
+    """value_instance_graph_fields for instances sharing a description"""
+    fields = [field for field in instances[0].description.field_set.all() if field.default]
+    existing = __existing_field_values(instances, fields)
+    ## {navigation value: counter}
+    counters = {}
+    created, updated = [], []
+
+    ## Field by field, as a navigation may use the fields valued before
+    for field in fields:
+        values = []
+        for instance in instances:
+            fv = existing.get((instance.pk, field.pk))
+            old_val = fv.value if fv is not None else None
+            new_val = old_val or field.default
+            counter_matches = []
+            if fv is None or force or old_val == field.default or re_counter_item.search(old_val):
+                counter_matches = list(re_counter_item.finditer(new_val))
+            values.append([instance, fv, new_val, counter_matches])
+
+        ## Counters
+        paths = {}
+        for instance, fv, new_val, counter_matches in values:
+            for match in counter_matches:
+                paths.setdefault(match.groups()[3], []).append(instance)
+        if paths:
+            save_field_values(created, updated)
+            pivots = __resolve_all(paths)
+            increments = {}
+            for instance, fv, new_val, counter_matches in values:
+                for match in counter_matches:
+                    pivot = pivots[(match.groups()[3], instance.pk)]
+                    if pivot not in counters:
+                        counters[pivot] = ConventionCounter.objects.get_for_scope(type=instance.description, instance=pivot)
+                    if match.groups()[1] is None:
+                        increments[pivot] = increments.get(pivot, 0) + 1
+            reserved = dict(counters)
+            for pivot, count in increments.items():
+                reserved[pivot] = _ReservedCounter(counters[pivot], count)
+            for value in values:
+                instance, new_val = value[0], value[2]
+                for match in reversed(value[3]):
+                    new_val = __counter(match, new_val, reserved[pivots[(match.groups()[3], instance.pk)]], False)
+                value[2] = new_val
+
+        ## Navigations
+        paths = {}
+        navigation_matches = {}
+        for instance, fv, new_val, counter_matches in values:
+            if fv is None or not fv.value or force or re_navigation.search(fv.value):
+                navigation_matches[instance.pk] = list(re_navigation.finditer(new_val))
+                for match in navigation_matches[instance.pk]:
+                    paths.setdefault(match.groups()[1], []).append(instance)
+        if paths:
+            save_field_values(created, updated)
+            resolved = __resolve_all(paths)
+            for value in values:
+                instance, new_val = value[0], value[2]
+                for match in reversed(navigation_matches.get(instance.pk, [])):
+                    new_val = new_val[0:match.start()] + str(resolved[(match.groups()[1], instance.pk)]) + new_val[match.end():]
+                value[2] = new_val
+
+        for instance, fv, new_val, counter_matches in values:
+            ## Maths?
+            if re_maths.search(new_val):
+                try:
+                    new_val = eval(new_val)
+                except:
+                    pass
+            __set_field_value(instance, field, fv, new_val, created, updated)
+
+    save_field_values(created, updated)
+
+def __value_fields(instances, force, counter_simulation=False):
+    """value_instance_fields for instances sharing a description"""
+    fields = [field for field in instances[0].description.field_set.all() if field.default]
+    existing = __existing_field_values(instances, fields)
+    counters = {}
+    todo = []
+    for instance in instances:
+        context = _Context(instance, counters=counters)
+        for field in fields:
+            fv = existing.get((instance.pk, field.pk))
+            if fv is None or force:
+                todo.append((context, field, fv))
+
+    ## Counter values are reserved beforehand, with a single reservation per counter
+    if not counter_simulation:
+        increments = {}
+        for context, field, fv in todo:
+            for part in compiled_patterns.get(field.default):
+                if not isinstance(part, str) and part[0] == 'counter' and part[2]:
+                    context.counter(part[1])
+                    key = context.counter_scope(part[1])
+                    increments[key] = increments.get(key, 0) + 1
+        for key, count in increments.items():
+            counters[key] = _ReservedCounter(counters[key], count)
+
+    created, updated = [], []
+    for context, field, fv in todo:
+        new_val = __value_pattern_field(context.instance, field.default, counter_simulation=counter_simulation, context=context)
+        __set_field_value(context.instance, field, fv, new_val, created, updated)
+    save_field_values(created, updated)
 
 def value_instance_graph_fields(instance, force=False):
     """Only values fields depending on another instance. Should be called once the instance relations are set"""
     if not instance.description:
         raise Exception ('cannot value an instance without structure')
-    impl = instance.description
-
-    for field in impl.field_set.all():
-        if not field.default:
-            continue
-        existing = ComponentInstanceField.objects.get_or_none(instance_id=instance.id, field_id=field.id)
-        new_val = existing.value or field.default
-
-        if field.default and (existing is None or force or existing.value == field.default or re_counter_item.search(existing.value)):
-            for match in reversed([i for i in re_counter_item.finditer(new_val)]):
-                scope_pivot = resolve(match.groups()[3], instance)
-                c = ConventionCounter.objects.get_or_create(scope_project=None, scope_application=None, scope_environment=None, scope_type=instance.description, scope_instance=scope_pivot)[0]
-                new_val = __counter(match, new_val, c, False)
-
-        if field.default and (existing is None or not existing.value or force or re_navigation.search(existing.value)):
-            for match in reversed([i for i in re_navigation.finditer(new_val)]):
-                scope_pivot = resolve(match.groups()[1], instance)
-                new_val = new_val[0:match.start()] + str(scope_pivot) + new_val[match.end():]
-
-        ## Maths?
-        if re_maths.search(new_val):
-            try:
-                new_val = eval(new_val)
-            except:
-                pass
-
-        if not existing is None:
-            existing.value = new_val
-            existing.save()
-        else:
-            n = ComponentInstanceField(value=new_val, field=field, instance=instance)
-            n.save()
+    __value_graph_fields([instance], force)
 
 def value_instance_fields(instance, force=False, create_missing_links=True, counter_simulation=False):
     """
@@ -258,20 +407,19 @@ def value_instance_fields(instance, force=False, create_missing_links=True, coun
         @param force: overwrite a field with a non-None computed value even if the field is not None.
         @param create_missing_links: ? - future use
     """
-
     if not instance.description:
         raise Exception ('cannot value an instance without structure')
-    impl = instance.description
+    __value_fields([instance], force, counter_simulation)
 
-    for field in impl.field_set.all():
-        existing = ComponentInstanceField.objects.get_or_none(instance_id=instance.id, field_id=field.id)
-        if field.default and (existing is None or force):
-            new_val = __value_pattern_field(instance, field.default, counter_simulation=counter_simulation)
-        else:
-            continue
-        if not existing is None:
-            existing.value = new_val
-            existing.save()
-        else:
-            n = ComponentInstanceField(value=new_val, field=field, instance=instance)
-            n.save()
+def value_instances_fields_bulk(instances, force=False):
+    """
+        Same as value_instance_fields for many instances (e.g. a whole environment), with a constant number of queries
+        per description (and per 500 instances).
+    """
+    for group in __by_description(instances):
+        __value_fields(group, force)
+
+def value_instances_graph_fields_bulk(instances, force=False):
+    """Same as value_instance_graph_fields for many instances, with a constant number of queries per description"""
+    for group in __by_description(instances):
+        __value_graph_fields(group, force)
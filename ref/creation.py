@@ -8,7 +8,7 @@
 from ref.models import Environment, ComponentInstance, ExtendedParameter, \
     EnvironmentType
 from ref.models.instances import ComponentInstanceField, ComponentInstanceRelation
-from ref.conventions import value_instance_fields, value_instance_graph_fields
+from ref.conventions import value_instances_fields_bulk, value_instances_graph_fields_bulk
 
 
 def duplicate_envt(envt_name, new_name, remaps={}, *components_to_duplicate):
@@ -26,6 +26,7 @@ def duplicate_envt(envt_name, new_name, remaps={}, *components_to_duplicate):
     components_to_duplicate = sorted(list(components_to_duplicate), key=lambda compo : compo.pk)
     internal_pks = [i.pk for i in components_to_duplicate]
     already_migrated = {} # key = old PK, value = new instance
+    new_instances = []
 
     ## Duplicate the envt
     envt.id = None
@@ -54,6 +55,7 @@ def duplicate_envt(envt_name, new_name, remaps={}, *components_to_duplicate):
         new_instance.save()
         new_instance.environments.add(envt)
         already_migrated[old.pk] = new_instance
+        new_instances.append(new_instance)
 
         for fv in old.field_set.all():
             new_instance.field_set.add(ComponentInstanceField(value=fv.value, field=fv.field), bulk=False)
@@ -94,18 +96,8 @@ def duplicate_envt(envt_name, new_name, remaps={}, *components_to_duplicate):
             p = ExtendedParameter(key=prm.key, value=prm.value, instance=new_instance)
             p.save()
 
-
-        ###############################
-        ## Convention
-        if new_instance is not None:
-            value_instance_fields(new_instance, force=True)
-
-
-        ###############################
-        new_instance.save()
-
-    ## Apply second step of conventions to instances
-    for instance in envt.component_instances.all():
-        value_instance_graph_fields(instance)
+    ## Conventions, for all the new instances at once
+    value_instances_fields_bulk(new_instances, force=True)
+    value_instances_graph_fields_bulk(envt.component_instances.all())
 
     return envt
@@ -12,4 +12,7 @@ class MageMclAttributeNameError(MageCallerError):
     pass
 
 class MageMclSyntaxError(MageCallerError):
-    pass
\ No newline at end of file
+    pass
+
+class MageNamingLanguageSyntaxError(MageCallerError):
+    pass
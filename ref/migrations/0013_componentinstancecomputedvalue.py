@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 01:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ref', '0012_auto_20221212_1608'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComponentInstanceComputedValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.TextField(null=True, verbose_name='valeur (JSON)')),
+                ('field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='value_set', to='ref.implementationcomputedfielddescription', verbose_name='champ calculé')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='computed_value_set', to='ref.componentinstance', verbose_name='instance de composant')),
+            ],
+            options={
+                'verbose_name': 'valeur de champ calculé',
+                'verbose_name_plural': 'valeurs des champs calculés',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='componentinstancecomputedvalue',
+            constraint=models.UniqueConstraint(fields=('instance', 'field'), name='computed_value_uniqueness'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-18 02:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 500
+
+def forward(apps, schema_editor):
+    ComponentInstanceField = apps.get_model('ref', 'ComponentInstanceField')
+    ComponentInstanceFieldTrigram = apps.get_model('ref', 'ComponentInstanceFieldTrigram')
+
+    ## Done by fixed size batches, so that memory does not grow with the number of field values
+    batch = []
+    for fv in ComponentInstanceField.objects.only('id', 'value').iterator(chunk_size=BATCH_SIZE):
+        batch.append(fv)
+        if len(batch) == BATCH_SIZE:
+            index_batch(ComponentInstanceField, ComponentInstanceFieldTrigram, batch)
+            batch = []
+    index_batch(ComponentInstanceField, ComponentInstanceFieldTrigram, batch)
+
+def index_batch(ComponentInstanceField, ComponentInstanceFieldTrigram, field_values):
+    for fv in field_values:
+        fv.reversed_value = fv.value[::-1]
+    ComponentInstanceField.objects.bulk_update(field_values, ['reversed_value'])
+
+    trigrams = []
+    for fv in field_values:
+        value = fv.value.lower()
+        trigrams += [ComponentInstanceFieldTrigram(field_value=fv, trigram=trigram) for trigram in set(value[i:i + 3] for i in range(len(value) - 2))]
+    ComponentInstanceFieldTrigram.objects.bulk_create(trigrams, batch_size=BATCH_SIZE)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ref', '0013_componentinstancecomputedvalue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='componentinstancefield',
+            name='reversed_value',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=512, verbose_name='valeur inversée'),
+        ),
+        migrations.CreateModel(
+            name='ComponentInstanceFieldTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('field_value', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigram_set', to='ref.componentinstancefield')),
+            ],
+            options={
+                'verbose_name': 'trigramme de valeur de champ',
+                'verbose_name_plural': 'trigrammes des valeurs des champs',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='componentinstancefieldtrigram',
+            index=models.Index(fields=['trigram', 'field_value'], name='field_value_trigram'),
+        ),
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 03:05
+
+from django.db import migrations, models
+
+def forward(apps, schema_editor):
+    ## Counters of the same scope may have been created twice: only the most advanced one is kept
+    ConventionCounter = apps.get_model('ref', 'ConventionCounter')
+    kept = {}
+    for counter in ConventionCounter.objects.order_by('-val', 'id'):
+        key = 'e%s_p%s_a%s_t%s_i%s' % tuple('' if item is None else item for item in (counter.scope_environment_id, counter.scope_project_id,
+                                                                                      counter.scope_application_id, counter.scope_type_id, counter.scope_instance))
+        if key in kept:
+            counter.delete()
+            continue
+        kept[key] = counter
+        counter.scope_key = key
+        counter.save()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ref', '0014_field_value_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conventioncounter',
+            name='scope_key',
+            field=models.CharField(editable=False, max_length=100, null=True),
+        ),
+        migrations.RunPython(forward, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='conventioncounter',
+            name='scope_key',
+            field=models.CharField(editable=False, max_length=100, unique=True),
+        ),
+    ]
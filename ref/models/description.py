@@ -1,8 +1,14 @@
 # coding: utf-8
 """ models describing the structure of component instances """
 
+## Python imports
+from contextlib import contextmanager
+
 ## Django imports
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import F
+from django.db.models.signals import pre_save
+from django.dispatch.dispatcher import receiver
 
 ## MAGE imports
 from ref import naming_language
@@ -13,18 +19,47 @@ from ref.models import ComponentInstanceRelation, ComponentInstance, ComponentIm
 ## Naming norms
 ################################################################################
 
+def counter_scope_key(environment=None, project=None, application=None, type=None, instance=None):
+    """ A single non null value for a counter scope (objects or ids), so that the scope can be unique - NULL values are never equal in SQL. """
+    return 'e%s_p%s_a%s_t%s_i%s' % tuple('' if item is None else getattr(item, 'pk', item) for item in (environment, project, application, type, instance))
+
+class ConventionCounterManager(models.Manager):
+    def get_for_scope(self, environment=None, project=None, application=None, type=None, instance=None):
+        """ The counter of the given scope, created if needed. Concurrent calls always return the same counter. """
+        return self.get_or_create(scope_key=counter_scope_key(environment, project, application, type, instance),
+                                  defaults={'scope_environment': environment, 'scope_project': project, 'scope_application': application,
+                                            'scope_type': type, 'scope_instance': instance})[0]
+
 class ConventionCounter(models.Model):
     scope_environment = models.ForeignKey(Environment, blank=True, null=True, default=None, on_delete=models.CASCADE)
     scope_project = models.ForeignKey('Project', blank=True, null=True, default=None, on_delete=models.CASCADE)
     scope_application = models.ForeignKey('Application', blank=True, null=True, default=None, on_delete=models.CASCADE)
     scope_type = models.ForeignKey('ImplementationDescription', blank=True, null=True, default=None, on_delete=models.CASCADE)
     scope_instance = models.IntegerField(blank=True, null=True, default=None)
+    scope_key = models.CharField(max_length=100, unique=True, editable=False)
     val = models.IntegerField(default=0, verbose_name='valeur courante')
 
+    objects = ConventionCounterManager()
+
+    def reserve(self, count=1):
+        """
+            Atomically reserves count consecutive values of the counter (a block, for bulk jobs) with a single update and
+            returns the first one. Afterwards, val is the last reserved value.
+        """
+        with transaction.atomic():
+            ConventionCounter.objects.filter(pk=self.pk).update(val=F('val') + count)
+            self.val = ConventionCounter.objects.filter(pk=self.pk).values_list('val', flat=True).get()
+        return self.val - count + 1
+
     class Meta:
         verbose_name = u'Compteur convention nommage'
         verbose_name_plural = u'Compteurs convention nommage'
 
+@receiver(pre_save, sender=ConventionCounter)
+def set_counter_scope_key(sender, instance, raw, **kwargs):
+    instance.scope_key = counter_scope_key(instance.scope_environment_id, instance.scope_project_id, instance.scope_application_id,
+                                           instance.scope_type_id, instance.scope_instance)
+
 
 ################################################################################
 ## Description classes
@@ -106,7 +141,13 @@ class ImplementationComputedFieldDescription(ImplementationFieldBase):
     objects = ImplementationSimpleFieldDescriptionMaager()
 
     def resolve(self, instance):
-        return naming_language.resolve(self.pattern, instance, self.pk)
+        from ref.computed_store import get_value
+        return get_value(self, instance)
+
+    def resolve_many(self, instances):
+        """Values of the field for many instances at once, as a dict {instance id: value}"""
+        from ref.computed_store import get_values
+        return get_values(self, instances)
 
     class Meta:
         verbose_name = u'champ calculé'
@@ -171,12 +212,12 @@ class ImplementationDescription(models.Model):
             return _classes[self.name]
         except:
             #TODO: datatype!
-            attrs = {'__init__': _proxyinit, 'save': lambda slf: slf._instance.save(), 'get' : lambda slf, attr, x : getattr(slf, attr)}
+            attrs = {'__init__': _proxyinit, 'save': _proxy_save, 'refresh': _proxy_refresh, 'buffered': _proxy_buffered, 'get' : lambda slf, attr, x : getattr(slf, attr)}
 
             ## Standard fields
             for field in self.field_set.all():
                 getter = lambda slf, field_id = field.id: _proxy_simple_accessor(slf, field_id)
-                setter = lambda slf, value, lfield = field: ComponentInstanceField.objects.update_or_create(defaults={'value': value} , field=lfield, instance=slf._instance)
+                setter = lambda slf, value, field_id = field.id: _proxy_simple_setter(slf, field_id, value)
                 attrs[field.name] = property(fget=getter, fset=setter, doc=field.label)
 
             ## Self to others relationships
@@ -187,7 +228,7 @@ class ImplementationDescription(models.Model):
                 else:
                     ## Direct get/set on a field
                     getter = lambda slf, field_id = field.id: _proxy_single_rel_accessor(slf, field_id)
-                    setter = lambda slf, value, field_id = field.id:  ComponentInstanceRelation.objects.update_or_create(defaults={'target': value._instance if not isinstance(value, ComponentInstance) else value}, source=slf._instance, field_id=field_id)
+                    setter = lambda slf, value, field_id = field.id: _proxy_single_rel_setter(slf, field_id, value)
                 attrs[field.name] = property(fget=getter, fset=setter, doc=field.label)
 
             ## Other to self relationships
@@ -204,6 +245,72 @@ class ImplementationDescription(models.Model):
             _classes[self.name] = cls
             return cls
 
+    def bulk_create_instances(self, rows, env=None, cic=None, project=None, conventions=True):
+        """
+            Creates many instances of this description at once. rows: one {field or relationship name: value} per
+            instance, as given to the proxy constructor (a list of targets for relationships with many targets).
+            env and cic are the same for all instances and given as to the proxy constructor. Instances, environments,
+            field values and relationships are inserted in batches, and conventions are applied in bulk to the fields
+            without given values. Returns the proxies of the new instances.
+        """
+        from ref.conventions import save_field_values, value_instances_fields_bulk, value_instances_graph_fields_bulk
+        from ref.computed_store import affected_by_relations, refresh
+
+        rows = list(rows)
+        envts = _environments(env)
+        if isinstance(cic, str):
+            cic = ComponentImplementationClass.objects.get(name=cic)
+        elif cic is None:
+            cics = list(self.cic_set.all()[:2])
+            cic = cics[0] if len(cics) == 1 else None
+        if project is None and envts:
+            project = envts[0].project
+
+        fields = dict((field.name, field) for field in self.field_set.all())
+        relations = dict((rel.name, rel) for rel in self.target_set.all())
+        for row in rows:
+            for name in row:
+                if name not in fields and name not in relations:
+                    raise AttributeError('%s has no field or relationship named %s' % (self.name, name))
+
+        with transaction.atomic():
+            instances = [ComponentInstance(description=self, project=project, instanciates=cic) for row in rows]
+            if connection.features.can_return_rows_from_bulk_insert:
+                ComponentInstance.objects.bulk_create(instances)
+            else:
+                ## Without the primary keys of bulk inserted rows, instances are inserted one by one (all the rest is
+                ## still done in bulk).
+                for instance in instances:
+                    instance.save()
+
+            through = ComponentInstance.environments.through
+            through.objects.bulk_create([through(componentinstance_id=instance.pk, environment_id=envt.pk) for instance in instances for envt in envts])
+
+            field_values = []
+            rels = []
+            for instance, row in zip(instances, rows):
+                for name, value in row.items():
+                    if value is None:
+                        continue
+                    if name in fields:
+                        field_values.append(ComponentInstanceField(instance=instance, field=fields[name], value=value))
+                        continue
+                    for target in (value if isinstance(value, (list, tuple)) else (value,)):
+                        rels.append(ComponentInstanceRelation(source=instance, field=relations[name], target=getattr(target, '_instance', target)))
+            ComponentInstanceRelation.objects.bulk_create(rels)
+            save_field_values(field_values, [])
+
+            ## What the signal handlers of ref.cache would have done for instances, environments and relationships
+            naming_language.bump_generations(['mql'])
+            refresh(affected_by_relations((rel.field_id, rel.source_id) for rel in rels))
+
+            if conventions:
+                value_instances_fields_bulk(instances)
+                value_instances_graph_fields_bulk(instances)
+
+        cls = self.proxy_class()
+        return [cls(base_instance=instance, _noconventions=True) for instance in instances]
+
     @staticmethod
     def class_for_name(name):
         descr = ImplementationDescription.objects.get(name=name)
@@ -314,9 +421,21 @@ class ProxyRelSequence:
         ComponentInstanceRelation.objects.filter(source=self.proxy._instance, target=target_instance if isinstance(target_instance, ComponentInstance) else target_instance._instance, field=self.rel_descr).delete()
 
 
+def _environments(env):
+    """The environments given to a proxy constructor (an environment, a name or a list of environments) as a list"""
+    if env and type(env) is list:
+        return env
+    elif env and type(env) is str:
+        return [Environment.objects.get(name=env)]
+    elif env and type(env) is Environment:
+        return [env]
+    return []
+
 def _proxyinit(self, base_instance=None, _cic=None, _env=None, _noconventions=False, _project=None, **kwargs):
     self._descr_id = None
     self._id = None
+    self._buffered = False
+    _proxy_refresh(self)
 
     if not base_instance is None:
         self._instance = base_instance
@@ -337,39 +456,125 @@ def _proxyinit(self, base_instance=None, _cic=None, _env=None, _noconventions=Fa
         self._instance.instanciates = self.__class__._related_impl.cic_set.all()[0]
 
     ## Envts
-    if _env and type(_env) is list:
-        for env in _env:
-            self._instance.environments.add(env)
-    elif _env and type(_env) is str:
-        self._instance.environments.add(Environment.objects.get(name=_env))
-    elif _env and type(_env) is Environment:
-        self._instance.environments.add(_env)
+    for env in _environments(_env):
+        self._instance.environments.add(env)
 
     ## Fields
     if not _noconventions:
         from ref.conventions import value_instance_fields, value_instance_graph_fields
         value_instance_fields(self._instance, force=False)
-    for name, value in kwargs.items():
-        if value is not None:
-            setattr(self, name, value)
+    with _proxy_buffered(self):
+        for name, value in kwargs.items():
+            if value is not None:
+                setattr(self, name, value)
     if not _noconventions:
         value_instance_graph_fields(self._instance, force=False)
+        _proxy_refresh(self)
 
     ## helper accessor to extended parameters
     self.extended_parameters = ExtendedParameterDict(self._instance)
 
-def _proxy_single_rel_accessor(instance, field_id):
-    try:
-        return instance._instance.rel_target_set.select_related('target__description').get(field_id=field_id).target
-    except ComponentInstanceRelation.DoesNotExist:
-        return None
+## Proxies read all the field values and single relationships of their instance at once, on first access, and keep
+## them until refresh(). Writes go to the database at once, unless inside a 'with proxy.buffered():' block: there, the
+## writes to fields and single relationships are kept aside and flushed in bulk at the end of the block (they are
+## dropped if it raises). Changes to relationships with many targets (ProxyRelSequence) are always written at once.
+
+def _proxy_snapshot(proxy):
+    if proxy._field_values is None:
+        proxy._field_values = dict(proxy._instance.field_set.values_list('field_id', 'value'))
+        proxy._relation_targets = dict((rel.field_id, rel.target) for rel in proxy._instance.rel_target_set.select_related('target__description').filter(field__max_cardinality=1))
+    return proxy
+
+def _proxy_single_rel_accessor(proxy, field_id):
+    if field_id in proxy._dirty_relations:
+        return proxy._dirty_relations[field_id]
+    return _proxy_snapshot(proxy)._relation_targets.get(field_id)
+
+def _proxy_single_rel_setter(proxy, field_id, target):
+    proxy._dirty_relations[field_id] = getattr(target, '_instance', target)
+    if not proxy._buffered:
+        _proxy_flush(proxy)
 
 def _proxy_simple_accessor(proxy, field_id):
+    if field_id in proxy._dirty_fields:
+        return proxy._dirty_fields[field_id]
+    return _proxy_snapshot(proxy)._field_values.get(field_id)
+
+def _proxy_simple_setter(proxy, field_id, value):
+    ## Stored as the database would, so reads give the same type before and after save()
+    proxy._dirty_fields[field_id] = None if value is None else str(value)
+    if not proxy._buffered:
+        _proxy_flush(proxy)
+
+def _proxy_refresh(proxy):
+    """Forgets the values read and the buffered values not written yet"""
+    proxy._field_values = None
+    proxy._relation_targets = None
+    proxy._dirty_fields = {}
+    proxy._dirty_relations = {}
+
+@contextmanager
+def _proxy_buffered(proxy):
+    """Context manager keeping the writes to the proxy aside, to write them in bulk when it exits"""
+    buffered, proxy._buffered = proxy._buffered, True
     try:
-        field = proxy._instance.field_set.get(field_id=field_id)
-    except ComponentInstanceField.DoesNotExist:
-        return None
-    return field.value
+        yield proxy
+    except:
+        proxy._dirty_fields = {}
+        proxy._dirty_relations = {}
+        raise
+    finally:
+        proxy._buffered = buffered
+    if not buffered:
+        _proxy_flush(proxy)
+
+def _proxy_flush(proxy):
+    """Writes the buffered values, with a constant number of queries"""
+    from ref.conventions import save_field_values
+    from ref.computed_store import affected_by_relations, refresh
+
+    if proxy._dirty_fields:
+        existing = dict((fv.field_id, fv) for fv in proxy._instance.field_set.filter(field_id__in=proxy._dirty_fields.keys()))
+        created, updated = [], []
+        for field_id, value in proxy._dirty_fields.items():
+            fv = existing.get(field_id)
+            if fv is None:
+                created.append(ComponentInstanceField(instance=proxy._instance, field_id=field_id, value=value))
+            elif fv.value != value:
+                fv.value = value
+                updated.append(fv)
+        save_field_values(created, updated)
+        if proxy._field_values is not None:
+            proxy._field_values.update(proxy._dirty_fields)
+        proxy._dirty_fields = {}
+
+    if proxy._dirty_relations:
+        existing = dict((rel.field_id, rel) for rel in proxy._instance.rel_target_set.filter(field_id__in=proxy._dirty_relations.keys()))
+        created, updated = [], []
+        for field_id, target in proxy._dirty_relations.items():
+            rel = existing.get(field_id)
+            if target is None:
+                ## Removal (sends the deletion signals)
+                if rel is not None:
+                    rel.delete()
+            elif rel is None:
+                created.append(ComponentInstanceRelation(source=proxy._instance, field_id=field_id, target=target))
+            elif rel.target_id != target.pk:
+                rel.target = target
+                updated.append(rel)
+        ComponentInstanceRelation.objects.bulk_create(created)
+        ComponentInstanceRelation.objects.bulk_update(updated, ['target'])
+        if created or updated:
+            ## What the signal handlers of ref.cache would have done
+            naming_language.bump_generations(['mql'])
+            refresh(affected_by_relations((rel.field_id, rel.source_id) for rel in created + updated))
+        if proxy._relation_targets is not None:
+            proxy._relation_targets.update(proxy._dirty_relations)
+        proxy._dirty_relations = {}
+
+def _proxy_save(proxy):
+    _proxy_flush(proxy)
+    proxy._instance.save()
 
 def clear_classes_cache():
     """Clear ImplementationDesscription classes cache. Only useful in test context"""
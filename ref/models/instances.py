@@ -13,6 +13,7 @@ from django.db import models
 from django.dispatch.dispatcher import receiver
 from django.db.models.signals import pre_save
 from django.db.models.constraints import UniqueConstraint
+from django.db.models.indexes import Index
 
 from ref.models.classifier import Project
 
@@ -125,6 +126,8 @@ class ComponentInstanceFieldManager(models.Manager):
 
 class ComponentInstanceField(models.Model):
     value = models.CharField(max_length=512, verbose_name='valeur', db_index=True)
+    ## Used to find values by their end with an index (see ref.value_index). Set on save.
+    reversed_value = models.CharField(max_length=512, verbose_name='valeur inversée', db_index=True, default='', editable=False)
     field = models.ForeignKey('ImplementationFieldDescription', verbose_name=u'champ implémenté', on_delete=models.CASCADE)
     instance = models.ForeignKey('ComponentInstance', verbose_name=u'instance de composant', related_name='field_set', on_delete=models.CASCADE)
 
@@ -140,6 +143,40 @@ class ComponentInstanceField(models.Model):
 
     objects = ComponentInstanceFieldManager()
 
+@receiver(pre_save, sender=ComponentInstanceField)
+def reverse_field_value(sender, instance, raw, **kwargs):
+    instance.reversed_value = str(instance.value)[::-1]
+
+
+class ComponentInstanceFieldTrigram(models.Model):
+    """ Lower case trigrams of a field value, used to find values by a part of their content. Maintained by ref.value_index - never edit by hand. """
+    trigram = models.CharField(max_length=3)
+    field_value = models.ForeignKey('ComponentInstanceField', related_name='trigram_set', on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = u'trigramme de valeur de champ'
+        verbose_name_plural = u'trigrammes des valeurs des champs'
+        indexes = [
+            Index(fields=('trigram', 'field_value'), name='field_value_trigram')
+        ]
+
+
+class ComponentInstanceComputedValue(models.Model):
+    """ Materialized value of a computed field for an instance. Maintained by ref.computed_store - never edit by hand. """
+    value = models.TextField(null=True, verbose_name='valeur (JSON)')
+    field = models.ForeignKey('ImplementationComputedFieldDescription', verbose_name=u'champ calculé', related_name='value_set', on_delete=models.CASCADE)
+    instance = models.ForeignKey('ComponentInstance', verbose_name=u'instance de composant', related_name='computed_value_set', on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = u'valeur de champ calculé'
+        verbose_name_plural = u'valeurs des champs calculés'
+        constraints = [
+            UniqueConstraint(fields=('instance', 'field'), name='computed_value_uniqueness')
+        ]
+
+    def __str__(self):
+        return 'valeur de %s' % self.field.name
+
 
 class ComponentInstanceManager(models.Manager):
     def get_by_natural_key(self, project, stable_key):
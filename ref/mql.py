@@ -4,238 +4,786 @@
 MAGE Query Language
 '''
 
-from pyparsing import Forward, Group, Suppress, Optional, ZeroOrMore, Combine, \
-    Word, alphas, nums, QuotedString, CaselessLiteral, FollowedBy
+import base64
+import json
+import operator
+import re
+import time
+from hashlib import md5
+from functools import reduce
 from ref.models.instances import ComponentInstance, ComponentInstanceField, ComponentInstanceRelation
+from ref.models.description import ImplementationFieldDescription, ImplementationRelationDescription, \
+    ImplementationComputedFieldDescription
 from django.db.models.query import Prefetch
-from django.db.models import Q
+from django.db.models import Q, F, Count, Exists, OuterRef, Subquery, Value, CharField, IntegerField, Case, When
+from django.db.models.functions import Coalesce, Cast
+from django.conf import settings
+from django.db import connection
+from django.core.cache import cache
+from ref.parse_cache import ParseCache
+from ref.parsing import ParseTree, Parser, Tokenizer, unquote
+from ref.exceptions import MageMclSyntaxError
+from ref.naming_language import generations
+from ref import value_index
+from ref.computed_store import get_many_values
+
+
+class _Parser(Parser):
+    """
+        Recursive descent parser of MQL queries (see the grammar in the documentation). The syntax tree has a 'select'
+        element (and an 'explain' one with EXPLAIN), with the clauses of the query as elements.
+    """
+    tokenizer = Tokenizer((('string', r"'(?:[^'\n\r]|'')*'"), ('identifier', r'[A-Za-z_][A-Za-z0-9_]*'), ('number', r'[0-9]+'),
+                           ('symbol', r'[.,()=*]')), MageMclSyntaxError)
+    error_class = MageMclSyntaxError
+
+    def query(self):
+        res = ParseTree()
+        if self.accept_keyword('EXPLAIN'):
+            res.explain = 'EXPLAIN'
+        res.select = self.select()
+        self.expect('end', expected='end of query')
+        return res
 
+    def select(self):
+        q = ParseTree()
+        self.expect_keyword('SELECT')
+        if self.is_keyword('COUNT') and self.peek(1)[1] == '(':
+            self.position += 1
+            self.expect('symbol', '(')
+            q.count = self.expect('symbol', '*')
+            self.expect('symbol', ')')
+            self.expect_keyword('FROM')
+        elif self.peek()[0] == 'identifier':
+            ## Either a selector or the pre filters - only a selector is followed by FROM
+            start = self.position
+            selector = self.navigations()
+            if self.accept_keyword('FROM'):
+                q.selector = selector
+            else:
+                self.position = start
+
+        for keyword, name in (('PROJECT', 'prj'), ('ENVIRONMENT', 'envt'), ('LC', 'lc'), ('OFFER', 'cic')):
+            if self.accept_keyword(keyword):
+                setattr(q, name, self.string())
+        if self.accept_keyword('IMPLEMENTATION'):
+            q.impl = self.string()
+        elif self.peek()[0] == 'string':
+            q.impl = self.string()
+        self.expect_keyword('INSTANCES')
+
+        if self.accept_keyword('WHERE'):
+            q.where = [self.predicate()]
+            while self.accept_keyword('AND'):
+                q.where.append(self.predicate())
+        if self.accept_keyword('GROUP', 'BY'):
+            q.group = self.navigations()
+        if self.accept_keyword('WITH', 'COMPUTATIONS'):
+            q.compute = 'WITH COMPUTATIONS'
+        if self.accept_keyword('ORDER', 'BY'):
+            q.order = [self.order_item()]
+            while self.accept('symbol', ','):
+                q.order.append(self.order_item())
+        if self.accept_keyword('LIMIT'):
+            q.limit = self.expect('number')
+        if self.accept_keyword('AFTER'):
+            q.after = self.string()
+        return q
+
+    def string(self):
+        return unquote(self.expect('string', expected='quoted string'), "'")
+
+    def navigation(self):
+        res = [self.expect('identifier')]
+        while self.accept('symbol', '.'):
+            res.append(self.expect('identifier'))
+        return res
 
-def __build_grammar():
-    expr = Forward()
+    def navigations(self):
+        res = [self.navigation()]
+        while self.accept('symbol', ','):
+            res.append(self.navigation())
+        return res
 
-    k_select = CaselessLiteral("SELECT")
-    k_from = CaselessLiteral("FROM")
-    k_where = CaselessLiteral("WHERE")
-    k_and = CaselessLiteral("AND")
-    k_instances = CaselessLiteral("INSTANCES")
-    qs = QuotedString("'", escQuote="''")
+    def predicate(self):
+        res = ParseTree(navigation=self.navigation())
+        if self.accept('symbol', '='):
+            if self.peek()[0] == 'string':
+                res.value = self.string()
+                return res
+        else:
+            self.expect_keyword('IN')
+        self.expect('symbol', '(')
+        res.subquery = self.select()
+        self.expect('symbol', ')')
+        return res
 
-    identifier = Combine(Word(alphas + "_", exact=1) + Optional(Word(nums + alphas + "_")))("identifier")
-    navigation = Group(identifier + ZeroOrMore(Suppress(".") + identifier))("navigation")
+    def order_item(self):
+        res = ParseTree(navigation=self.navigation())
+        if self.accept_keyword('ASC'):
+            res.direction = 'ASC'
+        elif self.accept_keyword('DESC'):
+            res.direction = 'DESC'
+        return res
 
-    filter_predicate = Group(
-        navigation + Suppress("=") + (qs('value') | (Suppress('(') + expr('subquery') + Suppress(')'))))('predicate')
-    where_clause = Group(Suppress(k_where) + filter_predicate + ZeroOrMore(Suppress(k_and) + filter_predicate))('where')
 
-    # Pre filters
-    impl = Optional(Suppress(CaselessLiteral("implementation"))) + qs('impl')
-    cic = Suppress(CaselessLiteral("offer")) + qs('cic')
-    lc = Suppress(CaselessLiteral("lc")) + qs('lc')
-    envt = Suppress(CaselessLiteral("environment")) + qs('envt')
-    project = Suppress(CaselessLiteral("project")) + qs('prj')
-    pre_filter = Optional(project) + Optional(envt) + Optional(lc) + Optional(cic) + Optional(impl) + FollowedBy(k_instances)
+def parse(query):
+    """Returns the syntax tree of the given query. Raises MageMclSyntaxError if the query is wrong."""
+    return _Parser(query).query()
 
-    # Dict query (only select some elements and navigate)
-    nl_expr = Group(navigation + ZeroOrMore(Suppress(',') + navigation) + FollowedBy(k_from))('selector')
 
-    # The sum of all fears
-    select = Group(
-        Suppress(k_select) + Optional(nl_expr + Suppress(k_from)) + pre_filter + Suppress(k_instances) + Optional(
-            where_clause) + Optional(CaselessLiteral('WITH COMPUTATIONS')('compute')))('select')
+parsed_queries = ParseCache(parse, getattr(settings, 'MAGE_PARSE_CACHE_SIZE', 1000))
 
-    expr << select
-    return expr
 
+## Number of instances loaded (with all their prefetched data) at the same time
+CHUNK_SIZE = getattr(settings, 'MAGE_MQL_CHUNK_SIZE', 500)
 
-__grammar = __build_grammar()
+## Results of queries are cached (in the Django cache) until the next change of the referential - if they are small enough
+RESULT_CACHE_TIMEOUT = getattr(settings, 'MAGE_MQL_RESULT_CACHE_TIMEOUT', 600)
+RESULT_CACHE_MAX_SIZE = getattr(settings, 'MAGE_MQL_RESULT_CACHE_MAX_SIZE', 1000)
 
 
 def run(query, return_sensitive_data=False):
-    expr = __grammar.parseString(query)
-    return __run(expr, return_sensitive_data)
-    # return  __grammar.parseString(query)
-
-
-def __run(q, return_sensitive_data):
-    if q.select != None:
-        return __select_compo(q.select, return_sensitive_data)
-
-
-def __select_compo(q, return_sensitive_data):
-    rs = ComponentInstance.objects.filter(deleted=False)
+    return list(iterate(query, return_sensitive_data))
+
+
+def run_batch(queries, return_sensitive_data=False):
+    """
+        Iterable Pages of results of many queries (see iterate). Instances returned by many queries of the batch are
+        only loaded once.
+    """
+    shared = {}
+    return [iterate(query, return_sensitive_data, shared=shared) for query in queries]
+
+
+def iterate(query, return_sensitive_data=False, chunk_size=CHUNK_SIZE, shared=None):
+    """
+        Same as run, but returns an iterable Page of results. The query is parsed and compiled immediately (so errors
+        are raised by this call), but data is only fetched - chunk by chunk - during the iteration.
+        shared is a dict of the instances already loaded by other queries, which is completed by this one.
+    """
+    parsed = parsed_queries.get(query)
+    if parsed.explain:
+        page = Page()
+        page.results = [explain(parsed, return_sensitive_data)]
+        return page
+
+    cache_key = __result_cache_key(query, return_sensitive_data)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        page = Page(parsed.select.limit and int(parsed.select.limit))
+        page.results, page.last_key = cached
+        return page
+
+    page = __prepare(parsed.select, return_sensitive_data, chunk_size, shared)
+    page.cache_key = cache_key
+    return page
+
+
+def __prepare(q, return_sensitive_data, chunk_size=CHUNK_SIZE, shared=None):
+    """A Page of results of the query, with all the query sets ready but not yet run"""
+    page = Page(q.limit and int(q.limit))
+    if q.count or q.group:
+        page.results = __iter_counts(__compile_count(q, return_sensitive_data), q.group)
+        return page
+
+    rs, keys = __compile_query(q, return_sensitive_data)
+    if not q.selector:
+        page.results = __iter_dicts(rs, use_computed_fields=q.compute, return_sensitive_data=return_sensitive_data, chunk_size=chunk_size, keys=keys, page=page, shared=shared)
+    else:
+        ## Selectors are checked now, so that their errors are not raised in the middle of a streamed response
+        descriptions = __selector_descriptions(q.selector)
+        __check_selector(q, return_sensitive_data, descriptions)
+        page.results = __iter_dicts(rs, q.selector, return_sensitive_data=return_sensitive_data, chunk_size=chunk_size, keys=keys, page=page, descriptions=descriptions)
+    return page
+
+
+def explain(query, return_sensitive_data=False):
+    """
+        Runs a query (without the result cache) and reports how: the SQL statements issued with their database plan,
+        and the time spent in each phase. Fetch is the time spent inside the database, serialize the rest of the
+        iteration over the results. query is a query (with or without EXPLAIN) or a parse result.
+    """
+    timings = {}
+    start = time.perf_counter()
+    parsed = parsed_queries.parser(query) if isinstance(query, str) else query
+    q = parsed.select
+    timings['parse'] = time.perf_counter() - start
+
+    statements = []
+    executed = []
+    def record(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            statements.append({'sql': sql, 'params': [str(p) for p in params or ()], 'time': time.perf_counter() - start})
+            executed.append((sql, params))
+
+    with connection.execute_wrapper(record):
+        start = time.perf_counter()
+        page = __prepare(q, return_sensitive_data)
+        timings['filter'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result_count = sum(1 for item in page)
+        timings['fetch'] = sum(statement['time'] for statement in statements)
+        timings['serialize'] = time.perf_counter() - start - timings['fetch']
+
+    for statement, (sql, params) in zip(statements, executed):
+        statement['plan'] = __plan(sql, params)
+    return {'query_count': len(statements), 'result_count': result_count, 'timings': timings, 'statements': statements}
+
+
+def __plan(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute('%s %s' % (connection.ops.explain_query_prefix(), sql), params)
+        return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+def __result_cache_key(query, return_sensitive_data):
+    """
+        The query is normalized (blanks outside of quoted values do not matter) and hashed. The key contains the
+        generation of the referential, which is changed on every modification (see ref.cache), so cached results are
+        never outdated.
+    """
+    parts = re.split(r"('(?:[^']|'')*')", query)
+    normalized = ''.join(part if i % 2 else ' '.join(part.split()) for i, part in enumerate(parts))
+    return 'mql_%s_%s_%s' % (generations(['mql'])['mql'], return_sensitive_data and 1 or 0, md5(normalized.encode('utf-8')).hexdigest())
+
+
+class Page(object):
+    """
+        Iterable over the results of a query. Once iterated, if the query had a LIMIT clause, cursor is the value to give
+        to the AFTER clause of the same query to get the next results - or None if there are no more results.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.cache_key = None
+        self.results = ()
+        self.count = 0
+        self.last_key = None
+
+    def __iter__(self):
+        ## Fully iterated small results are put inside the result cache
+        kept = [] if self.cache_key else None
+        for item in self.results:
+            self.count += 1
+            if kept is not None:
+                kept.append(item)
+                if len(kept) > RESULT_CACHE_MAX_SIZE:
+                    kept = None
+            yield item
+        if kept is not None:
+            cache.set(self.cache_key, (kept, self.last_key), RESULT_CACHE_TIMEOUT)
+
+    @property
+    def cursor(self):
+        if not self.limit or self.count < self.limit or self.last_key is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(self.last_key).encode('utf-8')).decode('ascii')
+
+
+def columns(query, return_sensitive_data=False):
+    """
+        Names of the keys of the results of a query, computed without running it. For queries without selector, this
+        is every attribute of every type returned by the query, so some results may not have all of them.
+    """
+    parsed = parsed_queries.get(query)
+    if parsed.explain:
+        return ['query_count', 'result_count', 'timings', 'statements']
+    q = parsed.select
+    if q.count or q.group:
+        return ['_'.join(navigation) for navigation in q.group or ()] + ['mage_count']
+    if q.selector:
+        return ['_'.join(navigation) for navigation in q.selector]
+
+    descriptions = ComponentInstance.objects.filter(__compile_filter(q, return_sensitive_data)).values('description_id')
+    sensitivity = (True, False) if return_sensitive_data else (False,)
+    res = ['mage_id', 'mage_cic_id', 'mage_deleted', 'mage_description_id', 'mage_description_name', 'mage_environments']
+    res += ImplementationFieldDescription.objects.filter(description_id__in=descriptions, sensitive__in=sensitivity).order_by('id').values_list('name', flat=True)
+    res += [name + '_id' for name in ImplementationRelationDescription.objects.filter(source_id__in=descriptions, sensitive__in=sensitivity).order_by('id').values_list('name', flat=True)]
+    if q.compute:
+        res += ImplementationComputedFieldDescription.objects.filter(description_id__in=descriptions, sensitive__in=sensitivity).order_by('id').values_list('name', flat=True)
+    return list(dict.fromkeys(res))
+
+
+def __compile_subquery(q, return_sensitive_data, as_ids):
+    """
+        The values returned by a subquery, as a SQL subselect (the subquery is never run on its own): the values of its
+        single selected navigation, or the ids of the instances it finds. as_ids tells if these values are compared
+        to ids or to field values (strings).
+    """
+    if q.count or q.group:
+        raise MageMclSyntaxError('subqueries cannot use COUNT(*)')
+    if q.selector and len(q.selector) != 1:
+        raise MageMclSyntaxError('subqueries must always return a single field')
+    if q.limit:
+        ## Not allowed inside IN subselects by all databases
+        raise MageMclSyntaxError('subqueries cannot use LIMIT')
+
+    ## Sorting is useless inside a subselect
+    rs = __compile_query(q, return_sensitive_data)[0].order_by()
+    value = __navigation_value(q.selector[0], return_sensitive_data) if q.selector else F('pk')
+    return rs.annotate(mql_value=Cast(value, IntegerField() if as_ids else CharField())).values('mql_value')
+
+
+def __compile_query(q, return_sensitive_data):
+    """
+        The full query set of a query (filters, ORDER BY, AFTER and LIMIT) and the names of its sort keys. Instances
+        are always sorted, on the ORDER BY keys then on their id, so that pagination is stable.
+    """
+    rs = ComponentInstance.objects.filter(__compile_filter(q, return_sensitive_data))
+
+    keys = []
+    for i, item in enumerate(q.order or ()):
+        rs = rs.annotate(**{'mql_order_%s' % i: __order_key(item.navigation, return_sensitive_data)})
+        keys.append(('mql_order_%s' % i, item.direction.upper() == 'DESC'))
+    keys.append(('pk', False))
+
+    if q.after:
+        rs = rs.filter(__after(keys, q.after))
+    rs = rs.order_by(*[('-' if descending else '') + key for key, descending in keys])
+    if q.limit:
+        rs = rs[:int(q.limit)]
+    return rs, [key for key, descending in keys[:-1]]
+
+
+def __compile_count(q, return_sensitive_data):
+    """
+        COUNT(*) queries: a single aggregate query, grouped on the values of the GROUP BY navigations and sorted on them.
+        Each group counts all its instances: an instance in many environments is counted in each of them. Navigations
+        through relationships with many targets are refused, as their instances could not be counted in all their groups.
+    """
+    if not q.count:
+        raise MageMclSyntaxError('GROUP BY can only be used with SELECT COUNT(*)')
+    if q.order or q.after or q.compute:
+        raise MageMclSyntaxError('COUNT(*) cannot be used with ORDER BY, AFTER or WITH COMPUTATIONS')
+
+    rs = ComponentInstance.objects.filter(__compile_filter(q, return_sensitive_data))
+    if not q.group:
+        return rs
+    __check_group(q)
+
+    keys = ['mql_group_%s' % i for i in range(len(q.group))]
+    values = {}
+    for key, navigation in zip(keys, q.group):
+        if len(navigation) == 1 and navigation[0] == 'mage_environments':
+            ## A join, so one row per environment
+            values[key] = F('environments__name')
+        else:
+            values[key] = __navigation_value(navigation, return_sensitive_data)
+    rs = rs.annotate(**values).values(*keys).annotate(mage_count=Count('pk', distinct=True)).order_by(*keys)
+    if q.limit:
+        rs = rs[:int(q.limit)]
+    return rs
+
+
+def __check_group(q):
+    """Refuses the GROUP BY navigations going through a relationship which can have many targets"""
+    relation_names = set(name for navigation in q.group for name in navigation[:-1])
+    if not relation_names:
+        return
+    relations = list(ImplementationRelationDescription.objects.filter(name__in=relation_names).values_list('name', 'source__name', 'source_id', 'target_id', 'max_cardinality'))
+    for navigation in q.group:
+        ## Without a description in the query, all the descriptions may be the root of the navigation
+        reached = None
+        for name in navigation[:-1]:
+            candidates = [rel for rel in relations if rel[0] == name and (rel[2] in reached if reached is not None else not q.impl or rel[1] == q.impl)]
+            if any(not rel[4] or rel[4] > 1 for rel in candidates):
+                raise MageMclSyntaxError("GROUP BY cannot use '%s', a relationship which can have many targets" % name)
+            reached = set(rel[3] for rel in candidates)
+
+
+def __iter_counts(rs, group):
+    if not group:
+        yield {'mage_count': rs.count()}
+        return
+    names = ['_'.join(navigation) for navigation in group]
+    for row in rs.iterator():
+        res = dict((name, row['mql_group_%s' % i]) for i, name in enumerate(names))
+        res['mage_count'] = row['mage_count']
+        yield res
+
+
+## Values which are not fields
+__special_values = {'mage_id': 'pk', '_id': 'pk', 'mage_cic_id': 'instanciates_id', 'mage_deleted': 'deleted',
+                    'mage_description_id': 'description_id', 'mage_description_name': 'description__name'}
+## The ones which can be NULL, with the type of their value
+__nullable_special_values = {'mage_cic_id': IntegerField()}
+
+def __navigation_value(navigation, return_sensitive_data):
+    """
+        An expression giving the value at the end of a navigation, or NULL if there is none. When the navigation leads to
+        many values, the smallest one is used. Sensitive fields are seen as missing without return_sensitive_data.
+    """
+    if len(navigation) == 1 and navigation[0] in __special_values:
+        return F(__special_values[navigation[0]])
+    if len(navigation) == 1 and navigation[0] == 'mage_environments':
+        rs = ComponentInstance.environments.through.objects.filter(componentinstance_id=OuterRef('pk'))
+        return Subquery(rs.order_by('environment__name').values('environment__name')[:1], output_field=CharField())
+
+    if navigation[-1] in ('mage_id', '_id'):
+        ## Id of the target of the last relationship
+        rs, prefix, path, value = ComponentInstanceRelation.objects.filter(field__name=navigation[-2]), 'source__', navigation[:-2], 'target_id'
+        output_field = IntegerField()
+    else:
+        rs, prefix, path, value = ComponentInstanceField.objects.filter(field__name=navigation[-1]), 'instance__', navigation[:-1], 'value'
+        output_field = CharField()
+    if not return_sensitive_data:
+        rs = rs.filter(field__sensitive=False)
+
+    ## Walk the relationships backwards, up to the instance. A single filter call, so a single chain of joins.
+    lookups = {}
+    for part in reversed(path):
+        lookups[prefix + 'rel_targeted_by_set__field__name'] = part
+        prefix += 'rel_targeted_by_set__source__'
+    lookups[prefix + 'pk'] = OuterRef('pk')
+
+    return Subquery(rs.filter(**lookups).order_by(value).values(value)[:1], output_field=output_field)
+
+
+def __order_key(navigation, return_sensitive_data):
+    """
+        Expression used to sort instances on a navigation. Field values are strings, so are sorted as strings.
+        Instances without the value come first (or last with DESC), as if it were empty. Keys are never NULL, as
+        pagination cursors compare them.
+    """
+    res = __navigation_value(navigation, return_sensitive_data)
+    if isinstance(res, F):
+        if len(navigation) > 1 or navigation[0] not in __nullable_special_values:
+            return res
+        output_field = __nullable_special_values[navigation[0]]
+    else:
+        output_field = res.output_field
+    default = Value(0) if isinstance(output_field, IntegerField) else Value('')
+    return Coalesce(res, default, output_field=output_field)
+
+
+def __after(keys, cursor):
+    """Keyset pagination: instances sorted strictly after the sort key values contained inside the cursor"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise MageMclSyntaxError('invalid AFTER cursor')
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise MageMclSyntaxError('the AFTER cursor does not match the ORDER BY clause')
+
+    res = None
+    equal = Q()
+    for (key, descending), value in zip(keys, values):
+        after = equal & Q(**{key + ('__lt' if descending else '__gt'): value})
+        res = after if res is None else res | after
+        equal &= Q(**{key: value})
+    return res
+
+
+def __compile_filter(q, return_sensitive_data):
+    """
+        Compiles the pre-filters and the WHERE clause of a query into a single Q object.
+        Every multi-valued navigation (environments, fields, relationships) becomes a correlated EXISTS subquery
+        instead of a join, so the main query never returns the same instance twice whatever the number of predicates.
+    """
+    res = Q(deleted=False)
 
     if q.lc:
-        rs = rs.filter(instanciates__implements__name=q.lc)
+        res &= Q(instanciates__implements__name=q.lc)
     if q.cic:
-        rs = rs.filter(instanciates__name=q.cic)
+        res &= Q(instanciates__name=q.cic)
     if q.impl:
-        rs = rs.filter(description__name=q.impl)
+        res &= Q(description__name=q.impl)
     if q.envt:
-        rs = rs.filter(environments__name=q.envt)
+        res &= Q(Exists(__envt_link(environment__name=q.envt)))
     if q.prj:
-        rs = rs.filter(environments__project__name=q.prj)
+        res &= Q(Exists(__envt_link(environment__project__name=q.prj)))
 
     if q.where:
         for predicate in q.where:
-            ## Special keys begin with 'mage_', normal keys without 'mage_' are CI attributes
-            if len(predicate.navigation) == 1 and predicate.navigation[0].lower().startswith('mage_'):
-                key = predicate.navigation[0]
-                if key.lower() == "mage_type":
-                    rs = rs.filter(description__name=predicate.value)
-                if key.lower() == "mage_id":
-                    rs = rs.filter(id=predicate.value)
-                if key.lower() == "mage_envt":
-                    rs = rs.filter(environments__name=predicate.value)
-                if key.lower() == "mage_backup":
-                    rs = rs.filter(include_in_envt_backup=(predicate.value.upper() == 'TRUE'))
-
-                continue
-
-            ## Key analysis: last part is always a simple field, others are relationship fields
-            r = {}
-            prefix = ""
-            for part in predicate.navigation[0:-1]:
-                r[prefix + 'rel_target_set__field__name'] = part
-                prefix = prefix + 'relationships__'
-
-            ## Add last item - the attribute name itself, constraint by the value
-            val = None
-            if predicate.value:
-                val = predicate.value
-            elif predicate.subquery:
-                tmp = __select_compo(predicate.subquery, return_sensitive_data)
-                if not type(tmp) == list:
-                    raise Exception('subqueries must always return a single field')
-                if len(tmp) != 1:
-                    raise Exception('subqueries must return a single value')
-                val = list(tmp[0].values())[0]
-
-            if predicate.navigation[-1] == '_id':
-                r[prefix + 'id'] = val
-            else:
-                r[prefix + 'field_set__field__name'] = predicate.navigation[-1]
-
-                ## MQL supports % as a wildcard in first and last position only.
-                ## Because we don't want dependency on an external Django LIKE module.
-                escaped_val = val.replace("\%", "")
-                if escaped_val.endswith("%") and escaped_val.startswith("%"):
-                    r[prefix + 'field_set__value__contains'] = val[1:-1]
-                elif escaped_val.endswith("%"):
-                    r[prefix + 'field_set__value__startswith'] = val[:-1]
-                    print(r)
-                elif escaped_val.startswith("%"):
-                    r[prefix + 'field_set__value__endswith'] = val[1:]
-                else:
-                    r[prefix + 'field_set__value'] = val
-            rs = rs.filter(**r)
+            res &= __compile_predicate(predicate, return_sensitive_data)
+
+    return res
 
-    if not q.selector:
-        return __to_dict(rs, use_computed_fields=q.compute, return_sensitive_data=return_sensitive_data)
-    else:
-        return __to_dict(rs, q.selector, return_sensitive_data=return_sensitive_data)
 
+def __envt_link(**kwargs):
+    return ComponentInstance.environments.through.objects.filter(componentinstance_id=OuterRef('pk'), **kwargs)
 
-def __to_dict(rs, selector=None, optim=True, use_computed_fields=False, return_sensitive_data=False):
+
+def __compile_predicate(predicate, return_sensitive_data):
+    ## Subqueries are compared with IN: any of their values matches
+    if predicate.subquery:
+        val = __compile_subquery(predicate.subquery, return_sensitive_data, predicate.navigation[-1].lower() in ('_id', 'mage_id'))
+        id_suffix, value_lookup = '__in', {'value__in': val}
+    else:
+        val = predicate.value
+        id_suffix, value_lookup = '', __value_lookup(val)
+
+    ## Special keys begin with 'mage_', normal keys without 'mage_' are CI attributes
+    if len(predicate.navigation) == 1 and predicate.navigation[0].lower().startswith('mage_'):
+        key = predicate.navigation[0].lower()
+        if key == "mage_type":
+            return Q(**{'description__name' + id_suffix: val})
+        if key == "mage_id":
+            return Q(**{'id' + id_suffix: val})
+        if key == "mage_envt":
+            return Q(Exists(__envt_link(**{'environment__name' + id_suffix: val})))
+        if key == "mage_backup":
+            if predicate.subquery:
+                raise MageMclSyntaxError('mage_backup can only be compared to TRUE or FALSE, not to a subquery')
+            return Q(include_in_envt_backup=(predicate.value.upper() == 'TRUE'))
+        return Q()
+
+    ## Key analysis: last part is always a simple field, others are relationship fields.
+    ## The set of matching instances is built from the end of the navigation back to the root instance.
+    if predicate.navigation[-1] == '_id':
+        if len(predicate.navigation) == 1:
+            return Q(**{'id' + id_suffix: val})
+        targets = {'target_id' + id_suffix: val}
+    else:
+        fields = ComponentInstanceField.objects.filter(field__name=predicate.navigation[-1], **value_lookup)
+        if len(predicate.navigation) == 1:
+            return Q(Exists(fields.filter(instance_id=OuterRef('pk'))))
+        targets = {'target_id__in': fields.values('instance_id')}
+
+    for part in predicate.navigation[-2:0:-1]:
+        targets = {'target_id__in': ComponentInstanceRelation.objects.filter(field__name=part, **targets).values('source_id')}
+
+    return Q(Exists(ComponentInstanceRelation.objects.filter(source_id=OuterRef('pk'), field__name=predicate.navigation[0], **targets)))
+
+
+def __value_lookup(val):
+    ## MQL supports % as a wildcard in first and last position only.
+    ## Because we don't want dependency on an external Django LIKE module.
+    ## Wildcard predicates use the value index, as a plain index on the values can only be used to match their beginning.
+    escaped_val = val.replace("\\%", "")
+    if escaped_val.endswith("%") and escaped_val.startswith("%"):
+        return value_index.contains_lookup(val[1:-1])
+    elif escaped_val.endswith("%"):
+        return value_index.startswith_lookup(val[:-1])
+    elif escaped_val.startswith("%"):
+        return value_index.endswith_lookup(val[1:])
+    else:
+        return {'value': val}
+
+
+def __fetch_chunks(rs, prefetched_rs, chunk_size, keys=(), page=None):
+    """
+        Evaluates the query by chunks of instances (in the order of rs), each chunk being loaded with the prefetches of
+        prefetched_rs. This keeps memory usage flat, which QuerySet.iterator alone cannot do as it ignores prefetches.
+        Without prefetched_rs, chunks are only lists of instance ids.
+        The sort keys of the last instance fetched are kept inside the page, to build its cursor.
+    """
+    chunk = []
+    for row in rs.values_list('pk', *keys).iterator(chunk_size=chunk_size):
+        chunk.append(row[0])
+        if page is not None:
+            page.last_key = list(row[1:]) + [row[0]]
+        if len(chunk) == chunk_size:
+            yield __load_chunk(prefetched_rs, chunk)
+            chunk = []
+    if chunk:
+        yield __load_chunk(prefetched_rs, chunk)
+
+
+def __load_chunk(prefetched_rs, chunk):
+    if prefetched_rs is None:
+        return chunk
+    cis = dict((ci.pk, ci) for ci in prefetched_rs.filter(pk__in=chunk))
+    return [cis[pk] for pk in chunk]
+
+
+def __iter_dicts(rs, selector=None, use_computed_fields=False, return_sensitive_data=False, chunk_size=CHUNK_SIZE, keys=(), page=None, shared=None, descriptions=None):
     '''Navigations are done entirely in memory to avoid hitting too much the database'''
-    res = []
+    prefetched_rs = ComponentInstance.objects.all()
 
     ## All data
     if not selector:
-        rs = rs.prefetch_related(Prefetch('field_set', queryset=ComponentInstanceField.objects.select_related('field')))
-        rs = rs.prefetch_related(
-            Prefetch('rel_target_set', queryset=ComponentInstanceRelation.objects.select_related('field')))
-        rs = rs.select_related('description')
-        rs = rs.prefetch_related('environments')
-
-        for ci in rs.all():
-            compo = {}
-            res.append(compo)
-
-            compo['mage_id'] = ci.id
-            compo['mage_cic_id'] = ci.instanciates_id
-            compo['mage_deleted'] = ci.deleted
-            compo['mage_description_id'] = ci.description_id
-            compo['mage_description_name'] = ci.description.name
-            compo['mage_environments'] = ','.join([e.name for e in ci.environments.all()])
-
-            for fi in ci.field_set.all():
-                if not return_sensitive_data and fi.field.sensitive:
-                    continue
-                compo[fi.field.name] = fi.value
-
-            for fi in ci.rel_target_set.all():
-                if not return_sensitive_data and fi.field.sensitive:
-                    continue
-                key = fi.field.name + '_id'
-                if key in compo:
-                    compo[key] = '%s,%s' % (compo[key], fi.target_id)
-                else:
-                    compo[key] = fi.target_id
+        ## Sensitive values are not even loaded when they cannot be returned
+        fields = ComponentInstanceField.objects.select_related('field')
+        relations = ComponentInstanceRelation.objects.select_related('field')
+        computed_fields = ImplementationComputedFieldDescription.objects.all()
+        if not return_sensitive_data:
+            fields = fields.filter(field__sensitive=False)
+            relations = relations.filter(field__sensitive=False)
+            computed_fields = computed_fields.filter(sensitive=False)
+        prefetched_rs = prefetched_rs.prefetch_related(Prefetch('field_set', queryset=fields))
+        prefetched_rs = prefetched_rs.prefetch_related(Prefetch('rel_target_set', queryset=relations))
+        prefetched_rs = prefetched_rs.select_related('description')
+        prefetched_rs = prefetched_rs.prefetch_related('environments')
+        if use_computed_fields or shared is not None:
+            prefetched_rs = prefetched_rs.prefetch_related(Prefetch('description__computed_field_set', queryset=computed_fields))
+
+        for ids in __fetch_chunks(rs, None, chunk_size, keys, page):
+            ## Instances already loaded by a previous query of the same batch are not loaded again
+            loaded = shared if shared is not None else {}
+            missing = [pk for pk in ids if pk not in loaded]
+            if missing:
+                for ci in __load_chunk(prefetched_rs, missing):
+                    loaded[ci.pk] = (ci, __instance_dict(ci))
+            cis = [loaded[pk][0] for pk in ids]
+            res = [dict(loaded[pk][1]) for pk in ids]
 
             if use_computed_fields:
-                for cf in ci.description.computed_field_set.all():
-                    compo[cf.name] = cf.resolve(ci)
-
-        return res
+                ## All the computed fields are resolved at once for all the instances of the chunk
+                instances = {}
+                for ci in cis:
+                    for cf in ci.description.computed_field_set.all():
+                        instances.setdefault(cf, []).append(ci)
+                values = get_many_values(instances)
+                for ci, compo in zip(cis, res):
+                    for cf in ci.description.computed_field_set.all():
+                        compo[cf.name] = values[cf][ci.pk]
+
+            yield from res
 
     else:
-        if optim:
-            ## Preload two levels of data
-            rs = rs.prefetch_related(
-                Prefetch('field_set', queryset=ComponentInstanceField.objects.select_related('field')))
-            rs = rs.prefetch_related(Prefetch('rel_target_set',
-                                              queryset=ComponentInstanceRelation.objects.select_related('field',
-                                                                                                        'target')))
-            rs = rs.prefetch_related(Prefetch('rel_target_set__target__field_set',
-                                              queryset=ComponentInstanceField.objects.select_related('field')))
-
-        ## Fetch!
-        for ci in rs.all():
-            compo = {}
-            res.append(compo)
-
-            for navigation in selector:
-                print(navigation)
-                tmp = ci
-                for idn in navigation:
-                    if navigation.asList().index(idn) == len(navigation) - 1:
-                        # the end of the line is always a value field
-                        key = '_'.join(navigation.asList())
-                        found = False
-                        for fi in tmp.field_set.all():
-                            if fi.field.name == idn:
-                                found = True
-                                compo[key] = fi.value
-                                if not return_sensitive_data and fi.field.sensitive:
-                                    raise Exception('logged-in user has no access to field %s' % idn)
-                        if not found:
-                            ## Special field?
-                            if idn == 'mage_id':
-                                compo[key] = ci.pk
-                            elif idn == 'mage_cic_id':
-                                compo[key] = ci.instanciates_id
-                            elif idn == 'mage_deleted':
-                                compo[key] = ci.deleted
-                            elif idn == 'mage_description_id':
-                                compo[key] = ci.description_id
-                            elif idn == 'mage_description_name':
-                                compo[key] = ci.description.name
-                            elif idn == 'mage_environments':
-                                compo[key] = ','.join([e.name for e in ci.environments.all()])
-                            else:
-                                compo[key] = None
-                    else:
-                        # navigation
-                        found = False
-                        for rel in tmp.rel_target_set.all():
-                            if rel.field.name == idn:
-                                tmp = rel.target
-                                found = True
-                                if not return_sensitive_data and rel.field.sensitive:
-                                    raise Exception('logged-in user has no access to field %s' % idn)
-                                break
-                        if not found:
-                            raise Exception("'%s' is not a valid relationship attribute" % idn)
+        for chunk in __fetch_chunks(rs, None, chunk_size, keys, page):
+            yield from __resolve_selector(selector, chunk, return_sensitive_data, descriptions)
+
+
+def __selector_descriptions(selector):
+    """
+        Relationship and field descriptions named by the navigations of a selector, as two dicts
+        {name: {description id: (name, sensitive, source description id, target description id)}} and
+        {name: {description id: (name, sensitive, owner description id)}}. Only the rows of these descriptions are loaded.
+    """
+    relations, fields = {}, {}
+    relation_names = set(name for navigation in selector for name in navigation[:-1])
+    if relation_names:
+        for pk, name, sensitive, source_id, target_id in ImplementationRelationDescription.objects.filter(name__in=relation_names).values_list('id', 'name', 'sensitive', 'source_id', 'target_id'):
+            relations.setdefault(name, {})[pk] = (name, sensitive, source_id, target_id)
+    for pk, name, sensitive, description_id in ImplementationFieldDescription.objects.filter(name__in=set(navigation[-1] for navigation in selector)).values_list('id', 'name', 'sensitive', 'description_id'):
+        fields.setdefault(name, {})[pk] = (name, sensitive, description_id)
+    return relations, fields
+
+
+def __check_selector(q, return_sensitive_data, descriptions):
+    """
+        Raises all the errors of the selector, before anything is streamed. They are found on the descriptions of the
+        instances of the query: a relationship none of them has, or a sensitive relationship or field which cannot be
+        returned.
+    """
+    relation_descriptions, field_descriptions = descriptions
+    roots = set(ComponentInstance.objects.filter(__compile_filter(q, return_sensitive_data)).order_by().values_list('description_id', flat=True).distinct())
+    for navigation in q.selector:
+        reached = roots
+        for name in navigation[:-1]:
+            relations = [rel for rel in relation_descriptions.get(name, {}).values() if rel[2] in reached]
+            if reached and not relations:
+                raise Exception("'%s' is not a valid relationship attribute" % name)
+            if not return_sensitive_data and any(rel[1] for rel in relations):
+                raise Exception('logged-in user has no access to field %s' % name)
+            reached = set(rel[3] for rel in relations)
+        if not return_sensitive_data and any(field[1] and field[2] in reached for field in field_descriptions.get(navigation[-1], {}).values()):
+            raise Exception('logged-in user has no access to field %s' % navigation[-1])
+
+
+def __instance_dict(ci):
+    compo = {}
+    compo['mage_id'] = ci.id
+    compo['mage_cic_id'] = ci.instanciates_id
+    compo['mage_deleted'] = ci.deleted
+    compo['mage_description_id'] = ci.description_id
+    compo['mage_description_name'] = ci.description.name
+    compo['mage_environments'] = ','.join([e.name for e in ci.environments.all()])
+
+    for fi in ci.field_set.all():
+        compo[fi.field.name] = fi.value
+
+    for fi in ci.rel_target_set.all():
+        key = fi.field.name + '_id'
+        if key in compo:
+            compo[key] = '%s,%s' % (compo[key], fi.target_id)
+        else:
+            compo[key] = fi.target_id
+    return compo
+
+
+def __resolve_selector(selector, instance_ids, return_sensitive_data, descriptions):
+    """
+        Values of the navigations of a selector for a chunk of instances, as a list of dicts (one per instance).
+        Navigations are walked level by level: the relationships of a level are loaded for all instances and all
+        navigations at once, as are the fields at the end of the navigations. Everything is then looked up inside
+        dicts indexed by instance id and name, so the cost is one query per level whatever the number of instances.
+        Each query only loads the rows needed: the descriptions named by the navigation, on the instances it reached.
+        Nothing is raised here, as the output may already be streaming: errors are found beforehand by __check_selector,
+        and a navigation through a relationship an instance does not have gives None.
+    """
+    paths = [tuple(navigation) for navigation in selector]
+    relation_descriptions, field_descriptions = descriptions
+    all_relations = dict(item for items in relation_descriptions.values() for item in items.items())
+    all_fields = dict(item for items in field_descriptions.values() for item in items.items())
+
+    ## reached[prefix] = {root instance id: id of the instance at the end of prefix}
+    reached = {(): dict((pk, pk) for pk in instance_ids)}
+    for level in range(1, max(len(path) for path in paths)):
+        prefixes = set(path[:level] for path in paths if len(path) > level)
+        if not prefixes:
+            continue
+        needed = [Q(source_id__in=set(pk for pk in reached[prefix[:-1]].values() if pk is not None), field_id__in=relation_descriptions[prefix[-1]])
+                  for prefix in prefixes if prefix[-1] in relation_descriptions]
+        relations = {}
+        if needed:
+            ## Sorted backwards so that the first relationship of each name wins
+            for source_id, field_id, target_id in ComponentInstanceRelation.objects.filter(reduce(operator.or_, needed)) \
+                    .annotate(mql_value=__hide_sensitive('target_id', all_relations, return_sensitive_data, IntegerField())) \
+                    .order_by('-id').values_list('source_id', 'field_id', 'mql_value'):
+                relations.setdefault(source_id, {})[all_relations[field_id][0]] = target_id
+
+        ## An instance without the relationship gives None, as do all the navigations going through it
+        for prefix in prefixes:
+            reached[prefix] = dict((root, relations.get(pk, {}).get(prefix[-1])) for root, pk in reached[prefix[:-1]].items())
+
+    ## The end of the line is always a value field (or a special key)
+    holders = {}
+    for path in paths:
+        holders.setdefault(path[-1], set()).update(reached[path[:-1]].values())
+    needed = [Q(instance_id__in=ids, field_id__in=field_descriptions[name]) for name, ids in holders.items() if name in field_descriptions]
+    fields = {}
+    if needed:
+        for instance_id, field_id, value in ComponentInstanceField.objects.filter(reduce(operator.or_, needed)) \
+                .annotate(mql_value=__hide_sensitive('value', all_fields, return_sensitive_data, CharField())) \
+                .order_by('id').values_list('instance_id', 'field_id', 'mql_value'):
+            fields.setdefault(instance_id, {})[all_fields[field_id][0]] = value
+    specials = __special_selector_values(holders)
 
-        return res
+    res = []
+    for root in instance_ids:
+        compo = {}
+        for path in paths:
+            pk = reached[path[:-1]][root]
+            try:
+                compo['_'.join(path)] = fields[pk][path[-1]]
+            except KeyError:
+                compo['_'.join(path)] = specials.get(path[-1], {}).get(pk)
+        res.append(compo)
+    return res
+
+
+def __hide_sensitive(column, descriptions, return_sensitive_data, output_field):
+    """
+        The column, or NULL for the rows of sensitive descriptions (inside {description id: (name, sensitive, ...)}) if they
+        cannot be returned. __check_selector already refused such selectors, this only makes sure their values are never loaded.
+    """
+    sensitive = [pk for pk, description in descriptions.items() if description[1]]
+    if return_sensitive_data or not sensitive:
+        return F(column)
+    return Case(When(field_id__in=sensitive, then=Value(None)), default=F(column), output_field=output_field)
+
+
+def __special_selector_values(holders):
+    """{special key: {instance id: value}} for the special keys (mage_id...) inside holders {name: instance ids}"""
+    res = {}
+    special = dict((name, __special_values[name]) for name in holders if name in __special_values)
+    if special:
+        instance_ids = set(pk for name in special for pk in holders[name])
+        for row in ComponentInstance.objects.filter(pk__in=instance_ids).values('pk', *set(special.values())):
+            for name, field in special.items():
+                res.setdefault(name, {})[row['pk']] = row[field]
+    if 'mage_environments' in holders:
+        envts = res['mage_environments'] = dict((pk, []) for pk in holders['mage_environments'])
+        for pk, name in ComponentInstance.environments.through.objects.filter(componentinstance_id__in=envts.keys()).order_by('id').values_list('componentinstance_id', 'environment__name'):
+            envts[pk].append(name)
+        for pk, envt_names in envts.items():
+            envts[pk] = ','.join(envt_names)
+    return res
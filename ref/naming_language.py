@@ -1,27 +1,57 @@
 # coding: utf-8
 
-from pyparsing import alphas, Group, nums, ZeroOrMore, Forward, QuotedString, \
-    Word, Suppress, Optional, Combine
+from uuid import uuid4
 
 from django.core.cache import cache
+from django.conf import settings
 
-def build_grammar():
-    expr = Forward()
+from ref.parse_cache import ParseCache
+from ref.parsing import ParseTree, Parser, Tokenizer, unquote
+from ref.exceptions import MageNamingLanguageSyntaxError
+
+class _Parser(Parser):
+    """
+        Recursive descent parser of naming language patterns. The syntax tree has an 'expr' element: the first operand
+        (a 'datatoken' - navigation, text or num - or a parenthesized 'expr') and a 'right_group' list of operands
+        which also have an 'operator'.
+    """
     # Our identifier definition is Python's one with the added constraint of not allowing underscores as first character.
-    identifier = Combine(Word(alphas, exact=1) + Optional(Word(nums + alphas + "_")))("identifier")
-    navigation = Group(identifier + ZeroOrMore(Suppress(".") + identifier))("navigation")
-    text = QuotedString('"', escQuote='""')("text")
-    numeric = Word(nums)('num')
-    operator = Word("?|+-/*", exact=1)("operator")
+    tokenizer = Tokenizer((('text', r'"(?:[^"\n\r]|"")*"'), ('identifier', r'[A-Za-z][A-Za-z0-9_]*'), ('num', r'[0-9]+'),
+                           ('operator', r'[?|+\-/*]'), ('symbol', r'[.()]')), MageNamingLanguageSyntaxError)
+    error_class = MageNamingLanguageSyntaxError
+
+    def pattern(self):
+        res = ParseTree(expr=self.expr())
+        self.expect('end', expected='end of pattern')
+        return res
 
-    datatoken = Group(navigation | text | numeric)('datatoken')
+    def expr(self):
+        res = self.operand(ParseTree())
+        res.right_group = []
+        while self.peek()[0] == 'operator':
+            res.right_group.append(self.operand(ParseTree(operator=self.next()[1])))
+        return res
 
-    # expr << Group(((datatoken | Suppress("(") + expr + Suppress(")")) + ZeroOrMore(Group(operator + (datatoken | Suppress("(") + expr + Suppress(")")))('operand'))('right_group')))("expr")
-    expr << Group(((datatoken | Suppress("(") + expr + Suppress(")")) + ZeroOrMore(Group(operator + (datatoken | Suppress("(") + expr + Suppress(")")))('operand'))('right_group')))("expr")
+    def operand(self, res):
+        kind, value, position = self.peek()
+        if kind == 'identifier':
+            navigation = [self.next()[1]]
+            while self.accept('symbol', '.'):
+                navigation.append(self.expect('identifier'))
+            res.datatoken = ParseTree(navigation=navigation)
+        elif kind == 'text':
+            res.datatoken = ParseTree(text=unquote(self.next()[1], '"'))
+        elif kind == 'num':
+            res.datatoken = ParseTree(num=self.next()[1])
+        elif self.accept('symbol', '('):
+            res.expr = self.expr()
+            self.expect('symbol', ')')
+        else:
+            self.fail('navigation, text, number or "("')
+        return res
 
-    return expr
 
-__grammar = build_grammar()  #.setDebug()
+parsed_patterns = ParseCache(lambda pattern: _Parser(pattern).pattern(), getattr(settings, 'MAGE_PARSE_CACHE_SIZE', 1000))
 
 def resolve(pattern, instance, field_id=None):
     # Always use the true Django object
@@ -32,7 +62,7 @@ def resolve(pattern, instance, field_id=None):
 
     # Cache?
     if field_id:
-        key = 'computed_%s_%s' % (field_id, instance.pk)
+        key = __cache_keys(field_id, (instance.pk,))[instance.pk]
         cached = cache.get(key)
         if cached:
             if cached == 'NonePpokiGFVGH':
@@ -40,8 +70,7 @@ def resolve(pattern, instance, field_id=None):
             else:
                 return cached
 
-    expression = parse(pattern)
-    res = __resolve_expr(expression.expr, instance)
+    res = compile_pattern(pattern)(instance)
     if field_id:
         if res is None:
             cache.set(key, 'NonePpokiGFVGH')
@@ -49,56 +78,251 @@ def resolve(pattern, instance, field_id=None):
             cache.set(key, res)
     return res
 
+def resolve_many(pattern, instances, field_id=None):
+    """
+        Same as resolve, but for many instances (or proxies, or ids) at once. Returns a dict {instance id: value}.
+        All the navigations of the pattern are loaded for the whole instance set with one query per navigation
+        level, then the pattern is evaluated in memory.
+    """
+    ids = []
+    for instance in instances:
+        try:
+            instance = instance._instance
+        except AttributeError:
+            pass
+        ids.append(getattr(instance, 'pk', instance))
+
+    res = {}
+    if field_id:
+        keys = __cache_keys(field_id, ids)
+        cached_values = cache.get_many(keys.values())
+        for pk, key in keys.items():
+            cached = cached_values.get(key)
+            if cached:
+                res[pk] = None if cached == 'NonePpokiGFVGH' else cached
+        ids = [pk for pk in ids if pk not in res]
+
+    f = compile_pattern(pattern)
+    contexts = preload_navigations(f.navigations, ids)
+    computed = dict((pk, f(contexts[pk])) for pk in ids)
+    res.update(computed)
+
+    if field_id and computed:
+        cache.set_many(dict((keys[pk], 'NonePpokiGFVGH' if value is None else value) for pk, value in computed.items()))
+    return res
+
+
+################################################################################
+## Cache generations
+################################################################################
+
+def __new_generation():
+    return uuid4().hex[:12]
+
+def generations(scopes):
+    """
+        Current generation of each given scope, as a dict {scope: generation}. Scopes are the field_id given to resolve
+        (e.g. 'id_12' for the self description of the description 12) and 'ci_<instance id>'.
+    """
+    keys = dict(('generation_%s' % scope, scope) for scope in scopes)
+    res = cache.get_many(keys.keys())
+    missing = dict((key, __new_generation()) for key in keys if key not in res)
+    if missing:
+        cache.set_many(missing, timeout=None)
+        res.update(missing)
+    return dict((keys[key], generation) for key, generation in res.items())
+
+def bump_generations(scopes):
+    """
+        Logically invalidates every cached value belonging to the given scopes, in a single cache call. Values cached
+        with an older generation are never read again and simply expire.
+    """
+    cache.set_many(dict(('generation_%s' % scope, __new_generation()) for scope in scopes), timeout=None)
+
+def __cache_keys(field_id, ids):
+    """{instance id: versioned cache key of the value of field_id for this instance}"""
+    gen = generations([field_id] + ['ci_%s' % pk for pk in ids])
+    return dict((pk, 'computed_%s_%s_%s_%s' % (field_id, pk, gen[field_id], gen['ci_%s' % pk])) for pk in ids)
+
 def parse(pattern):
-    """Parses the given pattern and throws an exception if it is wrong. Used to check patterns."""
-    return __grammar.parseString(pattern)
+    """Parses the given pattern and throws an exception if it is wrong. Used to check patterns. Results are cached."""
+    return parsed_patterns.get(pattern)
+
+def compile_pattern(pattern):
+    """
+        Returns the pattern compiled into a callable, which takes either a component instance (or its proxy) or a
+        preloaded context - a dict with navigation tuples as keys, e.g. {('group', 'name'): 'GEP_DEV1_01'} - and
+        returns the value of the pattern. The callable exposes the navigations used by the pattern in its
+        'navigations' attribute. Results are cached.
+    """
+    return compiled_patterns.get(pattern)
+
+
+################################################################################
+## Compilation
+################################################################################
+
+class _Constant(object):
+    """An operand whose value is known at compilation time"""
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, nav):
+        return self.value
+
+def __concat(left, right):
+    return "%s%s" % (left, right)
+
+__operators = {
+    '|': __concat,
+    '+': lambda left, right: int(left) + int(right),
+    '-': lambda left, right: int(left) - int(right),
+    '*': lambda left, right: int(left) * int(right),
+    '/': lambda left, right: int(left) / int(right),
+    '?': None, # alternative: not a binary function, handled inside the evaluation loop
+}
 
-def __resolve_datatoken(datatoken, instance):
-    res = ""
+def __compile(pattern):
+    navigations = set()
+    evaluate = __compile_expr(parse(pattern).expr, navigations)
 
+    if isinstance(evaluate, _Constant):
+        def run(instance):
+            return evaluate.value
+    else:
+        def run(instance):
+            if isinstance(instance, dict):
+                return evaluate(instance.get)
+            try:
+                instance = instance._instance
+            except AttributeError:
+                pass
+            return evaluate(lambda path: __resolve_navigation(path, instance))
+
+    run.pattern = pattern
+    run.navigations = frozenset(navigations)
+    return run
+
+def __compile_datatoken(datatoken, navigations):
     if datatoken.num:
-        res = int(datatoken.num)
+        return _Constant(int(datatoken.num))
     elif datatoken.text:
-        res = datatoken.text
+        return _Constant(datatoken.text)
     elif datatoken.navigation:
-        res = __resolve_navigation(datatoken.navigation, instance)
+        path = tuple(datatoken.navigation)
+        navigations.add(path)
+        return lambda nav: nav(path)
+    return _Constant("")
 
-    return res
-
-def __resolve_expr(e, instance):
+def __compile_operand(e, navigations):
     if e.expr:
-        left = __resolve_expr(e.expr)
-    else:
-        left = __resolve_datatoken(e.datatoken, instance)
+        return __compile_expr(e.expr, navigations)
+    return __compile_datatoken(e.datatoken, navigations)
 
-    if not e.right_group:
+def __compile_expr(e, navigations):
+    first = __compile_operand(e, navigations)
+    steps = []
+    for group in e.right_group or ():
+        operator = __operators[group.operator]
+        right = __compile_operand(group, navigations)
+
+        ## Constant folding of consecutive concatenations
+        if operator is __concat and isinstance(right, _Constant):
+            if not steps and isinstance(first, _Constant):
+                first = _Constant(__concat(first.value, right.value))
+                continue
+            if steps and steps[-1][0] is __concat and isinstance(steps[-1][1], _Constant):
+                steps[-1] = (__concat, _Constant(__concat(steps[-1][1].value, right.value)))
+                continue
+        steps.append((operator, right))
+
+    if not steps:
+        return first
+    steps = tuple(steps)
+
+    def evaluate(nav):
+        left = first(nav)
+        for operator, right in steps:
+            if operator is None:
+                if left:
+                    return left
+                right = right(nav)
+                if right:
+                    return right
+            else:
+                left = operator(left, right(nav))
         return left
 
-    for group in e.right_group:
-        operator = group.operator
-        if group.expr:
-            right = __resolve_expr(group.expr, instance)
-        else:
-            right = __resolve_datatoken(group.datatoken, instance)
-
-        if operator == "|":
-            left = "%s%s" % (left, right)
-        elif operator == "?":
-            if left :
-                return left
-            if right:
-                return right
-        elif operator == '+':
-            left = int(left) + int(right)
-        elif operator == '-':
-            left = int(left) - int(right)
-        elif operator == '*':
-            left = int(left) * int(right)
-        elif operator == '/':
-            left = int(left) / int(right)
-
-    return left
+    ## Constant folding of the whole expression
+    if isinstance(first, _Constant) and all(isinstance(right, _Constant) for operator, right in steps):
+        try:
+            return _Constant(evaluate(None))
+        except (ValueError, TypeError, ZeroDivisionError):
+            ## Let the error happen at evaluation time, as it would have without folding
+            pass
+    return evaluate
 
+compiled_patterns = ParseCache(__compile, getattr(settings, 'MAGE_PARSE_CACHE_SIZE', 1000))
+
+
+################################################################################
+## Navigation
+################################################################################
+
+def __chunks(ids, size=500):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def preload_navigations(paths, instance_ids):
+    """
+        Resolves the given navigations (tuples of names) for many component instances at once.
+        Returns a dict {instance id: {navigation: value}}, usable as a context by compiled patterns.
+        Issues one query per relationship level (all the relationships of a level are fetched together), plus one
+        query for the field values, whatever the number of instances (id lists are only split in chunks).
+    """
+    # Import here to avoid circular imports
+    from ref.models.instances import ComponentInstanceField, ComponentInstanceRelation
+
+    instance_ids = list(instance_ids)
+    contexts = dict((pk, {}) for pk in instance_ids)
+    if not paths or not instance_ids:
+        return contexts
+
+    ## reached[prefix] = {root instance id: [ids of the instances at the end of prefix]}
+    reached = {(): dict((pk, [pk]) for pk in instance_ids)}
+    depth = max(len(path) for path in paths)
+    for level in range(1, depth):
+        prefixes = set(path[:level] for path in paths if len(path) > level)
+        if not prefixes:
+            continue
+        sources = set(ci for prefix in prefixes for cis in reached[prefix[:-1]].values() for ci in cis)
+        names = set(prefix[-1] for prefix in prefixes)
+        targets = {}
+        for chunk in __chunks(sources):
+            for source_id, name, target_id in ComponentInstanceRelation.objects.filter(source_id__in=chunk, field__name__in=names).values_list('source_id', 'field__name', 'target_id'):
+                targets.setdefault((source_id, name), []).append(target_id)
+        for prefix in prefixes:
+            reached[prefix] = dict((root, [t for ci in cis for t in targets.get((ci, prefix[-1]), ())]) for root, cis in reached[prefix[:-1]].items())
+
+    ## Field values (a single query for all levels)
+    values = {}
+    names = set(path[-1] for path in paths if path[-1] != 'mage_id')
+    if names:
+        holders = set(ci for path in paths for cis in reached[path[:-1]].values() for ci in cis)
+        for chunk in __chunks(holders):
+            for instance_id, name, value in ComponentInstanceField.objects.filter(instance_id__in=chunk, field__name__in=names).values_list('instance_id', 'field__name', 'value'):
+                values.setdefault((instance_id, name), []).append(value)
+
+    ## As for single navigations, a navigation leading to more than one value has no value.
+    for path in paths:
+        for root, cis in reached[path[:-1]].items():
+            if path[-1] == 'mage_id':
+                found = cis
+            else:
+                found = [v for ci in cis for v in values.get((ci, path[-1]), ())]
+            contexts[root][path] = found[0] if len(found) == 1 else None
+    return contexts
 
 def __resolve_navigation(path, instance):
     ''' Will instanciate a pattern according to the value inside the given component instance'''
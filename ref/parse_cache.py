@@ -0,0 +1,63 @@
+# coding: utf-8
+'''
+    Bounded cache of parsed expressions (MQL queries, naming language patterns...), shared by all threads of a process.
+    @license: Apache License, Version 2.0
+'''
+
+## Python imports
+from collections import OrderedDict
+from threading import Lock
+
+
+class ParseCache(object):
+    """
+        LRU cache of parse results keyed on the source text. The parser is only called on a miss; parsing errors
+        are propagated to the caller and never cached. Parse results must be treated as read-only by callers, as
+        the same object is returned to everyone.
+    """
+
+    def __init__(self, parser, max_size=1000):
+        self.parser = parser
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__items = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, text):
+        with self.__lock:
+            try:
+                res = self.__items[text]
+                self.__items.move_to_end(text)
+                self.hits += 1
+                return res
+            except KeyError:
+                self.misses += 1
+
+        ## Parse outside the lock: two threads may parse the same text concurrently, which is harmless.
+        res = self.parser(text)
+
+        with self.__lock:
+            self.__items[text] = res
+            self.__items.move_to_end(text)
+            while len(self.__items) > self.max_size:
+                self.__items.popitem(last=False)
+                self.evictions += 1
+        return res
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, text):
+        return text in self.__items
+
+    def stats(self):
+        return {'size': len(self.__items), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
@@ -0,0 +1,125 @@
+# coding: utf-8
+'''
+    Common tools of the hand-written parsers of the MAGE languages (MQL, naming language): a regular expression based
+    tokenizer and a base class for recursive descent parsers.
+
+    Syntax trees are made of ParseTree nodes (named elements), lists (repeated elements) and strings (tokens), so that
+    they can be used the same way as pyparsing results, which they replace.
+
+    @license: Apache License, Version 2.0
+'''
+
+## Python imports
+import re
+
+
+class ParseTree(object):
+    """A node of a syntax tree. As with pyparsing results, absent elements are empty strings."""
+
+    def __init__(self, **elements):
+        self.__dict__.update(elements)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return ''
+
+    def __eq__(self, other):
+        return isinstance(other, ParseTree) and self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        return 'ParseTree(%s)' % ', '.join('%s=%r' % item for item in sorted(self.__dict__.items()))
+
+
+## Escaped whitespaces inside quoted strings are converted, as pyparsing did.
+__whitespace_escapes = ((r'\t', '\t'), (r'\n', '\n'), (r'\f', '\f'), (r'\r', '\r'))
+
+
+def unquote(token, quote):
+    """Content of a quoted string token, in which the quote character is escaped by doubling it"""
+    res = token[1:-1]
+    if '\\' in res:
+        for escape, char in __whitespace_escapes:
+            res = res.replace(escape, char)
+    return res.replace(quote * 2, quote)
+
+
+class Tokenizer(object):
+    """
+        Splits a text into (kind, value, position) tuples. token_types is a sequence of (kind, regular expression).
+        Whitespaces are ignored. Identifiers are their own kind - keywords are recognized by the parser.
+    """
+
+    def __init__(self, token_types, error_class):
+        self.regex = re.compile(r'\s*(?:%s)' % '|'.join('(?P<%s>%s)' % token_type for token_type in token_types))
+        self.error_class = error_class
+
+    def __call__(self, text):
+        tokens = []
+        position = 0
+        match = self.regex.match
+        end = len(text.rstrip())
+        while position < end:
+            m = match(text, position)
+            if m is None:
+                start = len(text) - len(text[position:].lstrip())
+                raise self.error_class('unexpected character %r (at char %s)' % (text[start], start))
+            tokens.append((m.lastgroup, m.group(m.lastgroup), m.start(m.lastgroup)))
+            position = m.end()
+        tokens.append(('end', '', len(text)))
+        return tokens
+
+
+class Parser(object):
+    """Base class of recursive descent parsers working on the tokens of a single text"""
+
+    tokenizer = None
+    error_class = Exception
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self.tokenizer(text)
+        self.position = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.position + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def is_keyword(self, keyword, offset=0):
+        kind, value, position = self.peek(offset)
+        return kind == 'identifier' and value.upper() == keyword
+
+    def accept(self, kind, value=None):
+        """Consumes the next token and returns its value if it has the given kind (and value), returns None otherwise"""
+        token_kind, token_value, position = self.tokens[self.position]
+        if token_kind != kind or (value is not None and token_value != value):
+            return None
+        self.position += 1
+        return token_value
+
+    def accept_keyword(self, *keywords):
+        """Consumes the given (case insensitive) keywords if they are next and returns True, returns False otherwise"""
+        for offset, keyword in enumerate(keywords):
+            if not self.is_keyword(keyword, offset):
+                return False
+        self.position += len(keywords)
+        return True
+
+    def expect(self, kind, value=None, expected=None):
+        res = self.accept(kind, value)
+        if res is None:
+            self.fail(expected or value or kind)
+        return res
+
+    def expect_keyword(self, *keywords):
+        if not self.accept_keyword(*keywords):
+            self.fail(' '.join(keywords))
+
+    def fail(self, expected):
+        kind, value, position = self.peek()
+        found = 'end of text' if kind == 'end' else repr(value)
+        raise self.error_class('expected %s, found %s (at char %s)' % (expected, found, position))
@@ -2,9 +2,9 @@
 
 function mage_query
 {
-    typeset query s arg ok tmpHeaders http_code headers
+    typeset query s arg ok tmpHeaders http_code headers data
     OPTIND=1
-    while getopts "q:s:" arg
+    while getopts "q:s:d:" arg
     do
         case ${arg} in
             q) # HTTP query. If relative, will be appended to $MAGE_BASE_URL
@@ -13,6 +13,9 @@ function mage_query
             s) # session id
                 s="$OPTARG"
                 ;;
+            d) # JSON data to POST (the query is a GET if not given)
+                data="$OPTARG"
+                ;;
             *)
                 return 1
                 ;;
@@ -38,7 +41,12 @@ function mage_query
     tmpHeaders=/tmp/t1_$$_$RANDOM
     rm -f $tmpHeaders >/dev/null 2>&1
 
-    wget -q -S --load-cookies=$s -O - "${query}" 2>${tmpHeaders}
+    if [[ "$data" == "" ]]
+    then
+        wget -q -S --load-cookies=$s -O - "${query}" 2>${tmpHeaders}
+    else
+        wget -q -S --load-cookies=$s --header="Content-Type: application/json" --post-data="${data}" -O - "${query}" 2>${tmpHeaders}
+    fi
     ok=$?
 
     http_code=$(($(cat $tmpHeaders | grep -v "302" | grep "HTTP/1" | cut -d' ' -f4)))
@@ -174,6 +182,47 @@ function mage_run_query
     return $ok
 }
 
+function mage_run_queries
+{
+    ## Runs many queries in a single call. Results of query n (from 0) are inside MAGE_RESULTS_n (instance ids) and
+    ## MAGE_RESULTS_n_COUNT, data of all instances inside MAGE_RESULTS_DATA[<id>_<attribute>]. Needs bash 4.
+    typeset s tmpFile arg ok query data
+    data=""
+    OPTIND=1
+    while getopts "q:s:" arg
+    do
+        case $arg in
+            q) # query (may be given many times)
+                query="${OPTARG//\\/\\\\}"
+                query="${query//\"/\\\"}"
+                data="${data}${data:+,}\"${query}\""
+                ;;
+            s) # session token
+                s="$OPTARG"
+                ;;
+            *)
+                return 1
+                ;;
+        esac
+    done
+
+    tmpFile="/tmp/tmpQuery_$$_$RANDOM"
+    mage_query -q "ref/mqlbatch/bash4" -d "[${data}]" -s $s >$tmpFile
+    ok=$?
+
+    if [[ $ok -ne 0 ]]
+    then
+        cat $tmpFile >&2
+        rm -f $tmpFile
+        return $ok
+    fi
+
+    . $tmpFile
+    rm -f $tmpFile
+
+    return $ok
+}
+
 function mage_run_csv_query
 {
     typeset s tmpFile arg ok query u
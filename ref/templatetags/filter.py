@@ -36,10 +36,6 @@ def ksh_protect_and_quote(value):
     res = ("%s" % value).replace('"', '\\"').replace('$', '\$')
     return ('"%s"' % res)
 
-@register.filter
-def apply_field_template(component_instance, computed_field):
-    return computed_field.resolve(component_instance)
-
 ''' Returns (field_descr, field_value_or_None). Single pass method. Both lists must be sorted beforehand. '''
 @register.filter
 def project_ci_fields(descriptions, instances):
@@ -0,0 +1,103 @@
+# coding: utf-8
+from threading import Thread, Event
+from unittest import mock
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http.response import StreamingHttpResponse
+from django.test import TestCase, RequestFactory
+
+from ref import coalescing
+from ref.coalescing import single_flight, coalesce_requests
+
+
+class CoalescingTestCase(TestCase):
+    def test_single_flight_threads(self):
+        calls = []
+        started = Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.3)
+            return b'result %d' % len(calls)
+
+        results = []
+        leader = Thread(target=lambda: results.append(single_flight('marsu', compute)))
+        leader.start()
+        started.wait()
+        followers = [Thread(target=lambda: results.append(single_flight('marsu', compute))) for i in range(10)]
+        for t in followers:
+            t.start()
+        for t in [leader] + followers:
+            t.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([b'result 1'] * 11, results)
+
+        ## Calls after the end of the computation compute again
+        self.assertEqual(b'result 2', single_flight('marsu', compute))
+
+    def test_single_flight_failure(self):
+        def fail():
+            time.sleep(0.2)
+            raise Exception('marsupilami')
+
+        errors = []
+        def run():
+            try:
+                single_flight('houba', fail)
+            except Exception:
+                errors.append(1)
+        leader = Thread(target=run)
+        leader.start()
+        time.sleep(0.05)
+
+        ## A waiting call computes by itself when the computation it waited for fails
+        self.assertEqual('ok', single_flight('houba', lambda: 'ok'))
+        leader.join()
+        self.assertEqual([1], errors)
+
+    def test_single_flight_processes(self):
+        ## Another process computes the result
+        cache.set('coalescing_lock_hop', 'other', 10)
+        def publish():
+            time.sleep(0.2)
+            cache.set('coalescing_result_other', 'from another process', 10)
+        Thread(target=publish).start()
+        self.assertEqual('from another process', single_flight('hop', lambda: 'computed'))
+
+        ## The other process failed
+        cache.delete('coalescing_result_other')
+        Thread(target=lambda: (time.sleep(0.2), cache.delete('coalescing_lock_hop'))).start()
+        self.assertEqual('computed', single_flight('hop', lambda: 'computed'))
+
+    def test_big_streamed_response(self):
+        calls = []
+        @coalesce_requests
+        def view(request):
+            calls.append(1)
+            return StreamingHttpResponse(b'%d' % i * 10 for i in range(5))
+
+        def get():
+            request = RequestFactory().get('/marsu')
+            request.user = AnonymousUser()
+            return view(request)
+
+        with mock.patch.object(coalescing, 'MAX_SIZE', 25):
+            response = get()
+            flight = next(iter(coalescing._flights.values()))
+            content = iter(response.streaming_content)
+            self.assertEqual(b'0' * 10, next(content))
+            self.assertFalse(flight.done.is_set())
+
+            ## Over the limit: still streamed, but not shared
+            self.assertEqual([b'1' * 10, b'2' * 10, b'3' * 10, b'4' * 10], list(content))
+            self.assertTrue(flight.done.is_set())
+            self.assertIsNone(flight.result)
+            self.assertIsNone(cache.get('coalescing_result_%s' % flight.id))
+
+            ## The next identical request computes its own response
+            self.assertEqual(b''.join(b'%d' % i * 10 for i in range(5)), b''.join(get().streaming_content))
+            self.assertEqual(2, len(calls))
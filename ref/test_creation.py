@@ -1,7 +1,11 @@
 # coding: utf-8
 from django.test import TestCase
 from ref.demo_items import utility_create_meta
-from ref.models import ImplementationDescription, Environment, EnvironmentType, Project, Application
+from django.db import IntegrityError, transaction, connection
+from django.test.utils import CaptureQueriesContext
+from ref.models import ImplementationDescription, Environment, EnvironmentType, Project, Application, ConventionCounter
+from ref import mql
+from ref.conventions import compiled_patterns, value_instances_fields_bulk, value_instances_graph_fields_bulk
 
 class Creation(TestCase):
     def setUp(self):
@@ -62,3 +66,105 @@ class Creation(TestCase):
         self.assertEqual("10", jas.port_shift)
 
 
+
+    def test_compiled_pattern(self):
+        self.assertEqual(('User', ('name', 'E~'), ('counter', 'cem', True, None), '_', ('counter', 'cg', False, '3'), '%zz%', ('name', 'd')),
+                         compiled_patterns.get('User%E~%%cem%_%cg~3%%zz%%d%'))
+        self.assertEqual(('50%',), compiled_patterns.get('50%'))
+
+    def test_counter_reservation(self):
+        counter = ConventionCounter.objects.get_for_scope(environment=self.e1, type=ImplementationDescription.objects.get(name='oracleschema'))
+        self.assertEqual(counter.pk, ConventionCounter.objects.get_for_scope(environment=self.e1.pk, type=counter.scope_type_id).pk)
+        self.assertEqual(1, counter.reserve(10))
+        self.assertEqual(10, counter.val)
+        self.assertEqual(11, ConventionCounter.objects.get(pk=counter.pk).reserve())
+
+        ## A scope has a single counter
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ConventionCounter(scope_environment=self.e1, scope_type=counter.scope_type).save()
+
+    def test_bulk_valuation(self):
+        schema_class = ImplementationDescription.class_for_name('oracleschema')
+        queries = []
+        names = []
+        for count in (1, 3, 6):
+            schemas = [schema_class(instance=self.i2_1, _env=self.e1, _noconventions=True) for i in range(count)]
+            with CaptureQueriesContext(connection) as ctx:
+                value_instances_fields_bulk(schemas)
+                value_instances_graph_fields_bulk(schemas)
+            queries.append(len(ctx.captured_queries))
+            names.extend(schema.name for schema in schemas)
+
+        ## Same number of queries whatever the number of instances (once the counter exists), same values as one by one
+        self.assertEqual(queries[1], queries[2])
+        self.assertEqual(['UserDev1%02ds%s' % (i, i) for i in range(1, 11)], names)
+
+        ## Only missing values unless forced
+        value_instances_fields_bulk(schemas)
+        self.assertEqual('UserDev110s10', schemas[-1].name)
+        value_instances_fields_bulk(schemas[-1:], force=True)
+        schemas[-1].refresh()
+        self.assertEqual('UserDev111s11', schemas[-1].name)
+
+    def test_bulk_create_instances(self):
+        descr = ImplementationDescription.objects.get(name='oracleschema')
+        queries = []
+        for count in (1, 3, 6):
+            with CaptureQueriesContext(connection) as ctx:
+                schemas = descr.bulk_create_instances([{'instance': self.i2_1, 'password': 'pwd%s' % i} for i in range(count)], env=self.e1)
+            queries.append(len(ctx.captured_queries))
+        ## Instances are inserted one by one when the database does not give back the primary keys of bulk inserts
+        self.assertEqual(queries[1] + (0 if connection.features.can_return_rows_from_bulk_insert else 3), queries[2])
+
+        self.assertEqual(['UserDev1%02ds%s' % (i, i) for i in range(5, 11)], [schema.name for schema in schemas])
+        self.assertEqual('pwd5', schemas[-1].password)
+        self.assertEqual(self.i2_1._instance, schemas[-1].instance)
+        self.assertEqual([self.e1], list(schemas[-1]._instance.environments.all()))
+        self.assertEqual(10, len(mql.run("SELECT 'oracleschema' INSTANCES WHERE name='%ev1%'")))
+
+        with self.assertRaises(AttributeError):
+            descr.bulk_create_instances([{'marsupilami': 'houba'}], env=self.e1)
+
+    def test_proxy_snapshot(self):
+        domain = ImplementationDescription.class_for_name('jbossdomain')(base_instance=self.i4_1._instance, _noconventions=True)
+
+        ## All values (fields and single relationships) are read at once
+        with self.assertNumQueries(2):
+            self.assertEqual('8080', domain.base_http_port)
+            self.assertEqual('9990', domain.web_admin_port)
+            self.assertEqual('admin', domain.admin_user)
+        host = ImplementationDescription.class_for_name('jbosshost')(base_instance=self.i5_1._instance, _noconventions=True)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.i1_1._instance, host.server)
+            self.assertEqual(self.i4_1._instance, host.domain)
+
+        ## Writes go to the database at once
+        domain.admin_user = 'root'
+        other = ImplementationDescription.class_for_name('jbossdomain')(base_instance=self.i4_1._instance, _noconventions=True)
+        self.assertEqual('root', other.admin_user)
+
+        ## Buffered writes are only visible to others at the end of the block
+        with domain.buffered(), host.buffered():
+            with self.assertNumQueries(0):
+                domain.base_http_port = 8180
+                domain.admin_user = 'admin'
+                host.server = self.i1_2
+                self.assertEqual('8180', domain.base_http_port)
+                self.assertEqual(self.i1_2._instance, host.server)
+            self.assertEqual('root', other.admin_user)
+            self.assertEqual(self.i1_1._instance, ImplementationDescription.class_for_name('jbosshost')(base_instance=self.i5_1._instance, _noconventions=True).server)
+        self.assertEqual('root', other.admin_user)
+        other.refresh()
+        self.assertEqual('8180', other.base_http_port)
+        self.assertEqual('admin', other.admin_user)
+        self.assertEqual('8180', domain.base_http_port)
+        self.assertEqual(self.i1_2._instance, ImplementationDescription.class_for_name('jbosshost')(base_instance=self.i5_1._instance, _noconventions=True).server)
+
+        ## Buffered writes are dropped if the block fails
+        with self.assertRaises(ValueError):
+            with domain.buffered():
+                domain.admin_user = 'nobody'
+                raise ValueError()
+        self.assertEqual('admin', domain.admin_user)
+        domain.refresh()
+        self.assertEqual('admin', domain.admin_user)
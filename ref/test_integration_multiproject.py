@@ -38,4 +38,31 @@ class TestIntegrationMultiproject(TestCase):
 
         if response.context['cis'] is not None:
             for prj in Project.objects.filter(environment__component_instances__id__in=(ci.id for ci in response.context['cis']), name=self.project):
-                self.assertEquals(prj.name, self.project)
\ No newline at end of file
+                self.assertEquals(prj.name, self.project)
+
+    def test_view_ref_envt(self):
+        self.client.login(username=self.rootUsername, password=self.rootPassword)
+        envt = Project.objects.get(name=self.project).environment_set.get(name='DEV1')
+        response = self.client.get(reverse('ref:envt', args=[self.project, envt.pk]))
+        self.assertEqual(200, response.status_code)
+
+        self.assertTrue(any(ci.computed_values for ci in response.context['cis']))
+        for ci in response.context['cis']:
+            self.assertEqual([cf.resolve(ci) for cf in ci.description.computed_field_set.all()], ci.computed_values)
+
+    def test_view_ref_envt_sensitive(self):
+        envt = Project.objects.get(name=self.project).environment_set.get(name='DEV1')
+        envt.show_sensitive_data = False
+        envt.save()
+        self.create_user('reader', 'password')
+
+        self.client.login(username=self.rootUsername, password=self.rootPassword)
+        response = self.client.get(reverse('ref:envt', args=[self.project, envt.pk]))
+        self.assertTrue(any(fi.field.sensitive for ci in response.context['cis'] for fi in ci.field_set.all()))
+
+        self.client.login(username='reader', password='password')
+        response = self.client.get(reverse('ref:envt', args=[self.project, envt.pk]))
+        self.assertEqual(200, response.status_code)
+        for ci in response.context['cis']:
+            self.assertFalse(any(fi.field.sensitive for fi in ci.field_set.all()))
+            self.assertFalse(any(cf.sensitive for cf in ci.description.computed_field_set.all()))
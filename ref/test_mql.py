@@ -1,9 +1,16 @@
 # coding: utf-8
 from django.test import TestCase
 from ref.demo_items import utility_create_meta, utility_create_logical
-from ref.models import ImplementationDescription, Environment, EnvironmentType, ComponentInstance, Project
+from ref.models import ImplementationDescription, Environment, EnvironmentType, ComponentInstance, Project, ComponentInstanceComputedValue
 from ref import mql
+from ref.exceptions import MageMclSyntaxError
 from django.db.models import Q
+from django.test import Client
+from django.urls import reverse
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import json
 
 
 class MQLTestCase(TestCase):
@@ -91,6 +98,25 @@ class MQLTestCase(TestCase):
         self.assertEqual(1, len(res))
         self.assertEqual(res[0]['name'], 'GEP_DEV1_01_03')
 
+    def test_query_selector_deep(self):
+        query = "SELECT name, mage_id, host.server.dns, group.domain.mage_id, group.domain.name, group.mage_description_name FROM 'jbossas' INSTANCES ORDER BY name"
+        res = mql.run(query)
+        self.assertEqual(4, len(res))
+        for compo in res:
+            instance = ComponentInstance.objects.get(pk=compo['mage_id']).proxy
+            self.assertEqual(instance.name, compo['name'])
+            self.assertEqual(instance.host.proxy.server.proxy.dns, compo['host_server_dns'])
+            self.assertEqual(instance.group.proxy.domain.pk, compo['group_domain_mage_id'])
+            self.assertEqual('domain1', compo['group_domain_name'])
+            self.assertEqual('jbossgroup', compo['group_mage_description_name'])
+
+        ## Descriptions (2 queries), their check, ids, one query per relationship level, fields, special keys
+        cache.clear()
+        with self.assertNumQueries(8):
+            mql.run(query)
+
+        self.assertRaises(Exception, mql.run, "SELECT name, marsupilami.name FROM 'jbossas' INSTANCES")
+
     def Xtest_query_db_impact(self):
         self.assertNumQueries(0, lambda : mql.run("SELECT INSTANCES where name='GEP_DEV1_01_03'", Project.objects.get(name='SUPER-PROJECT')))
         self.assertNumQueries(1, lambda : mql.run("SELECT INSTANCES where name='GEP_DEV1_01_03'", Project.objects.get(name='SUPER-PROJECT')).count())
@@ -103,3 +129,375 @@ class MQLTestCase(TestCase):
         res = mql.run("SELECT 'jbossas' INSTANCES where group.name=(SELECT name FROM INSTANCES WHERE name='GEP_DEV1_02')", Project.objects.get(name='SUPER-PROJECT'))
         self.assertEqual(1, len(res))
         self.assertEqual(self.i15_2_1._instance.id, res[0]['mage_id'])
+
+    def test_query_where_subquery_in(self):
+        res = mql.run("SELECT 'jbossas' INSTANCES WHERE group.name IN (SELECT name FROM 'jbossgroup' INSTANCES WHERE domain.name='domain1')")
+        self.assertEqual(4, len(res))
+
+        res = mql.run("SELECT 'jbossas' INSTANCES WHERE host._id IN (SELECT 'jbosshost' INSTANCES WHERE server.dns='server1.marsu.net')")
+        self.assertEqual(set((self.i15_1_1._instance.id, self.i15_1_2._instance.id, self.i15_2_1._instance.id)), set(r['mage_id'] for r in res))
+
+        res = mql.run("SELECT 'jbossas' INSTANCES WHERE mage_id IN (SELECT host.mage_id FROM 'jbossas' INSTANCES WHERE name='GEP_DEV1_01_03')")
+        self.assertEqual([], res)
+
+        ## Whatever the number of values, the subquery is part of the main statement
+        with self.assertNumQueries(1):
+            self.assertEqual([{'mage_count': 3}], mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES WHERE host.server._id IN (SELECT 'osserver' INSTANCES WHERE dns='server1.marsu.net')"))
+
+        self.assertRaises(Exception, mql.run, "SELECT 'jbossas' INSTANCES WHERE name IN (SELECT name, dns FROM INSTANCES)")
+
+        ## Subqueries are not sorted, and cannot be limited
+        with CaptureQueriesContext(connection) as ctx:
+            mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES WHERE group._id IN (SELECT 'jbossgroup' INSTANCES ORDER BY name)")
+        self.assertEqual(0, ctx.captured_queries[0]['sql'].count('ORDER BY'))
+        self.assertRaises(MageMclSyntaxError, mql.run, "SELECT 'jbossas' INSTANCES WHERE group.name IN (SELECT name FROM 'jbossgroup' INSTANCES LIMIT 1)")
+        self.assertRaises(MageMclSyntaxError, mql.run, "SELECT 'jbossas' INSTANCES WHERE mage_backup IN (SELECT name FROM 'jbossgroup' INSTANCES)")
+
+    def test_query_computations(self):
+        res = mql.run("SELECT 'jbossas' INSTANCES WITH COMPUTATIONS", Project.objects.get(name='SUPER-PROJECT'))
+        self.assertEqual(4, len(res))
+        for compo in res:
+            ci = ComponentInstance.objects.get(pk=compo['mage_id'])
+            for cf in ci.description.computed_field_set.all():
+                self.assertEqual(cf.resolve(ci), compo[cf.name])
+
+    def test_query_computations_batched(self):
+        ## All the computed fields of all the instances are loaded and computed together
+        def queries(query):
+            ComponentInstanceComputedValue.objects.all().delete()
+            cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                res = mql.run(query, Project.objects.get(name='SUPER-PROJECT'))
+            return len(captured), res
+        one, res = queries("SELECT 'jbossas' INSTANCES WHERE name='GEP_DEV1_01_01' WITH COMPUTATIONS")
+        self.assertEqual(1, len(res))
+        many, res = queries("SELECT 'jbossas' INSTANCES WITH COMPUTATIONS")
+        self.assertEqual(4, len(res))
+        self.assertEqual(one, many)
+        self.assertEqual(4 * 3, ComponentInstanceComputedValue.objects.count())
+
+    def test_sensitive_data(self):
+        query = "SELECT 'jbossgroup' INSTANCES WHERE name='GEP_DEV1_01' WITH COMPUTATIONS"
+        res = mql.run(query)[0]
+        self.assertEqual('GEP_DEV1_01', res['name'])
+        self.assertNotIn('dedicated_admin_password', res)
+        self.assertNotIn('admin_password', res)
+        self.assertNotIn('dedicated_admin_password', mql.columns(query))
+        self.assertNotIn('admin_password', mql.columns(query))
+
+        res = mql.run(query, True)[0]
+        self.assertEqual('dev1', res['dedicated_admin_password'])
+        self.assertEqual('dev1', res['admin_password'])
+
+        self.assertRaises(Exception, mql.run, "SELECT name, dedicated_admin_password FROM 'jbossgroup' INSTANCES")
+        self.assertEqual([{'name': 'GEP_DEV1_01', 'dedicated_admin_password': 'dev1'}],
+                         mql.run("SELECT name, dedicated_admin_password FROM 'jbossgroup' INSTANCES WHERE name='GEP_DEV1_01'", True))
+
+    def test_query_parse_cache(self):
+        mql.parsed_queries.clear()
+        mql.run("SELECT INSTANCES where name='GEP_DEV1_01_03'", Project.objects.get(name='SUPER-PROJECT'))
+        mql.run("SELECT INSTANCES where name='GEP_DEV1_01_03'", Project.objects.get(name='SUPER-PROJECT'))
+        self.assertEqual(1, mql.parsed_queries.misses)
+        self.assertEqual(1, mql.parsed_queries.hits)
+
+    def test_parse(self):
+        parsed = mql.parse("explain select name, jboss_host.name from environment 'DEV1' lc 'web application EE6' 'jbossas' instances "
+                           "where jboss_host.name='it''s' and mage_id in (select mage_id from instances) order by name desc, dns limit 10 after 'WzFd'")
+        self.assertEqual('EXPLAIN', parsed.explain)
+        q = parsed.select
+        self.assertEqual([['name'], ['jboss_host', 'name']], q.selector)
+        self.assertEqual(('DEV1', 'web application EE6', 'jbossas', '', ''), (q.envt, q.lc, q.impl, q.cic, q.prj))
+        self.assertEqual(['jboss_host', 'name'], q.where[0].navigation)
+        self.assertEqual("it's", q.where[0].value)
+        self.assertEqual([['mage_id']], q.where[1].subquery.selector)
+        self.assertEqual([(['name'], 'DESC'), (['dns'], '')], [(item.navigation, item.direction) for item in q.order])
+        self.assertEqual(('10', 'WzFd', ''), (q.limit, q.after, q.compute))
+
+        q = mql.parse("SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY group.name, name").select
+        self.assertEqual('*', q.count)
+        self.assertEqual([['group', 'name'], ['name']], q.group)
+        self.assertEqual('', q.selector)
+
+        ## Keywords are only keywords where they are expected
+        self.assertEqual([['count']], mql.parse("SELECT count FROM INSTANCES").select.selector)
+
+    def test_parse_errors(self):
+        for query in ("SELECT", "SELECT INSTANCES WHERE name='a", "SELECT INSTANCES WHERE name='a' OR dns='b'", "SELECT INSTANCES LIMIT 10 LIMIT 3",
+                      "SELECT name, FROM INSTANCES", "SELECT INSTANCES WHERE name IN 'a'", "SELECT INSTANCES #"):
+            self.assertRaises(MageMclSyntaxError, mql.parse, query)
+
+    def test_query_no_duplicates(self):
+        ## Multi-valued navigations (environments, fields, relations) must not multiply result rows
+        e2 = Environment(name='DEV2', description='DEV2', typology=EnvironmentType.objects.get(short_name='DEV'), project=Project.objects.get(name='SUPER-PROJECT'))
+        e2.save()
+        self.i15_1_3._instance.environments.add(e2)
+
+        res = mql.run("SELECT PROJECT 'SUPER-PROJECT' ENVIRONMENT 'DEV1' 'jbossas' INSTANCES WHERE group.name='GEP_DEV1_01' AND host.server.dns='server2.marsu.net' AND name='%DEV1%'", Project.objects.get(name='SUPER-PROJECT'))
+        self.assertEqual(1, len(res))
+        self.assertEqual(self.i15_1_3._instance.id, res[0]['mage_id'])
+
+    def test_query_same_results_as_joins(self):
+        ## The EXISTS compilation must return the same instances as the equivalent join-based ORM filters
+        queries = (
+            ("SELECT INSTANCES where name='GEP_DEV1_01_03'",
+             ComponentInstance.objects.filter(deleted=False, field_set__field__name='name', field_set__value='GEP_DEV1_01_03')),
+            ("SELECT INSTANCES where name='GEP_DEV1_0%'",
+             ComponentInstance.objects.filter(deleted=False, field_set__field__name='name', field_set__value__startswith='GEP_DEV1_0')),
+            ("SELECT INSTANCES where name='%.marsu.net'",
+             ComponentInstance.objects.filter(deleted=False, field_set__field__name='name', field_set__value__endswith='.marsu.net')),
+            ("SELECT INSTANCES where name='%DEV1_01%'",
+             ComponentInstance.objects.filter(deleted=False, field_set__field__name='name', field_set__value__contains='DEV1_01')),
+            ("SELECT INSTANCES where name='%01%'",
+             ComponentInstance.objects.filter(deleted=False, field_set__field__name='name', field_set__value__contains='01')),
+            ("SELECT 'jbossas' INSTANCES where group.name='GEP_DEV1_01'",
+             ComponentInstance.objects.filter(deleted=False, description__name='jbossas', rel_target_set__field__name='group', rel_target_set__target__field_set__field__name='name', rel_target_set__target__field_set__value='GEP_DEV1_01')),
+            ("SELECT INSTANCES where group.domain.name='domain1'",
+             ComponentInstance.objects.filter(deleted=False, rel_target_set__field__name='group', rel_target_set__target__rel_target_set__field__name='domain',
+                                              rel_target_set__target__rel_target_set__target__field_set__field__name='name', rel_target_set__target__rel_target_set__target__field_set__value='domain1')),
+            ("SELECT INSTANCES where host.server.dns='server1.marsu.net' and port_shift='0'",
+             ComponentInstance.objects.filter(deleted=False, rel_target_set__field__name='host', rel_target_set__target__rel_target_set__field__name='server',
+                                              rel_target_set__target__rel_target_set__target__field_set__field__name='dns', rel_target_set__target__rel_target_set__target__field_set__value='server1.marsu.net').
+                                       filter(field_set__field__name='port_shift', field_set__value='0')),
+            ("SELECT INSTANCES where group._id='%s'" % self.i14_1._instance.id,
+             ComponentInstance.objects.filter(deleted=False, rel_target_set__field__name='group', rel_target_set__target_id=self.i14_1._instance.id)),
+            ("SELECT ENVIRONMENT 'DEV1' INSTANCES",
+             ComponentInstance.objects.filter(deleted=False, environments__name='DEV1')),
+        )
+        for query, expected in queries:
+            res = mql.run(query, Project.objects.get(name='SUPER-PROJECT'))
+            self.assertEqual(len(res), len(set(r['mage_id'] for r in res)), query)
+            self.assertEqual(set(expected.values_list('id', flat=True)), set(r['mage_id'] for r in res), query)
+            self.assertTrue(len(res) > 0, query)
+
+    def test_query_wildcards(self):
+        ## Trigrams and reversed values follow the changes of the values
+        self.i15_1_1.name = 'GEP_DEV1_01_XYZ'
+        self.i15_1_1.save()
+        def names(query):
+            return set(r['name'] for r in mql.run(query, Project.objects.get(name='SUPER-PROJECT')))
+        self.assertEqual({'GEP_DEV1_01_XYZ'}, names("SELECT 'jbossas' INSTANCES where name='%01_X%'"))
+        self.assertEqual({'GEP_DEV1_01_XYZ'}, names("SELECT 'jbossas' INSTANCES where name='%_XYZ'"))
+        self.assertEqual({'GEP_DEV1_01_02', 'GEP_DEV1_01_03'}, names("SELECT 'jbossas' INSTANCES where name='%DEV1_01_0%'"))
+        self.assertEqual(set(), names("SELECT 'jbossas' INSTANCES where name='%01_01%'"))
+        self.assertEqual({'GEP_DEV1_02_01'}, names("SELECT 'jbossas' INSTANCES where name='%_01'"))
+
+    def test_query_order_by(self):
+        res = mql.run("SELECT 'jbossas' INSTANCES ORDER BY name DESC")
+        self.assertEqual(['GEP_DEV1_02_01', 'GEP_DEV1_01_03', 'GEP_DEV1_01_02', 'GEP_DEV1_01_01'], [r['name'] for r in res])
+
+        res = mql.run("SELECT name, group.name FROM 'jbossas' INSTANCES ORDER BY group.name DESC, name")
+        self.assertEqual(['GEP_DEV1_02_01', 'GEP_DEV1_01_01', 'GEP_DEV1_01_02', 'GEP_DEV1_01_03'], [r['name'] for r in res])
+
+        res = mql.run("SELECT name, host.server.dns FROM 'jbossas' INSTANCES ORDER BY host.server.dns DESC, mage_id")
+        self.assertEqual(['server2.marsu.net', 'server1.marsu.net', 'server1.marsu.net', 'server1.marsu.net'], [r['host_server_dns'] for r in res])
+        self.assertEqual(['GEP_DEV1_01_03', 'GEP_DEV1_01_01', 'GEP_DEV1_01_02', 'GEP_DEV1_02_01'], [r['name'] for r in res])
+
+    def test_query_limit_after(self):
+        query = "SELECT 'jbossas' INSTANCES ORDER BY group.name DESC, name LIMIT 3"
+        expected = [r['name'] for r in mql.run("SELECT 'jbossas' INSTANCES ORDER BY group.name DESC, name")]
+
+        page = mql.iterate(query)
+        self.assertEqual(expected[:3], [r['name'] for r in page])
+        self.assertIsNotNone(page.cursor)
+
+        page = mql.iterate(query + " AFTER '%s'" % page.cursor)
+        self.assertEqual(expected[3:], [r['name'] for r in page])
+        self.assertIsNone(page.cursor)
+
+        self.assertRaises(Exception, mql.run, "SELECT 'jbossas' INSTANCES ORDER BY name LIMIT 3 AFTER 'marsu'")
+
+        response = Client().get(reverse('ref:mqlquery', args=['json', query]))
+        content = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(expected[:3], [r['name'] for r in content['results']])
+        self.assertEqual(expected[3:], [r['name'] for r in mql.run(query + " AFTER '%s'" % content['cursor'])])
+
+    def test_query_limit_after_nullable_key(self):
+        ## Only GEP_DEV1_APP1 has a CIC: instances without one are not lost between pages
+        query = "SELECT name FROM INSTANCES ORDER BY mage_cic_id, mage_id LIMIT 3"
+        expected = mql.run(query.replace(' LIMIT 3', ''))
+        self.assertEqual('GEP_DEV1_APP1', expected[-1]['name'])
+        res, cursor = [], None
+        while True:
+            page = mql.iterate(query + (" AFTER '%s'" % cursor if cursor else ''))
+            res.extend(page)
+            cursor = page.cursor
+            if not cursor:
+                break
+        self.assertEqual(expected, res)
+
+    def test_query_count(self):
+        self.assertEqual([{'mage_count': 4}], mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES"))
+        self.assertEqual([{'mage_count': 3}], mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES WHERE group.name='GEP_DEV1_01'"))
+
+        res = mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY group.name")
+        self.assertEqual([{'group_name': 'GEP_DEV1_01', 'mage_count': 3}, {'group_name': 'GEP_DEV1_02', 'mage_count': 1}], res)
+
+        res = mql.run("SELECT COUNT(*) FROM INSTANCES GROUP BY mage_description_name, host.server.dns")
+        self.assertIn({'mage_description_name': 'jbossas', 'host_server_dns': 'server1.marsu.net', 'mage_count': 3}, res)
+        self.assertIn({'mage_description_name': 'jbossas', 'host_server_dns': 'server2.marsu.net', 'mage_count': 1}, res)
+        self.assertEqual(ComponentInstance.objects.filter(deleted=False).count(), sum(r['mage_count'] for r in res))
+        self.assertEqual(['mage_description_name', 'host_server_dns', 'mage_count'], mql.columns("SELECT COUNT(*) FROM INSTANCES GROUP BY mage_description_name, host.server.dns"))
+
+        ## The relationship descriptions, then the count itself
+        with self.assertNumQueries(2):
+            mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY group.domain.name, host.server.dns")
+
+        self.assertRaises(Exception, mql.run, "SELECT 'jbossas' INSTANCES GROUP BY group.name")
+
+        ## Instances are counted in all their environments
+        e2 = Environment(name='DEV2', description='DEV2', typology=EnvironmentType.objects.get(short_name='DEV'), project=Project.objects.get(name='SUPER-PROJECT'))
+        e2.save()
+        self.i15_1_3._instance.environments.add(e2)
+        self.i15_2_1._instance.environments.add(e2)
+        res = mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY mage_environments")
+        self.assertEqual([{'mage_environments': None, 'mage_count': 2}, {'mage_environments': 'DEV1', 'mage_count': 1},
+                          {'mage_environments': 'DEV2', 'mage_count': 2}], res)
+
+        ## Relationships with many targets cannot be used
+        jbossas = ImplementationDescription.objects.get(name='jbossas')
+        link_type = jbossas.target_set.get(name='group').link_type
+        jbossas.add_relationship('groups', 'other groups', ImplementationDescription.objects.get(name='jbossgroup'), link_type, 0, None)
+        self.assertRaises(MageMclSyntaxError, mql.run, "SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY groups.name")
+        self.assertRaises(MageMclSyntaxError, mql.run, "SELECT COUNT(*) FROM INSTANCES GROUP BY groups.domain.name")
+        self.assertEqual(4, sum(r['mage_count'] for r in mql.run("SELECT COUNT(*) FROM 'jbossas' INSTANCES GROUP BY group.domain.name")))
+
+    def test_result_cache(self):
+        query = "SELECT 'jbossas' INSTANCES WHERE group.name='GEP_DEV1_02'"
+        res = mql.run(query)
+        with self.assertNumQueries(0):
+            self.assertEqual(res, mql.run(query))
+            self.assertEqual(res, mql.run("  SELECT 'jbossas'\tINSTANCES   WHERE group.name='GEP_DEV1_02' "))
+        self.assertEqual([], mql.run("SELECT 'jbossas' INSTANCES WHERE group.name='GEP_DEV1_02 '"))
+
+        ## Any change of the referential invalidates the results
+        self.i15_2_1.name = 'GEP_DEV1_02_99'
+        self.i15_2_1.save()
+        self.assertEqual(['GEP_DEV1_02_99'], [r['name'] for r in mql.run(query)])
+
+        self.assertEqual(1, len(mql.run("SELECT environment 'DEV1' 'jbossas' INSTANCES")))
+        self.i15_1_1._instance.environments.add(Environment.objects.get(name='DEV1'))
+        self.assertEqual(2, len(mql.run("SELECT environment 'DEV1' 'jbossas' INSTANCES")))
+
+        ## Including the names used by the pre-filters
+        self.assertEqual(1, len(mql.run("SELECT offer 'soft1_webapp_ee6_jboss' INSTANCES")))
+        cic = self.i16_1._instance.instanciates
+        cic.name = 'soft1_webapp_ee6_jboss_v2'
+        cic.save()
+        self.assertEqual(0, len(mql.run("SELECT offer 'soft1_webapp_ee6_jboss' INSTANCES")))
+        self.assertEqual(1, len(mql.run("SELECT lc 'web application EE6' INSTANCES")))
+        lc = cic.implements
+        lc.name = 'web application EE7'
+        lc.save()
+        self.assertEqual(0, len(mql.run("SELECT lc 'web application EE6' INSTANCES")))
+
+        ## Pagination cursors are cached with the results
+        page = mql.iterate("SELECT 'jbossas' INSTANCES ORDER BY name LIMIT 2")
+        list(page)
+        cached = mql.iterate("SELECT 'jbossas' INSTANCES ORDER BY name LIMIT 2")
+        list(cached)
+        self.assertEqual(page.cursor, cached.cursor)
+
+    def test_iterate_chunks(self):
+        for query in ("SELECT 'jbossas' INSTANCES WITH COMPUTATIONS", "SELECT name,group.name FROM 'jbossas' INSTANCES"):
+            self.assertEqual(mql.run(query), list(mql.iterate(query, chunk_size=3)))
+
+    def test_columns(self):
+        self.assertEqual(['name', 'group_name', 'group_domain_name'], mql.columns("SELECT name,group.name,group.domain.name FROM 'jbossas' INSTANCES"))
+        columns = mql.columns("SELECT 'jbossas' INSTANCES WITH COMPUTATIONS")
+        for compo in mql.run("SELECT 'jbossas' INSTANCES WITH COMPUTATIONS"):
+            self.assertTrue(set(compo.keys()) <= set(columns))
+
+    def test_streamed_outputs(self):
+        query = "SELECT 'jbossas' INSTANCES"
+        expected = mql.run(query)
+        client = Client()
+
+        response = client.get(reverse('ref:mqlquery', args=['json', query]))
+        self.assertEqual(expected, json.loads(b''.join(response.streaming_content)))
+
+        response = client.get(reverse('ref:mqlquery', args=['ndjson', query]))
+        self.assertEqual(expected, [json.loads(line) for line in b''.join(response.streaming_content).splitlines()])
+
+        response = client.get(reverse('ref:mqlquery', args=['csv', query]))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(expected) + 1, len(lines))
+        self.assertTrue(lines[0].startswith('mage_id;'))
+
+        response = client.get(reverse('ref:mqlquery', args=['sh', query]))
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('MAGE_4_NAME="%s"' % expected[3]['name'], content)
+        self.assertTrue(content.endswith('MAGE_RESULT_COUNT=4'))
+
+        response = client.get(reverse('ref:mqlquery', args=['bash4', query]))
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('MAGE_RESULTS+=(%s)' % expected[0]['mage_id'], content)
+        self.assertIn('MAGE_RESULTS_COUNT=4', content)
+
+    def test_streamed_outputs_errors(self):
+        ## Errors are raised before anything is streamed
+        client = Client(raise_request_exception=False)
+        for query in ("SELECT name, marsupilami.name FROM 'jbossas' INSTANCES", "SELECT name, dedicated_admin_password FROM 'jbossgroup' INSTANCES",
+                      "SELECT name, group.dedicated_admin_password FROM 'jbossas' INSTANCES"):
+            self.assertRaises(Exception, mql.iterate, query)
+            for output_format in ('json', 'ndjson', 'csv', 'sh', 'bash4'):
+                response = client.get(reverse('ref:mqlquery', args=[output_format, query]))
+                self.assertEqual(500, response.status_code, (query, output_format))
+                self.assertFalse(response.streaming)
+
+        ## Relationships only some of the instances have are fine
+        self.assertEqual(200, client.get(reverse('ref:mqlquery', args=['json', "SELECT name, group.name FROM INSTANCES WHERE name='GEP_DEV1_01_01'"])).status_code)
+
+        ## As are declared relationships an instance does not have: the navigation gives None
+        query = "SELECT name, schema.name, schema.instance.sid FROM 'jbossapplication' INSTANCES"
+        self.assertEqual([{'name': 'GEP_DEV1_APP1', 'schema_name': None, 'schema_instance_sid': None}], mql.run(query))
+        for output_format in ('json', 'ndjson', 'csv', 'sh', 'bash4'):
+            response = client.get(reverse('ref:mqlquery', args=[output_format, query]))
+            self.assertEqual(200, response.status_code, output_format)
+            self.assertIn(b'GEP_DEV1_APP1', b''.join(response.streaming_content))
+
+    def test_batch(self):
+        queries = ["SELECT 'jbossas' INSTANCES", "SELECT 'jbossas' INSTANCES WHERE group.name='GEP_DEV1_02'", "SELECT name FROM 'jbossgroup' INSTANCES"]
+        expected = [mql.run(query) for query in queries]
+        cache.clear()
+        self.assertEqual(expected, [list(page) for page in mql.run_batch(queries)])
+
+        ## Instances already loaded by a previous query of the batch are not loaded again
+        cache.clear()
+        pages = mql.run_batch(queries[:2])
+        list(pages[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(expected[1], list(pages[1]))
+
+        client = Client()
+        response = client.post(reverse('ref:mqlbatch', args=['json']), json.dumps(queries), content_type='application/json')
+        self.assertEqual(expected, json.loads(b''.join(response.streaming_content)))
+
+        response = client.post(reverse('ref:mqlbatch', args=['bash4']), json.dumps(queries[:2]), content_type='application/json')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('MAGE_RESULTS_1+=(%s)' % self.i15_2_1._instance.id, content)
+        self.assertIn('MAGE_RESULTS_0_COUNT=4', content)
+        self.assertIn('MAGE_RESULTS_1_COUNT=1', content)
+        self.assertIn('MAGE_QUERIES_COUNT=2', content)
+
+        self.assertEqual(400, client.post(reverse('ref:mqlbatch', args=['json']), 'marsu', content_type='application/json').status_code)
+        self.assertEqual(405, client.get(reverse('ref:mqlbatch', args=['json'])).status_code)
+
+    def test_explain(self):
+        query = "SELECT name, group.name FROM 'jbossas' INSTANCES WHERE group.domain.name='domain1'"
+        res = mql.run('EXPLAIN ' + query)
+        self.assertEqual(1, len(res))
+        report = res[0]
+        self.assertEqual(4, report['result_count'])
+        self.assertEqual(len(report['statements']), report['query_count'])
+        self.assertTrue(report['query_count'] > 0)
+        self.assertEqual(set(('parse', 'filter', 'fetch', 'serialize')), set(report['timings'].keys()))
+        for statement in report['statements']:
+            self.assertIn('SELECT', statement['sql'])
+            self.assertTrue(len(statement['plan']) > 0)
+
+        ## Never from the result cache
+        mql.run(query)
+        self.assertEqual(report['query_count'], mql.explain(query)['query_count'])
+
+        response = Client().post(reverse('ref:mqltester'), {'mql': 'EXPLAIN ' + query})
+        self.assertContains(response, 'SQL queries')
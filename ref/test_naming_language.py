@@ -1,8 +1,11 @@
 # coding: utf-8
 from django.test import TestCase
-from ref.naming_language import resolve
+from ref.naming_language import parse, resolve, resolve_many, parsed_patterns, compiled_patterns, compile_pattern, bump_generations
+from ref.computed_store import dependency_index
+from ref.parse_cache import ParseCache
+from ref.exceptions import MageNamingLanguageSyntaxError
 from ref.demo_items import utility_create_meta
-from ref.models import ImplementationDescription, Project, Application, EnvironmentType, Environment, LogicalComponent, ComponentImplementationClass
+from ref.models import ComponentInstanceComputedValue, ImplementationComputedFieldDescription, ImplementationDescription, ImplementationRelationDescription, Project, Application, EnvironmentType, Environment, LogicalComponent, ComponentImplementationClass
 
 class NLTestCase(TestCase):
     def setUp(self):
@@ -34,11 +37,12 @@ class NLTestCase(TestCase):
         i12_1 = ImplementationDescription.class_for_name('jbossdomain')(name=u'domain1', admin_user='admin', admin_password='pass', \
                 base_http_port=8080, base_https_port=8081, web_admin_port=9990, native_admin_port=9999, _env=e1)
 
-        i13_1 = ImplementationDescription.class_for_name('jbosshost')(_project=p1, name=u'jbosshost1.marsu.net', domain=i12_1, server=i1_1)
+        self.i13_1 = i13_1 = ImplementationDescription.class_for_name('jbosshost')(_project=p1, name=u'jbosshost1.marsu.net', domain=i12_1, server=i1_1)
 
         i14_1 = ImplementationDescription.class_for_name('jbossgroup')(name=u'GEP_DEV1_01', dns_to_use='marsu.pl', \
                    dedicated_admin_login='dev1', dedicated_admin_password='dev1', domain=i12_1, _env=e1)
         i14_1.profile = ""
+        self.i14_1 = i14_1
 
         self.i15_1_1 = ImplementationDescription.class_for_name('jbossas')(name=u'GEP_DEV1_01_01', port_shift=00, host=i13_1, group=i14_1, _env=e1)
 
@@ -120,3 +124,144 @@ class NLTestCase(TestCase):
         pattern = 'client_url?("http://"|(group.dns_to_use?group.domain.name)|":"|(group.domain.base_http_port+10))'
         res = resolve(pattern, self.i16_1)
         self.assertEqual("http://marsu.pl:8090", res)
+
+    def test_parse_cache(self):
+        parsed_patterns.clear()
+        compiled_patterns.clear()
+        resolve('group.domain.name|"-"|name', self.i16_1)
+        resolve('group.domain.name|"-"|name', self.i16_1)
+        resolve('group.domain.name|"-"|name', self.i15_1_1)
+        self.assertEqual(1, parsed_patterns.misses)
+        self.assertEqual(1, compiled_patterns.misses)
+        self.assertEqual(2, compiled_patterns.hits)
+
+    def test_parse(self):
+        expr = parse('group.name|"it""s"|(base_port + 10)').expr
+        self.assertEqual(['group', 'name'], expr.datatoken.navigation)
+        self.assertEqual(['|', '|'], [group.operator for group in expr.right_group])
+        self.assertEqual('it"s', expr.right_group[0].datatoken.text)
+        self.assertEqual(['base_port'], expr.right_group[1].expr.datatoken.navigation)
+        self.assertEqual('10', expr.right_group[1].expr.right_group[0].datatoken.num)
+
+        for pattern in ('', 'name|', '_name', '"text', 'name "text"', '(name', 'name)'):
+            self.assertRaises(MageNamingLanguageSyntaxError, parse, pattern)
+
+    def test_parse_cache_eviction(self):
+        c = ParseCache(lambda text: text.upper(), max_size=2)
+        self.assertEqual('A', c.get('a'))
+        c.get('b')
+        c.get('a')  # 'b' is now the least recently used item
+        c.get('c')
+        self.assertEqual(1, c.evictions)
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertEqual({'size': 2, 'max_size': 2, 'hits': 1, 'misses': 3, 'evictions': 1}, c.stats())
+
+    def test_compiled_navigations(self):
+        f = compile_pattern('client_url?("http://"|(group.dns_to_use?group.domain.name)|":"|(group.domain.base_http_port+10))')
+        self.assertEqual({('client_url',), ('group', 'dns_to_use'), ('group', 'domain', 'name'), ('group', 'domain', 'base_http_port')}, set(f.navigations))
+
+    def test_compiled_context(self):
+        f = compile_pattern('client_url?("http://"|(group.dns_to_use?group.domain.name)|":"|(group.domain.base_http_port+10))')
+        self.assertEqual("http://marsu.pl:8090", f({('group', 'dns_to_use'): 'marsu.pl', ('group', 'domain', 'base_http_port'): '8080'}))
+        self.assertEqual("http://domain1:10", f({('group', 'domain', 'name'): 'domain1', ('group', 'domain', 'base_http_port'): '0'}))
+        self.assertEqual("http://marsu.pl:8090", f(self.i16_1))
+
+    def test_compiled_constant_folding(self):
+        self.assertNumQueries(0, lambda: self.assertEqual('12345', compile_pattern('1|"2"|(3|4)|5')(self.i16_1)))
+        self.assertNumQueries(0, lambda: self.assertEqual(60, compile_pattern('(50+10)?name')(self.i16_1)))
+
+    def test_nested_first_expression(self):
+        res = resolve('(group.name|"-")|name', self.i16_1)
+        self.assertEqual('GEP_DEV1_01-GEP_DEV1_APP1', res)
+
+    def test_resolve_many(self):
+        instances = [self.i16_1, self.i15_1_1]
+        for pattern in ('name', 'group.domain.name', 'group.domain.base_http_port+100', 'name|"@"|(group.dns_to_use?group.domain.name)', 'group.mage_id', 'host.server.dns|":"|group.profile', '"x"|2'):
+            expected = dict((i._instance.pk, resolve(pattern, i)) for i in instances)
+            self.assertEqual(expected, resolve_many(pattern, instances), pattern)
+
+    def test_resolve_many_db_impact(self):
+        instances = [self.i16_1, self.i15_1_1]
+        # One query for the 'group' level, one for the 'domain' level, one for all field values.
+        self.assertNumQueries(3, lambda: resolve_many('name|"@"|(group.dns_to_use?group.domain.name)|group.domain.mage_id', instances))
+        self.assertNumQueries(0, lambda: resolve_many('1|2', instances))
+
+    def test_computed_store_read(self):
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='dns')
+        self.assertEqual('marsu.pl', cf.resolve(self.i15_1_1))
+        self.assertEqual(1, ComponentInstanceComputedValue.objects.filter(field=cf, instance=self.i15_1_1._instance).count())
+        self.assertNumQueries(1, lambda: self.assertEqual('marsu.pl', cf.resolve(self.i15_1_1)))
+
+    def test_computed_store_refresh_on_field(self):
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='dns')
+        http = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='http_port')
+        self.assertEqual('marsu.pl', cf.resolve(self.i15_1_1))
+        self.assertEqual(8080, http.resolve(self.i15_1_1))
+
+        self.i14_1.dns_to_use = 'houba.hop'
+        self.assertEqual('houba.hop', ComponentInstanceComputedValue.objects.get(field=cf, instance=self.i15_1_1._instance).value.strip('"'))
+        self.assertEqual('houba.hop', cf.resolve(self.i15_1_1))
+
+        self.i13_1.domain.proxy.base_http_port = 9000
+        self.assertEqual(9000, http.resolve(self.i15_1_1))
+
+    def test_computed_store_refresh_on_relation(self):
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='group_name')
+        self.assertEqual('GEP_DEV1_01', cf.resolve(self.i15_1_1))
+
+        i14_2 = ImplementationDescription.class_for_name('jbossgroup')(_env=self.i15_1_1._instance.environments.all()[0], name=u'GEP_DEV1_02', dns_to_use='marsu.pl', \
+                   dedicated_admin_login='dev1', dedicated_admin_password='dev1', domain=self.i13_1.domain)
+        self.i15_1_1.group = i14_2
+        self.assertEqual('GEP_DEV1_02', cf.resolve(self.i15_1_1))
+
+    def test_computed_store_purge_on_description(self):
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='group_name')
+        self.assertEqual('GEP_DEV1_01', cf.resolve(self.i15_1_1))
+        cf.pattern = 'group.name|"!"'
+        cf.save()
+        self.assertEqual('GEP_DEV1_01!', cf.resolve(self.i15_1_1))
+
+    def test_computed_store_purge_on_field_description(self):
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='group_name')
+        self.assertEqual('GEP_DEV1_01', cf.resolve(self.i15_1_1))
+
+        ## Renaming a relationship or a field the pattern uses changes its value
+        group = ImplementationRelationDescription.objects.get(source__name='jbossas', name='group')
+        group.name = 'jbossgroup'
+        group.save()
+        self.assertFalse(ComponentInstanceComputedValue.objects.filter(field=cf).exists())
+        self.assertIsNone(cf.resolve(self.i15_1_1))
+        group.name = 'group'
+        group.save()
+        self.assertEqual('GEP_DEV1_01', cf.resolve(self.i15_1_1))
+
+        ## As does deleting it
+        ImplementationDescription.objects.get(name='jbossgroup').field_set.get(name='name').delete()
+        self.assertIsNone(cf.resolve(self.i15_1_1))
+
+    def test_dependency_index_shared_generation(self):
+        index = dependency_index()
+        self.assertIs(index, dependency_index())
+
+        ## A description changed by another process: the generation is bumped in the shared cache only
+        cf = ImplementationComputedFieldDescription.objects.get(description__name='jbossas', name='group_name')
+        ImplementationComputedFieldDescription.objects.filter(pk=cf.pk).update(pattern='host.name')
+        bump_generations(['dependency_index'])
+        self.assertIsNot(index, dependency_index())
+        host = ImplementationRelationDescription.objects.get(source__name='jbossas', name='host')
+        self.assertIn(cf.pk, [owner.pk for owner, relations in dependency_index().by_relation[host.pk]])
+
+    def test_self_description_cache_generations(self):
+        descr = self.i15_1_1._instance.description
+        self.assertEqual('GEP_DEV1_01_01', descr.resolve_self_description(self.i15_1_1))
+        self.assertNumQueries(0, lambda: descr.resolve_self_description(self.i15_1_1))
+
+        # Changing a field the pattern depends on only invalidates the entries of the instance
+        self.i15_1_1.name = 'GEP_DEV1_01_99'
+        self.assertEqual('GEP_DEV1_01_99', descr.resolve_self_description(self.i15_1_1))
+
+        # Changing the pattern invalidates the entries of the whole description
+        descr.self_description_pattern = 'name|"@"|group.name'
+        descr.save()
+        self.assertEqual('GEP_DEV1_01_99@GEP_DEV1_01', descr.resolve_self_description(self.i15_1_1))
@@ -68,6 +68,7 @@ urlpatterns_nonproject = [
 
     ## MQL (scripting API)
     re_path(r'mqltester/$', views.mql_tester, name='mqltester'),
+    re_path(r'mqlbatch/(?P<output_format>json|bash4)$', views.mql_batch, name='mqlbatch'),
     re_path(r'mql/(?P<output_format>.*)/(?P<query>.*)$', views.mql_query, name='mqlquery'),
 ]
 
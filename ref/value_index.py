@@ -0,0 +1,53 @@
+# coding: utf-8
+'''
+    Index of the field values, used by MQL wildcard predicates.
+
+    Values are found by their beginning with the index of ComponentInstanceField.value, by their end with the index of
+    its reversed_value column (set on save) and by any part of their content with their trigrams: a value can only
+    contain a text if it has all the trigrams of this text. Trigrams are lower case, so that they give the candidates of
+    both case sensitive and case insensitive (SQLite) comparisons - the comparison itself is still done on the
+    candidates.
+
+    Trigrams are maintained by the signal handlers of ref.cache. Field values must therefore be saved one by one, or
+    given to index() after a bulk operation.
+
+    @license: Apache License, Version 2.0
+'''
+
+## Django imports
+from django.db.models import Count
+
+## MAGE imports
+from ref.models import ComponentInstanceFieldTrigram
+
+
+def trigrams(value):
+    value = str(value).lower()
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+def index(field_values, created=False):
+    """(Re)builds the trigrams of the given ComponentInstanceField objects. created: they have no trigrams yet."""
+    field_values = list(field_values)
+    if not created:
+        ComponentInstanceFieldTrigram.objects.filter(field_value__in=field_values).delete()
+    ComponentInstanceFieldTrigram.objects.bulk_create([ComponentInstanceFieldTrigram(field_value=fv, trigram=trigram)
+                                                       for fv in field_values for trigram in trigrams(fv.value)])
+
+
+def startswith_lookup(text):
+    return {'value__startswith': text}
+
+
+def endswith_lookup(text):
+    return {'reversed_value__startswith': text[::-1]}
+
+
+def contains_lookup(text):
+    """ComponentInstanceField lookups of the values containing text. Texts shorter than a trigram cannot use the index."""
+    needed = trigrams(text)
+    if not needed:
+        return {'value__contains': text}
+    candidates = ComponentInstanceFieldTrigram.objects.filter(trigram__in=needed).values('field_value_id') \
+        .annotate(matched_trigrams=Count('pk')).filter(matched_trigrams=len(needed)).values('field_value_id')
+    return {'id__in': candidates, 'value__contains': text}
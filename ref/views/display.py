@@ -9,6 +9,7 @@ from ref.models.instances import Environment, ComponentInstance, \
     ComponentInstanceField
 from ref.models.description import ImplementationFieldDescription, \
     ImplementationComputedFieldDescription
+from ref.computed_store import get_many_values
 
 
 def envt(request, envt_id):
@@ -22,18 +23,17 @@ def envt(request, envt_id):
                     select_related('description').\
                     order_by('description__name', 'id')
     
-    sec = (False,)
-    if not envt.protected or (request.user.is_authenticated and request.user.has_perm(request.project.perm_see_allfields)):
-        sec = (True, False)
+    show_sensitive = not envt.protected or (request.user.is_authenticated and request.user.has_perm(request.project.perm_see_allfields))
         
     cis = ComponentInstance.objects.filter(environments__id=envt_id, deleted=False).\
                     select_related('description').\
                     select_related('instanciates__implements__application').\
-                    prefetch_related(Prefetch('field_set', queryset=ComponentInstanceField.objects.filter(field__widget_row__gte=0, field__sensitive__in=sec).order_by('field__widget_row', 'field__id'))).\
-                    prefetch_related(Prefetch('description__field_set', queryset=ImplementationFieldDescription.objects.filter(widget_row__gte=0, sensitive__in=sec).order_by('widget_row', 'id'))).\
-                    prefetch_related(Prefetch('description__computed_field_set', queryset=ImplementationComputedFieldDescription.objects.filter(widget_row__gte=0, sensitive__in=sec).order_by('widget_row', 'id'))).\
+                    prefetch_related(*__field_prefetches(show_sensitive)).\
                     order_by('description__tag', 'description__name')
 
+    cis = list(cis)
+    __resolve_computed_fields(cis)
+
     return render(request, 'ref/envt.html', {'envt': envt, 'deleted': deleted, 'cis' : cis})
 
 def backuped(request):
@@ -51,16 +51,43 @@ def shared_ci(request):
                     select_related('description').\
                     order_by('description__name', 'id')
     
-    sec = (False,)
-    if request.user.is_authenticated and request.user.has_perm(request.project.perm_see_allfields):
-        sec = (True, False)
+    show_sensitive = request.user.is_authenticated and request.user.has_perm(request.project.perm_see_allfields)
         
     cis = ComponentInstance.objects.annotate(num_envt=Count('environments')).filter(~Q(num_envt=1), deleted=False, project=request.project).\
                     select_related('description').\
                     prefetch_related('environments').\
-                    prefetch_related(Prefetch('field_set', queryset=ComponentInstanceField.objects.filter(field__widget_row__gte=0, field__sensitive__in=sec).order_by('field__widget_row', 'field__id'))).\
-                    prefetch_related(Prefetch('description__field_set', queryset=ImplementationFieldDescription.objects.filter(widget_row__gte=0, sensitive__in=sec).order_by('widget_row', 'id'))).\
-                    prefetch_related(Prefetch('description__computed_field_set', queryset=ImplementationComputedFieldDescription.objects.filter(widget_row__gte=0, sensitive__in=sec).order_by('widget_row', 'id'))).\
+                    prefetch_related(*__field_prefetches(show_sensitive)).\
                     order_by('description__tag', 'description__name')
 
+    cis = list(cis)
+    __resolve_computed_fields(cis)
+
     return render(request, 'ref/envt_shared.html', {'deleted': deleted, 'cis' : cis})
+
+
+def __field_prefetches(show_sensitive):
+    """ Displayed fields, values and computed fields of instances. Sensitive values are not loaded if they are hidden. """
+    values = ComponentInstanceField.objects.filter(field__widget_row__gte=0)
+    fields = ImplementationFieldDescription.objects.filter(widget_row__gte=0)
+    computed_fields = ImplementationComputedFieldDescription.objects.filter(widget_row__gte=0)
+    if not show_sensitive:
+        values = values.filter(field__sensitive=False)
+        fields = fields.filter(sensitive=False)
+        computed_fields = computed_fields.filter(sensitive=False)
+    return (Prefetch('field_set', queryset=values.order_by('field__widget_row', 'field__id')),
+            Prefetch('description__field_set', queryset=fields.order_by('widget_row', 'id')),
+            Prefetch('description__computed_field_set', queryset=computed_fields.order_by('widget_row', 'id')))
+
+
+def __resolve_computed_fields(cis):
+    """
+        Sets a 'computed_values' list on each instance, in the order of (the prefetched) description__computed_field_set.
+        All the computed fields are resolved at once for all the instances.
+    """
+    instances = {}
+    for ci in cis:
+        for cf in ci.description.computed_field_set.all():
+            instances.setdefault(cf, []).append(ci)
+    values = get_many_values(instances)
+    for ci in cis:
+        ci.computed_values = [values[cf][ci.pk] for cf in ci.description.computed_field_set.all()]
@@ -1,9 +1,12 @@
 # coding: utf-8
 
-from django.http.response import HttpResponse
+from django.http.response import StreamingHttpResponse, HttpResponseBadRequest
+from django.views.decorators.http import require_POST
 from django.shortcuts import render
+from django.template.loader import get_template
 from django import forms
 from ref import mql
+from ref.coalescing import coalesce_requests
 import unicodecsv as csv
 import json
 
@@ -20,6 +23,8 @@ def mql_tester(request):
         if form.is_valid(): # All validation rules pass
             try:
                 res = mql.run(form.cleaned_data['mql'], return_sensitive_data = request.user.has_perm('ref.allfields_componentinstance'))
+                if mql.parsed_queries.get(form.cleaned_data['mql']).explain:
+                    return render(request, 'ref/mql_tester.html', {'mql': form.cleaned_data['mql'], 'form': form, 'explain': res[0], 'base': base})
                 return render(request, 'ref/mql_tester.html', {'mql': form.cleaned_data['mql'], 'form': form, 'results': res, 'base': base})
             except Exception as e:
                 error = e.__str__()
@@ -28,29 +33,102 @@ def mql_tester(request):
 
     return render(request, 'ref/mql_tester.html', {'form': form, 'base': base, 'error': error})
 
+@coalesce_requests
 def mql_query(request, output_format, query):
-    res = mql.run(query, return_sensitive_data = request.user.has_perm('ref.allfields_componentinstance'))
+    ''' All formats are streamed: results are serialized while they are fetched, chunk by chunk '''
+    return_sensitive_data = request.user.has_perm('ref.allfields_componentinstance')
+    res = mql.iterate(query, return_sensitive_data = return_sensitive_data)
 
     if output_format == 'csv':
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
+        response = StreamingHttpResponse(__stream_csv(res, mql.columns(query, return_sensitive_data = return_sensitive_data)), content_type='text/csv; charset=utf-8')
         response['Content-Disposition'] = 'attachment; filename="result.csv"'
-        dd = {}
-        for it in res:
-            for k in it.keys():
-                dd[k] = None
-        wr = csv.DictWriter(response, fieldnames=dd.keys(), restval="", extrasaction='ignore', dialect='excel', delimiter=";")
-        wr.writeheader()
-        wr.writerows(res)
         return response
-    
+
     if output_format == 'sh':
-        return render(request, 'ref/mql_export_sh.html', {'instances': res}, content_type="text/plain")
-    
+        return StreamingHttpResponse(__stream_sh(res), content_type="text/plain")
+
     if output_format == 'bash4':
-        return render(request, 'ref/mql_export_bash4.html', {'instances': res}, content_type="text/plain")
-    
+        return StreamingHttpResponse(__stream_bash4(res), content_type="text/plain")
+
     if output_format == 'json':
-        response = HttpResponse(content_type='text/json; charset=utf-8')
-        json.dump(res, fp = response, ensure_ascii = False, indent= 4)
-        return response
+        return StreamingHttpResponse(__stream_json(res), content_type='text/json; charset=utf-8')
+
+    if output_format == 'ndjson':
+        return StreamingHttpResponse(('%s\n' % json.dumps(compo, ensure_ascii = False) for compo in res), content_type='application/x-ndjson; charset=utf-8')
+
+@require_POST
+@coalesce_requests
+def mql_batch(request, output_format):
+    ''' Many queries in a single call. The body is a JSON list of queries. Instances are shared between the queries. '''
+    try:
+        queries = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        queries = None
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return HttpResponseBadRequest('the body must be a JSON list of MQL queries')
+
+    pages = mql.run_batch(queries, return_sensitive_data = request.user.has_perm('ref.allfields_componentinstance'))
+
+    if output_format == 'json':
+        return StreamingHttpResponse(__stream_json_batch(pages), content_type='text/json; charset=utf-8')
+
+    if output_format == 'bash4':
+        return StreamingHttpResponse(__stream_bash4_batch(pages), content_type="text/plain")
+
+
+class __Echo(object):
+    '''File-like object returning what is written, so that a csv writer can be used as a generator'''
+    def write(self, value):
+        return value
+
+def __stream_csv(res, fieldnames):
+    wr = csv.DictWriter(__Echo(), fieldnames=fieldnames, restval="", extrasaction='ignore', dialect='excel', delimiter=";")
+    yield wr.writerow(dict(zip(fieldnames, fieldnames))) # writeheader does not return the written line
+    for compo in res:
+        yield wr.writerow(compo)
+
+def __stream_json(res):
+    ''' With a LIMIT clause, results are wrapped inside an object also giving the cursor of the next page (known at the end) '''
+    if res.limit:
+        yield '{"results": '
+    yield '['
+    separator = '\n'
+    for compo in res:
+        yield separator + json.dumps(compo, ensure_ascii = False, indent = 4)
+        separator = ',\n'
+    yield '\n]'
+    if res.limit:
+        yield ',\n"cursor": %s}' % json.dumps(res.cursor)
+
+def __stream_json_batch(pages):
+    yield '['
+    separator = '\n'
+    for page in pages:
+        yield separator
+        yield from __stream_json(page)
+        separator = ',\n'
+    yield '\n]'
+
+def __stream_sh(res):
+    template = get_template('ref/mql_export_sh.html')
+    count = 0
+    for count, compo in enumerate(res, 1):
+        yield template.render({'compo': compo, 'counter': count})
+    yield '\nMAGE_RESULT_COUNT=%s' % count
+
+def __stream_bash4(res, array='MAGE_RESULTS', header=True):
+    template = get_template('ref/mql_export_bash4.html')
+    yield 'declare -xa %s=()\n' % array
+    if header:
+        yield '\nunset MAGE_RESULTS_DATA\ndeclare -xA MAGE_RESULTS_DATA\n'
+    count = 0
+    for count, compo in enumerate(res, 1):
+        yield template.render({'compo': compo, 'array': array})
+    yield '%s_COUNT=%s\nexport %s\n' % (array, count, array)
 
+def __stream_bash4_batch(pages):
+    ''' Ids returned by query n are inside MAGE_RESULTS_n, data of all the instances inside MAGE_RESULTS_DATA '''
+    yield 'unset MAGE_RESULTS_DATA\ndeclare -xA MAGE_RESULTS_DATA\n'
+    for i, page in enumerate(pages):
+        yield from __stream_bash4(page, 'MAGE_RESULTS_%s' % i, header=False)
+    yield 'MAGE_QUERIES_COUNT=%s\n' % len(pages)
@@ -11,10 +11,12 @@ from django.http.response import HttpResponse
 
 ## MAGE imports
 from ref.models import LogicalComponent
+from ref.coalescing import coalesce_requests
 from django.db.models.query import Prefetch
 from scm.models import LogicalComponentVersion, InstallableSet, InstallableItem
 
 
+@coalesce_requests
 def get_lc_versions(request, lc_id):
     lc = LogicalComponent.objects.get(pk=lc_id, application__project=request.project)
     res = []